@@ -26,6 +26,9 @@ function Start-Waitress {
         }
     }
 
+    # Create the database tables once; importing the app no longer does
+    python -c "from run import app; from app import init_db; init_db(app)"
+
     # Start Waitress in the background and capture its PID
     Start-Process "python" -ArgumentList "-m", "waitress", "--host=$SERVER_HOST", "--port=$PORT", $APP_NAME -PassThru | Select-Object -ExpandProperty Id | Out-File $PID_FILE
 
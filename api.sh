@@ -2,10 +2,10 @@
 
 # Set variables
 APP_NAME="run:app"  # The entry point of your app
-HOST="0.0.0.0"
-PORT="8001"
-WORKERS=4
+ASGI_APP_NAME="asgi:app"  # Async entry point (classify/memory served on an event loop)
 PID_FILE="gunicorn.pid"
+# Bind address, workers and threads come from gunicorn.conf.py
+# (GUNICORN_BIND, WEB_CONCURRENCY, GUNICORN_THREADS)
 
 # Function to start gunicorn
 start_gunicorn() {
@@ -15,15 +15,31 @@ start_gunicorn() {
         echo "Gunicorn is already running."
     else
         if [ "$2" == "background" ]; then
-            gunicorn -w $WORKERS -b $HOST:$PORT $APP_NAME --pid $PID_FILE &
+            gunicorn $APP_NAME --pid $PID_FILE &
             echo "Gunicorn started in the background with PID $(cat $PID_FILE)."
         else
-            gunicorn -w $WORKERS -b $HOST:$PORT $APP_NAME --pid $PID_FILE
+            gunicorn $APP_NAME --pid $PID_FILE
             echo "Gunicorn started in the foreground with PID $(cat $PID_FILE)."
         fi
     fi
 }
 
+# Function to start gunicorn with uvicorn (ASGI) workers
+start_asgi() {
+    echo "Starting Gunicorn with ASGI workers..."
+    if [ -f "$PID_FILE" ] && kill -0 $(cat "$PID_FILE") > /dev/null 2>&1; then
+        echo "Gunicorn is already running."
+    else
+        if [ "$2" == "background" ]; then
+            gunicorn -k uvicorn.workers.UvicornWorker $ASGI_APP_NAME --pid $PID_FILE &
+            echo "Gunicorn (ASGI) started in the background with PID $(cat $PID_FILE)."
+        else
+            gunicorn -k uvicorn.workers.UvicornWorker $ASGI_APP_NAME --pid $PID_FILE
+            echo "Gunicorn (ASGI) started in the foreground with PID $(cat $PID_FILE)."
+        fi
+    fi
+}
+
 # Function to stop gunicorn
 stop_gunicorn() {
     echo "Stopping Gunicorn..."
@@ -57,8 +73,9 @@ show_usage() {
 
 # Show script usage
 usage() {
-    echo "Usage: $0 {start|stop|usage} [background]"
+    echo "Usage: $0 {start|start-asgi|stop|usage} [background]"
     echo "   start       Start Gunicorn (optional: 'background' to run in the background)"
+    echo "   start-asgi  Start Gunicorn with async ASGI workers (optional: 'background')"
     echo "   stop        Stop the running Gunicorn server"
     echo "   usage       Show usage statistics for Gunicorn"
     exit 1
@@ -69,6 +86,9 @@ case "$1" in
     start)
         start_gunicorn "$@"
         ;;
+    start-asgi)
+        start_asgi "$@"
+        ;;
     stop)
         stop_gunicorn
         ;;
@@ -1,38 +1,17 @@
-import importlib
 import logging
-from elasticsearch import Elasticsearch
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
-from redis import Redis
+from .clients import ClientProxy
 from .config import Config
 
-logger = logging.getLogger()
-
 db = SQLAlchemy()
 jwt = JWTManager()
 
-redis_client = Redis.from_url(Config.REDIS_URL)
-
-# Import the utils module
-utils_module = "app.utils"  # Single utils module
-try:
-    utils = importlib.import_module(utils_module)  # Import the merged utils
-    logger.info(f"Successfully imported {utils_module}")
-except ModuleNotFoundError as e:
-    logger.error(f"Error importing {utils_module}: {e}")
-    raise ImportError(f"Module {utils_module} could not be found")
-
-# Initialize Elasticsearch client
-try:
-    es = Elasticsearch(Config.ELASTICSEARCH_URL)
-    if es.ping():
-        logger.info("Successfully connected to Elasticsearch")
-    else:
-        logger.warning("Failed to connect to Elasticsearch")
-except Exception as e:
-    logger.error(f"Error connecting to Elasticsearch: {e}")
-    raise ConnectionError(f"Could not connect to Elasticsearch at {Config.ELASTICSEARCH_URL}")
+# Shared pooled clients, resolved per process by app.clients.registry. Nothing
+# connects at import time; /api/readyz reports whether the dependencies are up.
+redis_client = ClientProxy("redis")
+es = ClientProxy("es")
 
 
 def create_app():
@@ -46,3 +25,13 @@ def create_app():
     app.register_blueprint(api_bp, url_prefix='/api')
 
     return app
+
+
+def init_db(app):
+    """Create missing tables. Runs once before serving, never at import time."""
+    with app.app_context():
+        try:
+            db.create_all()
+            logging.info("Database and tables created successfully.")
+        except Exception as e:
+            logging.error(f"Error creating database: {e}")
@@ -1,13 +1,27 @@
 import json
 import logging
+import os
 import time
-from elasticsearch import Elasticsearch
-from flask import Blueprint, Response, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask import Blueprint, Response, g, request, jsonify, stream_with_context
+from flask_jwt_extended import create_access_token
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
 from werkzeug.security import check_password_hash
 from .models import db, User
-from .utils import classify_text, get_embedding
-from . import redis_client
+from .auth import api_keys, auth_required, current_caller
+from .utils import classify_stages, classify_text, classify_texts, get_embedding, path_stats
+from .embedding_cache import embedding_cache
+from .semantic_cache import semantic_cache
+from .llm_batch import llm_batcher
+from .ingest import index_source, ingest_queue, memory_document, store_memories, track_memory
+from . import es, redis_client
+from .clients import registry
+from .logger import bind_request, unbind_request
+from .metrics import IN_FLIGHT, REQUEST_LATENCY, begin_timing, count_cache, render_metrics, server_timing, stage
+from .health import readiness
+from .resilience import breaker_stats, clear_deadline, start_deadline
+from .ratelimit import check_rate_limit, limit_for, rate_limit_headers
+from .singleflight import SingleFlight, cache_probe_keys, queue_cache_writes, refresh_pool, split_probe
 from datetime import timedelta
 from .config import Config
 import logging
@@ -15,10 +29,195 @@ from flask import request
 
 logger = logging.getLogger()
 
+api_bp = Blueprint('api', __name__)
 
-es = Elasticsearch(Config.ELASTICSEARCH_URL)
+def shareable_result(result):
+    """A degraded answer reflects its own request's budget; other callers compute theirs."""
+    _, info = result
+    return "degraded" not in info
+
+
+single_flight = SingleFlight(redis_client, shareable_result)
+
+
+def cache_result(query, ai_response, info):
+    # A degraded answer is only good for this request
+    if Config.USE_REDIS and "degraded" not in info:
+        with stage("redis"):
+            queue_cache_writes(redis_client.pipeline(transaction=False), query, ai_response).execute()
+        logging.info(f"Cached response for query: '{query}' with expiration {Config.REDIS_CACHE_EXPIRATION} seconds")
+
+
+def classify_and_cache(query):
+    """Classify a query and store the result in the Redis cache."""
+    ai_response, _, info = classify_text(query, es)
+    cache_result(query, ai_response, info)
+    return ai_response, info
+
+
+def classify_coalesced(query):
+    """Classify a cache miss once, however many requests are waiting for it."""
+    if not Config.SINGLE_FLIGHT_ENABLED:
+        return classify_and_cache(query), False
+    return single_flight.do(query, lambda: classify_and_cache(query))
+
+
+def refresh_stale(query):
+    """Recompute a stale cached result in the background."""
+    def run():
+        try:
+            classify_coalesced(query)
+        except Exception as e:
+            logging.error(f"Error refreshing stale result for query '{query}': {str(e)}")
+    refresh_pool.submit(run)
+
+
+@api_bp.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    begin_timing()
+    g.request_id = bind_request(request.headers.get("X-Request-Id"),
+                                request.headers.get('X-Forwarded-For', request.remote_addr))
+    clear_deadline()
+    # Label by route template so ids in the path don't multiply series
+    g.route = request.url_rule.rule if request.url_rule else "unmatched"
+    IN_FLIGHT.labels(g.route).inc()
+
+
+@api_bp.after_request
+def add_rate_limit_headers(response):
+    limit = g.pop("rate_limit", None)
+    if limit:
+        response.headers.update(rate_limit_headers(limit))
+    return response
+
+
+@api_bp.after_request
+def add_server_timing(response):
+    # A stream's latency is recorded by event_stream() once its body has been sent
+    if "request_start" in g and not g.get("streaming"):
+        total = time.perf_counter() - g.request_start
+        REQUEST_LATENCY.labels(g.route, request.method, response.status_code).observe(total)
+        response.headers["Server-Timing"] = server_timing(total)
+    if "request_id" in g:
+        response.headers["X-Request-Id"] = g.request_id
+    return response
+
+
+@api_bp.teardown_request
+def finish_request_metrics(exc):
+    route = g.pop("route", None)
+    if route is not None:
+        IN_FLIGHT.labels(route).dec()
+    unbind_request()
+
+
+def classification_fields(info):
+    """Response fields describing how a classification was produced."""
+    fields = {"cached": "false"}
+    if "path" in info:
+        fields["path"] = info["path"]
+    if info.get("path") == "semantic":
+        fields["cached"] = "semantic"
+        fields["similarity"] = info["similarity"]
+    elif info.get("path") == "centroid":
+        fields["similarity"] = info["similarity"]
+    elif info.get("path") in ("knn", "knn_fallback"):
+        fields["agreement"] = info["agreement"]
+        fields["score"] = info["score"]
+    if "degraded" in info:
+        fields["degraded"] = info["degraded"]
+    return fields
+
+
+def stale_body(cached_result, start_time):
+    count_cache("stale")
+    return {
+        "response": json.loads(cached_result),
+        "cached": "stale",
+        "time": round(time.time() - start_time, 2)
+    }
+
+
+def neighbor_fields(documents):
+    return [
+        {
+            "category": doc["Category"],
+            "subcategory": doc["Sub-Category"],
+            "score": round(doc["score"], 4),
+            "description": doc["Description"]
+        }
+        for doc in documents
+    ]
+
+
+def provisional_fields(vote):
+    category, subcategory, agreement, score = vote
+    return {
+        "response": {"category": category, "subcategory": subcategory},
+        "agreement": round(agreement, 4),
+        "score": round(score, 4)
+    }
+
+
+def wants_stream(data, accept):
+    """Stream when asked with ``"stream": true`` or ``Accept: text/event-stream``."""
+    if data.get("stream") is True:
+        return True
+    return parse_accept_header(accept, MIMEAccept).best_match(["application/json", "text/event-stream"]) == "text/event-stream"
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def event_stream(events):
+    g.streaming = True
+
+    def body():
+        try:
+            for event, data in events:
+                yield sse_event(event, data)
+        finally:
+            # after_request runs before the body, so the stream's stages are only known here
+            REQUEST_LATENCY.labels(g.route, request.method, 200).observe(time.perf_counter() - g.request_start)
+
+    response = Response(stream_with_context(body()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def classification_events(query, start_time, stale_result=None):
+    """SSE events for a cache miss, sent as each stage of the pipeline finishes."""
+    yield "cache", {"cached": "false"}
+    try:
+        for event, data in classify_stages(query, es):
+            if event == "neighbors":
+                yield "neighbors", {"neighbors": neighbor_fields(data)}
+            elif event == "provisional":
+                yield "provisional", provisional_fields(data)
+            else:
+                ai_response, _, info = data
+    except Exception as e:
+        logging.error(f"Error during streamed classification: {str(e)}")
+        if stale_result:
+            yield "result", stale_body(stale_result, start_time)
+        else:
+            yield "error", {"msg": f"Error getting AI response: {str(e)}"}
+        return
+    if stale_result and "degraded" in info:
+        logging.info(f"Serving stale result for query: '{query}' instead of a degraded answer")
+        yield "result", stale_body(stale_result, start_time)
+        return
+
+    cache_result(query, ai_response, info)
+    response = {"response": ai_response, **classification_fields(info), "time": round(time.time() - start_time, 2)}
+    count_cache(response["cached"])
+    logging.info(f"Returning streamed response for query: '{query}'")
+    yield "result", response
 
-api_bp = Blueprint('api', __name__)
 
 @api_bp.route('/register', methods=['POST'])
 def register_user():
@@ -52,8 +251,10 @@ def login_user():
     username = data.get('username')
     password = data.get('password')
 
-    user = User.query.filter_by(username=username).first()
-    if not user or not user.check_password(password):
+    with stage("auth"):
+        user = User.query.filter_by(username=username).first()
+        valid = user is not None and user.check_password(password)
+    if not valid:
         logging.warning(f"Invalid login attempt for username '{username}'")
         return jsonify({"msg": "Invalid credentials"}), 401
 
@@ -63,25 +264,13 @@ def login_user():
     return jsonify(access_token=access_token)
 
 @api_bp.route('/classify', methods=['POST'])
-@jwt_required()
+@auth_required
 def get_ai_response():
-    """Classify a user query with caching and rate limiting."""
+    """Classify a user query with caching and rate limiting, optionally as a stream of SSE events."""
     logging.info("Classify endpoint accessed")
-    user_identity = get_jwt_identity()
-    rate_limit_key = f"rate_limit:{user_identity}"
-    logging.debug(f"Rate limiting key: {rate_limit_key}")
-
+    caller = current_caller()
     start_time = time.time()  # Start tracking response time
-
-    # Get current count of requests made in the rate-limit window
-    current_count = redis_client.get(rate_limit_key) if Config.USE_REDIS else None
-    if current_count:
-        logging.debug(f"Current request count for user '{user_identity}': {current_count.decode()}")
-
-    # Check rate limit
-    if Config.USE_REDIS and current_count and int(current_count) >= Config.RATE_LIMIT_MAX_REQUESTS:
-        logging.warning(f"Rate limit exceeded for user '{user_identity}'")
-        return jsonify({"msg": "Rate limit exceeded, try again later."}), 429
+    start_deadline(request.headers.get(Config.REQUEST_BUDGET_HEADER))
 
     # Retrieve the user query
     data = request.get_json()
@@ -89,91 +278,264 @@ def get_ai_response():
     if not query:
         logging.warning("Classify request missing 'query' parameter")
         return jsonify({"msg": "Query is required"}), 400
+    stream = wants_stream(data, request.headers.get("Accept"))
 
-    # Check Redis cache for a stored result
+    # Check the rate limit and Redis cache in one round trip
+    stale_result = None
     if Config.USE_REDIS:
-        cached_result = redis_client.get(query)
-        if cached_result:
+        limit = check_rate_limit(redis_client, caller.rate_key, cache_keys=cache_probe_keys([query]))
+        g.rate_limit = limit
+        if not limit.allowed:
+            logging.warning(f"Rate limit exceeded for '{caller.rate_key}'")
+            return jsonify({"msg": "Rate limit exceeded, try again later."}), 429
+
+        cached_values, fresh = split_probe(limit.cached, 1)
+        cached_result = cached_values[0]
+        if cached_result and not fresh[0] and Config.CACHE_STALE_MODE == "fallback":
+            # Keep the stale value in reserve in case classification degrades
+            stale_result = cached_result
+        elif cached_result:
             elapsed_time = round(time.time() - start_time, 2)
             logging.info(f"Cache hit for query: '{query}'")
+            if not fresh[0]:
+                logging.info(f"Serving stale result for query: '{query}' while refreshing")
+                refresh_stale(query)
             decoded_result = json.loads(cached_result)
-            return jsonify({
+            count_cache("true" if fresh[0] else "stale")
+            body = {
                 "response": decoded_result,
-                "cached": "true",
+                "cached": "true" if fresh[0] else "stale",
                 "time": elapsed_time
-            })
+            }
+            if stream:
+                return event_stream([("cache", {"cached": body["cached"]}), ("result", body)])
+            return jsonify(body)
+
+    # Streams skip request coalescing so each client sees its own stages
+    if stream:
+        logging.info(f"Cache miss for query: '{query}', streaming classification")
+        return event_stream(classification_events(query, start_time, stale_result))
 
-    # If not cached, query Elasticsearch and classify
+    # If not cached, query Elasticsearch and classify (once per identical in-flight query)
     try:
         logging.info(f"Cache miss for query: '{query}', querying Elasticsearch")
-        ai_response, _ = classify_text(query, es)
+        (ai_response, info), shared = classify_coalesced(query)
     except Exception as e:
         logging.error(f"Error during Elasticsearch query: {str(e)}")
+        if stale_result:
+            logging.info(f"Serving stale result for query: '{query}' after the error")
+            return jsonify(stale_body(stale_result, start_time))
         return jsonify({"msg": f"Error getting AI response: {str(e)}"}), 500
+    if stale_result and "degraded" in info:
+        logging.info(f"Serving stale result for query: '{query}' instead of a degraded answer")
+        return jsonify(stale_body(stale_result, start_time))
 
     elapsed_time = round(time.time() - start_time, 2)
 
-    # Cache the response in Redis and increment rate limit count
-    if Config.USE_REDIS:
-        # Increment rate limit count or set it if not present
-        if current_count:
-            redis_client.incr(rate_limit_key)
-            logging.debug(f"Incremented rate limit count for user '{user_identity}'")
-        else:
-            redis_client.setex(rate_limit_key, Config.RATE_LIMIT_WINDOW_SECONDS, 1)
-            logging.debug(f"Rate limit key set for user '{user_identity}' with a window of {Config.RATE_LIMIT_WINDOW_SECONDS} seconds")
-
-        # Cache the AI response
-        redis_client.setex(query, Config.REDIS_CACHE_EXPIRATION, json.dumps(ai_response, ensure_ascii=False))
-        logging.info(f"Cached response for query: '{query}' with expiration {Config.REDIS_CACHE_EXPIRATION} seconds")
-
     # Return the AI response
     response = {
         "response": ai_response,
-        "cached": "false",
+        **classification_fields(info),
         "time": elapsed_time
     }
+    if shared:
+        response["cached"] = "coalesced"
+    count_cache(response["cached"])
     logging.info(f"Returning response for query: '{query}'")
     return Response(json.dumps(response, ensure_ascii=False), mimetype='application/json; charset=utf-8')
 
 
+@api_bp.route('/classify/batch', methods=['POST'])
+@auth_required
+def classify_batch():
+    """Classify a list of queries in one request, preserving input order."""
+    logging.info("Batch classify endpoint accessed")
+    caller = current_caller()
+
+    start_time = time.time()
+    # REQUEST_BUDGET_MS is sized for one query; a batch only has a deadline when the client asks for one
+    budget = request.headers.get(Config.REQUEST_BUDGET_HEADER)
+    if budget:
+        start_deadline(budget)
+
+    data = request.get_json()
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not queries:
+        logging.warning("Batch classify request missing 'queries' list")
+        return jsonify({"msg": "Queries must be a non-empty list"}), 400
+    if len(queries) > Config.BATCH_MAX_QUERIES:
+        logging.warning(f"Batch classify request with {len(queries)} queries exceeds the limit")
+        return jsonify({"msg": f"At most {Config.BATCH_MAX_QUERIES} queries are allowed per batch"}), 400
+    if not all(isinstance(query, str) and query for query in queries):
+        logging.warning("Batch classify request contains empty or non-string queries")
+        return jsonify({"msg": "Every query must be a non-empty string"}), 400
+
+    # Every query counts against the rate limit; the cache is probed in the same round trip
+    cached_results, fresh = [None] * len(queries), [True] * len(queries)
+    if Config.USE_REDIS:
+        capacity = limit_for(caller.rate_key)[0]
+        if len(queries) > capacity:
+            # More tokens than the bucket holds: retrying could never succeed
+            logging.warning(f"Batch of {len(queries)} queries exceeds the rate limit of '{caller.rate_key}'")
+            return jsonify({"msg": f"At most {capacity} queries are allowed per batch for this client"}), 400
+        limit = check_rate_limit(redis_client, caller.rate_key, cache_keys=cache_probe_keys(queries), cost=len(queries))
+        g.rate_limit = limit
+        if not limit.allowed:
+            logging.warning(f"Rate limit exceeded for '{caller.rate_key}'")
+            return jsonify({"msg": "Rate limit exceeded, try again later."}), 429
+        cached_results, fresh = split_probe(limit.cached, len(queries))
+        if Config.CACHE_STALE_MODE == "fallback":
+            # Stale entries are reclassified and only served if that degrades
+            stale = {queries[i]: value for i, value in enumerate(cached_results) if value and not fresh[i]}
+            cached_results = [value if fresh[i] else None for i, value in enumerate(cached_results)]
+        else:
+            stale = {}
+            for query in {queries[i] for i, value in enumerate(cached_results) if value and not fresh[i]}:
+                refresh_stale(query)
+    else:
+        stale = {}
+
+    results = [None] * len(queries)
+    for i, cached_result in enumerate(cached_results):
+        if cached_result:
+            results[i] = {
+                "query": queries[i],
+                "response": json.loads(cached_result),
+                "cached": "true" if fresh[i] else "stale",
+                "time": round(time.time() - start_time, 2)
+            }
+    logging.info(f"Batch cache hits: {len(queries) - results.count(None)}/{len(queries)}")
+
+    # Classify the misses as one pipeline, once per distinct query
+    misses = list(dict.fromkeys(queries[i] for i, result in enumerate(results) if result is None))
+    if misses:
+        try:
+            classified = dict(zip(misses, classify_texts(misses, es)))
+        except Exception as e:
+            logging.error(f"Error during batch classification: {str(e)}")
+            return jsonify({"msg": f"Error getting AI response: {str(e)}"}), 500
+
+        for i, query in enumerate(queries):
+            if results[i] is not None:
+                continue
+            ai_response, elapsed_time, info = classified[query]
+            if query in stale and ("error" in info or "degraded" in info):
+                results[i] = {"query": query, "response": json.loads(stale[query]), "cached": "stale", "time": elapsed_time}
+                continue
+            results[i] = {"query": query, "response": ai_response, **classification_fields(info), "time": elapsed_time}
+            if "error" in info:
+                results[i]["error"] = info["error"]
+
+    for result in results:
+        count_cache(result["cached"])
+
+    if Config.USE_REDIS and misses:
+        pipe = redis_client.pipeline(transaction=False)
+        for query in misses:
+            ai_response, _, info = classified[query]
+            if "error" not in info and "degraded" not in info:
+                queue_cache_writes(pipe, query, ai_response)
+        with stage("redis"):
+            pipe.execute()
+        logging.info(f"Cached {len(misses)} batch responses with expiration {Config.REDIS_CACHE_EXPIRATION} seconds")
+
+    response = {
+        "results": results,
+        "time": round(time.time() - start_time, 2)
+    }
+    logging.info(f"Returning batch response for {len(queries)} queries")
+    return Response(json.dumps(response, ensure_ascii=False), mimetype='application/json; charset=utf-8')
+
+
+@api_bp.route('/cache/stats', methods=['GET'])
+@auth_required
+def cache_stats():
+    """Report cache and classification path counters for this worker."""
+    return jsonify({
+        "embedding": embedding_cache.stats(),
+        "semantic": semantic_cache.stats(),
+        "paths": path_stats(),
+        "llm_batch": llm_batcher.stats(),
+        "api_keys": api_keys.stats()
+    })
+
+
+@api_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics aggregated over every worker of this server."""
+    body, content_type = render_metrics()
+    return Response(body, content_type=content_type)
+
+
+@api_bp.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the worker is serving requests. No dependency is contacted."""
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+@api_bp.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 200 once every configured dependency answers, 503 otherwise."""
+    ready, checks = readiness()
+    return jsonify({"status": "ready" if ready else "unavailable", "checks": checks}), 200 if ready else 503
+
+
+@api_bp.route('/pools', methods=['GET'])
+@auth_required
+def pool_stats():
+    """Report outbound connection pool usage for this worker."""
+    return jsonify({**registry.stats(), "breakers": breaker_stats()})
+
+
 @api_bp.route('/memory', methods=['POST'])
-@jwt_required()
+@auth_required
 def store_memory():
-    """Store a new document with category, subcategory, description."""
+    """Store one document, or many under "documents", with category, subcategory, description.
+
+    With ``"async": true`` the documents are queued for the background
+    ingestion worker and a job id is returned with status 202.
+    """
     logging.info("Memory endpoint accessed")
 
     # Get current user identity
-    user_identity = get_jwt_identity()
+    user_identity = current_caller().identity
 
     # Get the data from the request
     data = request.get_json()
-    category = data.get("Category")
-    sub_category = data.get("Subcategory")
-    description = data.get("Description")
+    if "documents" in data or data.get("async"):
+        status, body, headers = store_memories(user_identity, data)
+        return jsonify(body), status, headers
 
-    if not category or not sub_category or not description:
+    document = memory_document(data)
+    if document is None:
         logging.warning("Missing category, subcategory, or description in memory request")
         return jsonify({"msg": "Category, Subcategory, and Description are required"}), 400
 
     # Generate embedding for the description
-    embedding = get_embedding(description)
+    embedding = get_embedding(document["Description"])
     if not embedding or len(embedding) != 768:
         logging.error("Failed to generate valid embedding for the description")
         return jsonify({"msg": "Error generating embedding for the description"}), 500
 
     # Index document in Elasticsearch
-    document = {
-        "Description": description,
-        "Category": category,
-        "Sub-Category": sub_category,
-        "embedding": embedding
-    }
-
     try:
-        es.index(index="documents", document=document)
+        es.index(index=Config.ES_INDEX, document=index_source(document, embedding))
         logging.info("Document indexed successfully")
-        return jsonify({"msg": "Document stored successfully"}), 201
     except Exception as e:
         logging.error(f"Error indexing document: {str(e)}")
         return jsonify({"msg": f"Error storing document: {str(e)}"}), 500
+
+    # Keep the in-process indexes in step with Elasticsearch
+    track_memory(document, embedding)
+
+    return jsonify({"msg": "Document stored successfully"}), 201
+
+
+@api_bp.route('/memory/jobs/<job_id>', methods=['GET'])
+@auth_required
+def memory_job_status(job_id):
+    """Report the progress of an asynchronous /memory job."""
+    job = ingest_queue.status(job_id)
+    if job is None or job["user"] != current_caller().identity:
+        return jsonify({"msg": "Job not found"}), 404
+    return jsonify({key: value for key, value in job.items() if key != "user"})
@@ -0,0 +1,537 @@
+import asyncio
+import inspect
+import json
+import logging
+import time
+import aiohttp
+import jwt
+import openai
+from asgiref.wsgi import WsgiToAsgi
+from elasticsearch import AsyncElasticsearch
+from redis import asyncio as aioredis
+from .config import Config
+from .auth import Caller, api_keys
+from .api import classification_fields, neighbor_fields, provisional_fields, shareable_result, sse_event, stale_body, wants_stream
+from .centroid_index import centroid_index, get_centroid_index
+from .embedding_cache import embedding_cache
+from .ingest import index_source, store_memories, track_memory
+from .llm_batch import llm_batcher
+from .logger import bind_request
+from .metrics import IN_FLIGHT, REQUEST_LATENCY, begin_timing, count_cache, server_timing, stage
+from .resilience import CircuitOpenError, DeadlineExceeded, breakers, clear_deadline, stage_timeout, start_deadline
+from .ratelimit import acheck_rate_limit, rate_limit_headers
+from .singleflight import AsyncSingleFlight, cache_probe_keys, queue_cache_writes, split_probe
+from .utils import (
+    build_classify_prompt, build_knn_search, classification_request, centroid_label, count_path, degradation_reason,
+    degraded_label, fast_path_label, hits_to_documents, knn_vote, lookup_semantic, read_classification, remember_classification,
+    search_failed_label,
+)
+from .vector_store import get_local_store, local_store
+from . import es, init_db
+
+logger = logging.getLogger()
+
+
+class HTTPError(Exception):
+    def __init__(self, status, msg, headers=None):
+        super().__init__(msg)
+        self.status = status
+        self.msg = msg
+        self.headers = headers or {}
+
+
+class AsyncClients:
+    """Asyncio clients owned by one event loop, opened on ASGI startup."""
+
+    def __init__(self):
+        self.es = None
+        self.redis = None
+        self.http = None
+        self.single_flight = None
+
+    async def start(self):
+        self.es = AsyncElasticsearch(
+            Config.ELASTICSEARCH_URL,
+            connections_per_node=Config.ES_POOL_SIZE,
+            request_timeout=Config.ES_TIMEOUT,
+            max_retries=Config.ES_MAX_RETRIES,
+            retry_on_timeout=True,
+        )
+        self.redis = aioredis.from_url(
+            Config.REDIS_URL,
+            max_connections=Config.REDIS_POOL_SIZE,
+            socket_timeout=Config.REDIS_TIMEOUT,
+        )
+        self.http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=Config.OLLAMA_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=Config.ASYNC_HTTP_POOL_SIZE),
+        )
+        self.single_flight = AsyncSingleFlight(self.redis, shareable_result)
+
+    async def close(self):
+        if self.http:
+            await self.http.close()
+        if self.es:
+            await self.es.close()
+        if self.redis:
+            await self.redis.aclose()
+
+
+def identity_from_headers(headers):
+    """Validate a Flask-JWT-Extended access token and return its identity."""
+    auth = headers.get("authorization")
+    if not auth:
+        raise HTTPError(401, "Missing Authorization Header")
+    parts = auth.split()
+    if len(parts) != 2 or parts[0] != "Bearer":
+        raise HTTPError(401, "Bad Authorization header. Expected 'Authorization: Bearer <JWT>'")
+    try:
+        claims = jwt.decode(parts[1], Config.SECRET_KEY, algorithms=["HS256"])
+    except jwt.ExpiredSignatureError:
+        raise HTTPError(401, "Token has expired")
+    except jwt.InvalidTokenError as e:
+        raise HTTPError(422, str(e))
+    if claims.get("type") != "access":
+        raise HTTPError(422, "Only non-refresh tokens are allowed")
+    return claims["sub"]
+
+
+async def aget_embedding(text, clients):
+    with stage("embed"):
+        return await _aget_embedding(text, clients)
+
+
+async def _aget_embedding(text, clients):
+    if Config.EMBEDDING_CACHE_ENABLED:
+        cached = (await embedding_cache.aget_many([text], clients.redis))[0]
+        if cached:
+            logger.debug("Embedding cache hit")
+            return cached
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    payload = {"model": Config.OLLAMA_MODEL, "prompt": text}
+    try:
+        timeout = aiohttp.ClientTimeout(total=stage_timeout(Config.OLLAMA_TIMEOUT))
+        breakers["ollama"].before_call()
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        logger.warning(f"Skipping embedding request: {e}")
+        return None
+    try:
+        async with clients.http.post(Config.OLLAMA_API_URL, headers=headers, json=payload, timeout=timeout) as response:
+            response.raise_for_status()
+            embedding = (await response.json()).get("embedding", None)
+        logger.info(f"Successfully fetched embedding for text: {text}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        breakers["ollama"].failure()
+        logger.error(f"Request failed: {e}")
+        return None
+    breakers["ollama"].success()
+    if embedding and Config.EMBEDDING_CACHE_ENABLED:
+        await embedding_cache.aset_many([text], [embedding], clients.redis)
+    return embedding
+
+
+async def arequest_classification(query, documents):
+    """Async counterpart of ``utils.request_classification``."""
+    timeout = stage_timeout(Config.OPENAI_TIMEOUT, minimum=Config.LLM_MIN_BUDGET_MS / 1000)
+    if Config.LLM_BATCH_ENABLED:
+        # Shares micro-batches with the other requests of this process
+        with stage("llm"):
+            return await asyncio.wait_for(asyncio.wrap_future(llm_batcher.submit(query, documents)), timeout)
+    prompt = build_classify_prompt(query, documents)
+    if not prompt.labels:
+        logger.warning("No candidate labels to classify against")
+        return "Unknown", "Unknown"
+    breakers["openai"].before_call()
+    try:
+        with stage("llm"):
+            response = await openai.ChatCompletion.acreate(**classification_request(prompt), request_timeout=timeout)
+    except Exception:
+        breakers["openai"].failure()
+        raise
+    breakers["openai"].success()
+    return read_classification(response, query, prompt)
+
+
+async def aclassify(query, documents):
+    """Return ``(result, info)`` from the LLM, or from the kNN vote when it is too slow or failing."""
+    try:
+        category, subcategory = await arequest_classification(query, documents)
+    except Exception as e:
+        reason = degradation_reason(e)
+        logger.error(f"Error in OpenAI classification ({reason}): {e}")
+        return degraded_label(documents, reason)
+    return {"category": category, "subcategory": subcategory}, {"path": "llm"}
+
+
+async def aclassify_text(query, clients):
+    """Async counterpart of ``utils.classify_text`` with the same return value."""
+    async for event, data in aclassify_stages(query, clients):
+        if event == "result":
+            return data
+
+
+async def aclassify_stages(query, clients):
+    """Async counterpart of ``utils.classify_stages``, yielding the same events."""
+    start_time = time.time()
+    logger.debug(f"Classifying text: {query}")
+    embedding = await aget_embedding(query, clients)
+    if not embedding:
+        logger.warning("Failed to generate query embedding")
+        raise ValueError("Failed to generate query embedding")
+
+    result, similarity = lookup_semantic(embedding)
+    if result:
+        count_path("semantic")
+        yield "result", (result, round(time.time() - start_time, 2), {"path": "semantic", "similarity": round(similarity, 4)})
+        return
+
+    # The centroid index is loaded on startup, so this never blocks on Elasticsearch
+    centroid = centroid_label(embedding, es) if centroid_index.loaded else None
+    if centroid:
+        count_path("centroid")
+        yield "result", (centroid[0], round(time.time() - start_time, 2), centroid[1])
+        return
+
+    try:
+        with stage("search"):
+            if Config.RETRIEVAL_BACKEND == "local":
+                response = local_store.search(embedding, Config.KNN_K)
+            else:
+                timeout = stage_timeout(Config.ES_TIMEOUT)
+                breakers["elasticsearch"].before_call()
+                try:
+                    response = await clients.es.options(request_timeout=timeout, retry_on_timeout=False).search(
+                        index=Config.ES_INDEX, **build_knn_search(embedding))
+                except Exception:
+                    breakers["elasticsearch"].failure()
+                    raise
+                breakers["elasticsearch"].success()
+        documents = hits_to_documents(response)
+        logger.debug(f"Found {len(documents)} documents for query")
+    except Exception as e:
+        logger.error(f"Error while searching Elasticsearch: {e}")
+        yield "neighbors", []
+        result, info = search_failed_label(e)
+        count_path(info["path"])
+        yield "result", (result, round(time.time() - start_time, 2), info)
+        return
+    yield "neighbors", documents
+
+    fast_path = fast_path_label(documents)
+    if fast_path:
+        result, info = fast_path
+        remember_classification(embedding, result)
+        count_path("knn")
+        yield "result", (result, round(time.time() - start_time, 2), info)
+        return
+
+    vote = knn_vote(documents)
+    if vote:
+        yield "provisional", vote
+
+    result, info = await aclassify(query, documents)
+    if info["path"] == "llm":
+        remember_classification(embedding, result)
+    count_path(info["path"])
+    elapsed_time = round(time.time() - start_time, 2)
+    logger.info(f"Classification completed in {elapsed_time} seconds")
+    yield "result", (result, elapsed_time, info)
+
+
+async def replay(events):
+    for event in events:
+        yield event
+
+
+class AsyncAPI:
+    """ASGI application serving the classify and memory routes natively.
+
+    Every other route (register, login, batch, stats) is handed to the Flask
+    app through a WSGI adapter, so the public API is unchanged.
+    """
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.fallback = WsgiToAsgi(flask_app)
+        self.clients = AsyncClients()
+        self.refreshes = set()
+        self.routes = {
+            "/api/classify": self.classify,
+            "/api/memory": self.memory,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        handler = self.routes.get(scope["path"]) if scope["type"] == "http" else None
+        if handler is None or scope["method"] != "POST":
+            return await self.fallback(scope, receive, send)
+
+        start = time.perf_counter()
+        begin_timing()
+        endpoint = scope["path"]
+        IN_FLIGHT.labels(endpoint).inc()
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        client = scope.get("client")
+        request_id = bind_request(headers.get("x-request-id"), headers.get("x-forwarded-for", client[0] if client else None))
+        try:
+            with stage("auth"):
+                caller = await self.authenticate(headers)
+            data = await self.read_json(receive)
+            status, body, extra_headers = await handler(caller, data, headers)
+            extra_headers = {**(extra_headers or {}), "X-Request-Id": request_id}
+            if inspect.isasyncgen(body):
+                await self.send_events(send, status, body, extra_headers)
+                REQUEST_LATENCY.labels(endpoint, "POST", status).observe(time.perf_counter() - start)
+                return
+        except HTTPError as e:
+            status, body, extra_headers = e.status, {"msg": e.msg}, {**(e.headers or {}), "X-Request-Id": request_id}
+        finally:
+            IN_FLIGHT.labels(endpoint).dec()
+        total = time.perf_counter() - start
+        REQUEST_LATENCY.labels(endpoint, "POST", status).observe(total)
+        await self.send_json(send, status, body, {**(extra_headers or {}), "Server-Timing": server_timing(total)})
+
+    async def authenticate(self, headers):
+        """An API key (checked against the database only on a cache miss) or a JWT access token."""
+        key = headers.get(Config.API_KEY_HEADER.lower())
+        if not key:
+            identity = identity_from_headers(headers)
+            return Caller(identity, identity)
+        found, caller = api_keys.cached(key)
+        if not found:
+            caller = await asyncio.to_thread(self.load_api_key, key)
+        if caller is None:
+            raise HTTPError(401, "Invalid API key")
+        return caller
+
+    def load_api_key(self, key):
+        with self.flask_app.app_context():
+            return api_keys.load(key)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.clients.start()
+                await asyncio.to_thread(init_db, self.flask_app)
+                # Warm in-process indexes off the event loop
+                if Config.RETRIEVAL_BACKEND == "local":
+                    await asyncio.to_thread(get_local_store, es)
+                if Config.CENTROID_MODE in ("first_stage", "only"):
+                    await asyncio.to_thread(get_centroid_index, es)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.clients.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def read_json(receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise HTTPError(400, "Request body must be valid JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Request body must be a JSON object")
+        return data
+
+    @staticmethod
+    async def send_json(send, status, body, extra_headers=None):
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        headers = [
+            (b"content-type", b"application/json; charset=utf-8"),
+            (b"content-length", str(len(payload)).encode()),
+        ]
+        headers += [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in (extra_headers or {}).items()]
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers,
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    @staticmethod
+    async def send_events(send, status, events, extra_headers=None):
+        headers = [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ]
+        headers += [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in (extra_headers or {}).items()]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        async for event, data in events:
+            await send({"type": "http.response.body", "body": sse_event(event, data).encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def classify_and_cache(self, query):
+        openai.aiosession.set(self.clients.http)
+        ai_response, _, info = await aclassify_text(query, self.clients)
+        await self.cache_result(query, ai_response, info)
+        return ai_response, info
+
+    async def cache_result(self, query, ai_response, info):
+        if Config.USE_REDIS and "degraded" not in info:
+            with stage("redis"):
+                await queue_cache_writes(self.clients.redis.pipeline(transaction=False), query, ai_response).execute()
+
+    async def classification_events(self, query, start_time, stale_result=None):
+        """Async counterpart of ``api.classification_events``."""
+        openai.aiosession.set(self.clients.http)
+        yield "cache", {"cached": "false"}
+        try:
+            async for event, data in aclassify_stages(query, self.clients):
+                if event == "neighbors":
+                    yield "neighbors", {"neighbors": neighbor_fields(data)}
+                elif event == "provisional":
+                    yield "provisional", provisional_fields(data)
+                else:
+                    ai_response, _, info = data
+        except Exception as e:
+            logging.error(f"Error during streamed classification: {str(e)}")
+            if stale_result:
+                yield "result", stale_body(stale_result, start_time)
+            else:
+                yield "error", {"msg": f"Error getting AI response: {str(e)}"}
+            return
+        if stale_result and "degraded" in info:
+            logging.info(f"Serving stale result for query: '{query}' instead of a degraded answer")
+            yield "result", stale_body(stale_result, start_time)
+            return
+
+        await self.cache_result(query, ai_response, info)
+        response = {"response": ai_response, **classification_fields(info), "time": round(time.time() - start_time, 2)}
+        count_cache(response["cached"])
+        logging.info(f"Returning streamed response for query: '{query}'")
+        yield "result", response
+
+    async def classify_coalesced(self, query):
+        if not Config.SINGLE_FLIGHT_ENABLED:
+            return await self.classify_and_cache(query), False
+        return await self.clients.single_flight.ado(query, lambda: self.classify_and_cache(query))
+
+    def refresh_stale(self, query):
+        async def run():
+            # The task copies the request's context; a background refresh has no deadline
+            clear_deadline()
+            try:
+                await self.classify_coalesced(query)
+            except Exception as e:
+                logging.error(f"Error refreshing stale result for query '{query}': {str(e)}")
+        task = asyncio.create_task(run())
+        self.refreshes.add(task)
+        task.add_done_callback(self.refreshes.discard)
+
+    async def classify(self, caller, data, request_headers):
+        """Classify a user query with caching and rate limiting, optionally as a stream of SSE events."""
+        logging.info("Classify endpoint accessed")
+        redis = self.clients.redis
+        start_time = time.time()
+        # Each request runs in its own task, so the deadline stays with it
+        start_deadline(request_headers.get(Config.REQUEST_BUDGET_HEADER.lower()))
+
+        query = data.get("query")
+        if not query:
+            logging.warning("Classify request missing 'query' parameter")
+            return 400, {"msg": "Query is required"}, {}
+        stream = wants_stream(data, request_headers.get("accept"))
+
+        headers = {}
+        stale_result = None
+        if Config.USE_REDIS:
+            limit = await acheck_rate_limit(redis, caller.rate_key, cache_keys=cache_probe_keys([query]))
+            headers = rate_limit_headers(limit)
+            if not limit.allowed:
+                logging.warning(f"Rate limit exceeded for '{caller.rate_key}'")
+                return 429, {"msg": "Rate limit exceeded, try again later."}, headers
+
+            cached_values, fresh = split_probe(limit.cached, 1)
+            cached_result = cached_values[0]
+            if cached_result and not fresh[0] and Config.CACHE_STALE_MODE == "fallback":
+                stale_result = cached_result
+            elif cached_result:
+                logging.info(f"Cache hit for query: '{query}'")
+                if not fresh[0]:
+                    self.refresh_stale(query)
+                count_cache("true" if fresh[0] else "stale")
+                body = {
+                    "response": json.loads(cached_result),
+                    "cached": "true" if fresh[0] else "stale",
+                    "time": round(time.time() - start_time, 2)
+                }
+                if stream:
+                    return 200, replay([("cache", {"cached": body["cached"]}), ("result", body)]), headers
+                return 200, body, headers
+
+        # Streams skip request coalescing so each client sees its own stages
+        if stream:
+            logging.info(f"Cache miss for query: '{query}', streaming classification")
+            return 200, self.classification_events(query, start_time, stale_result), headers
+
+        try:
+            logging.info(f"Cache miss for query: '{query}', querying Elasticsearch")
+            (ai_response, info), shared = await self.classify_coalesced(query)
+        except Exception as e:
+            logging.error(f"Error during Elasticsearch query: {str(e)}")
+            if stale_result:
+                return 200, stale_body(stale_result, start_time), headers
+            return 500, {"msg": f"Error getting AI response: {str(e)}"}, headers
+        if stale_result and "degraded" in info:
+            logging.info(f"Serving stale result for query: '{query}' instead of a degraded answer")
+            return 200, stale_body(stale_result, start_time), headers
+
+        elapsed_time = round(time.time() - start_time, 2)
+        response = {"response": ai_response, **classification_fields(info), "time": elapsed_time}
+        if shared:
+            response["cached"] = "coalesced"
+        count_cache(response["cached"])
+
+        logging.info(f"Returning response for query: '{query}'")
+        return 200, response, headers
+
+    async def memory(self, caller, data, request_headers):
+        """Store a new document with category, subcategory, description."""
+        logging.info("Memory endpoint accessed")
+        if "documents" in data or data.get("async"):
+            # Batched embedding and bulk indexing run on the sync clients off the event loop
+            return await asyncio.to_thread(store_memories, caller.identity, data)
+
+        category = data.get("Category")
+        sub_category = data.get("Subcategory")
+        description = data.get("Description")
+
+        if not category or not sub_category or not description:
+            logging.warning("Missing category, subcategory, or description in memory request")
+            return 400, {"msg": "Category, Subcategory, and Description are required"}, {}
+
+        embedding = await aget_embedding(description, self.clients)
+        if not embedding or len(embedding) != 768:
+            logging.error("Failed to generate valid embedding for the description")
+            return 500, {"msg": "Error generating embedding for the description"}, {}
+
+        document = {
+            "Description": description,
+            "Category": category,
+            "Sub-Category": sub_category,
+        }
+
+        try:
+            await self.clients.es.index(index=Config.ES_INDEX, document=index_source(document, embedding))
+            logging.info("Document indexed successfully")
+        except Exception as e:
+            logging.error(f"Error indexing document: {str(e)}")
+            return 500, {"msg": f"Error storing document: {str(e)}"}, {}
+
+        track_memory(document, embedding)
+
+        return 201, {"msg": "Document stored successfully"}, {}
+
+
+def create_asgi_app(flask_app):
+    return AsyncAPI(flask_app)
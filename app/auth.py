@@ -0,0 +1,175 @@
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import g, jsonify, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from redis import Redis
+from .config import Config
+from .metrics import stage
+from .models import ApiKey, User
+
+logger = logging.getLogger()
+
+# ``identity`` owns data (memory jobs); ``rate_key`` is what the rate limiter counts
+Caller = namedtuple("Caller", "identity rate_key")
+
+
+def hash_key(key):
+    # Keys are 256-bit random tokens, so a fast hash is enough; no password KDF
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ApiKeyCache:
+    """Verified API keys held in process, so a hot request touches neither SQLite nor a KDF.
+
+    Entries are keyed by the SHA-256 of the presented key and trusted for
+    ``API_KEY_CACHE_TTL`` seconds; unknown or revoked keys are remembered for
+    ``API_KEY_NEGATIVE_TTL``. ``mgt.py`` publishes the prefix of a key it
+    revokes or moves to a renamed user on Redis, and a listener thread in
+    every process evicts it at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # digest -> (Caller or None, prefix, expires)
+        # Bumped by revoke(prefix) and clear(), so a load() that raced one does not cache a stale verdict
+        self._generations = {}  # prefix -> revocations seen
+        self._generation = 0
+        self._listener = None
+        self._pid = os.getpid()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, key):
+        """Return the ``Caller`` for a valid key or ``None``. Needs an app context on a miss."""
+        found, caller = self.cached(key)
+        return caller if found else self.load(key)
+
+    def cached(self, key):
+        """``(True, caller)`` when the key's verdict is cached, else ``(False, None)``."""
+        self._ensure_listener()
+        digest = hash_key(key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry and entry[2] > time.monotonic():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return True, entry[0]
+            self.misses += 1
+        return False, None
+
+    def load(self, key):
+        """Check a key against the database and cache the verdict."""
+        digest = hash_key(key)
+        prefix = key.partition(".")[0]
+        for _ in range(2):
+            now = time.monotonic()
+            generation = self._generation_of(prefix)
+            caller, ttl = self._query(prefix, digest)
+            with self._lock:
+                # A revocation published while we queried may have committed after our read
+                if self._generation_of(prefix) != generation:
+                    continue
+                self._entries[digest] = (caller, prefix, now + ttl)
+                self._entries.move_to_end(digest)
+                while len(self._entries) > Config.API_KEY_CACHE_SIZE:
+                    self._entries.popitem(last=False)
+            return caller
+        # Still racing revocations: the second read already saw the first one, so use it uncached
+        return caller
+
+    def _query(self, prefix, digest):
+        # The retry in load() must not get the identity-mapped row of the first read back
+        record = ApiKey.query.filter_by(prefix=prefix).populate_existing().first()
+        if record is None or record.revoked_at is not None or not hmac.compare_digest(record.key_hash, digest):
+            return None, Config.API_KEY_NEGATIVE_TTL
+        # mgt.py revokes a deleted user's keys; this also covers users deleted before it did
+        if User.query.filter_by(username=record.username).first() is None:
+            logger.warning(f"API key '{prefix}' belongs to missing user '{record.username}'")
+            return None, Config.API_KEY_NEGATIVE_TTL
+        # All of a user's keys (and their JWTs) share one bucket and its RATE_LIMIT_OVERRIDES entry
+        return Caller(record.username, record.username), Config.API_KEY_CACHE_TTL
+
+    def _generation_of(self, prefix):
+        return self._generation, self._generations.get(prefix, 0)
+
+    def revoke(self, prefix):
+        """Forget every cached entry of a key in this process."""
+        with self._lock:
+            self._generations[prefix] = self._generations.get(prefix, 0) + 1
+            for digest in [digest for digest, entry in self._entries.items() if entry[1] == prefix]:
+                del self._entries[digest]
+        logger.info(f"Evicted API key '{prefix}' from the key cache")
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _ensure_listener(self):
+        # A forked child inherits the entries but not the listener thread
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._listener = None
+            self._pid = os.getpid()
+        if not Config.USE_REDIS or (self._listener is not None and self._listener.is_alive()):
+            return
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="api-key-revocations", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        # A dedicated connection without the pool's socket timeout, since it idles between messages
+        client = Redis.from_url(Config.REDIS_URL, health_check_interval=30)
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(Config.API_KEY_REVOCATION_CHANNEL)
+                # Revocations sent while we were not listening are unknown
+                self.clear()
+                while True:
+                    message = pubsub.get_message(timeout=5.0)
+                    if message:
+                        self.revoke(message["data"].decode("utf-8"))
+            except Exception as e:
+                logger.error(f"API key revocation listener failed, retrying: {e}")
+                time.sleep(5)
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+        return {"entries": entries, "hits": self.hits, "misses": self.misses}
+
+
+api_keys = ApiKeyCache()
+
+
+def auth_required(fn):
+    """Accept an API key (``API_KEY_HEADER``) or a JWT access token; sets ``g.caller``."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(Config.API_KEY_HEADER)
+        if key:
+            with stage("auth"):
+                caller = api_keys.verify(key)
+            if caller is None:
+                logging.warning("Request with an invalid or revoked API key")
+                return jsonify({"msg": "Invalid API key"}), 401
+            g.caller = caller
+        else:
+            with stage("auth"):
+                verify_jwt_in_request()
+            identity = get_jwt_identity()
+            g.caller = Caller(identity, identity)
+        return fn(*args, **kwargs)
+    return wrapper
+
+
+def current_caller():
+    return g.caller
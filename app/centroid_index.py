@@ -0,0 +1,320 @@
+import io
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import numpy as np
+from .config import Config
+from . import redis_client
+
+logger = logging.getLogger()
+
+
+class CentroidIndex:
+    """One mean embedding (plus a few medoids) per (Category, Sub-Category).
+
+    Scoring a query is one matrix-vector product against a few hundred rows.
+    Centroids are kept as running sums of normalized embeddings so that new
+    documents can be folded in without a rebuild; medoids are chosen at build
+    time as diverse members of each label (farthest-point selection).
+
+    With several workers, ``add`` only queues the document. A sync thread in
+    each process appends queued vectors to a Redis stream every
+    ``CENTROID_SYNC_INTERVAL`` seconds and folds in every stream entry, its
+    own included, so all processes converge on the same sums. The snapshot
+    records the last entry it contains and is written by one process at a
+    time.
+    """
+
+    def __init__(self, path, redis_key, medoids=3):
+        self.path = path
+        self.redis_key = redis_key
+        self.medoids = medoids
+        self._lock = threading.Lock()
+        self._labels = []
+        self._positions = {}
+        self._sums = None
+        self._counts = None
+        self._medoid_vectors = None
+        self._medoid_labels = None
+        self._matrix = None
+        self._row_labels = None
+        self._pending = []  # (label, vector) not yet published
+        self._stream_id = "0-0"  # Last stream entry folded into the sums
+        self._unsaved = 0
+        self._saved_stream_id = None  # Stream position of this process's last snapshot
+        self._sync_thread = None
+        self._pid = os.getpid()
+
+    @property
+    def stream_key(self):
+        return f"{self.redis_key}:updates"
+
+    @property
+    def loaded(self):
+        return self._sums is not None
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def labels(self):
+        """Closed set of valid (Category, Sub-Category) pairs."""
+        with self._lock:
+            return set(self._labels)
+
+    def _select_medoids(self, members):
+        centroid = self._normalize(members.mean(axis=0))
+        chosen = [int(np.argmax(members @ centroid))]
+        while len(chosen) < min(self.medoids, len(members)):
+            # Next medoid is the member least similar to those already chosen
+            similarity = (members @ members[chosen].T).max(axis=1)
+            similarity[chosen] = np.inf
+            chosen.append(int(np.argmin(similarity)))
+        return members[chosen]
+
+    def build(self, documents, embeddings):
+        vectors = self._normalize(embeddings)
+        groups = {}
+        for i, doc in enumerate(documents):
+            groups.setdefault((doc["Category"], doc["Sub-Category"]), []).append(i)
+
+        labels = sorted(groups)
+        dims = vectors.shape[1] if len(documents) else 0
+        sums = np.zeros((len(labels), dims), dtype=np.float32)
+        counts = np.zeros(len(labels), dtype=np.int64)
+        medoid_vectors, medoid_labels = [], []
+        for position, label in enumerate(labels):
+            members = vectors[groups[label]]
+            sums[position] = members.sum(axis=0)
+            counts[position] = len(members)
+            if self.medoids:
+                selected = self._select_medoids(members)
+                medoid_vectors.extend(selected)
+                medoid_labels.extend([position] * len(selected))
+
+        with self._lock:
+            self._labels = labels
+            self._positions = {label: i for i, label in enumerate(labels)}
+            self._sums = sums
+            self._counts = counts
+            self._medoid_vectors = np.array(medoid_vectors, dtype=np.float32).reshape(len(medoid_vectors), dims)
+            self._medoid_labels = np.array(medoid_labels, dtype=np.int64)
+            self._matrix = None
+        logger.info(f"Built centroid index with {len(labels)} labels from {len(documents)} documents")
+
+    def add(self, category, subcategory, embedding):
+        """Queue a new document for its label's centroid; the sync thread folds it in."""
+        self._ensure_sync()
+        with self._lock:
+            self._pending.append(((category, subcategory), self._normalize(embedding)))
+
+    def _apply(self, label, vector):
+        # Callers hold self._lock
+        if label not in self._positions:
+            self._positions[label] = len(self._labels)
+            self._labels.append(label)
+            self._sums = np.vstack([self._sums.reshape(-1, vector.shape[0]), vector[None, :] * 0])
+            self._counts = np.append(self._counts, 0)
+        position = self._positions[label]
+        self._sums[position] += vector
+        self._counts[position] += 1
+        self._matrix = None
+        self._unsaved += 1
+
+    def _ensure_sync(self):
+        # A forked worker inherits the sums but not the sync thread
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pending = []
+            self._sync_thread = None
+            self._pid = os.getpid()
+        if self._sync_thread is None or not self._sync_thread.is_alive():
+            self._sync_thread = threading.Thread(target=self._run_sync, name="centroid-sync", daemon=True)
+            self._sync_thread.start()
+
+    def _run_sync(self):
+        while True:
+            time.sleep(Config.CENTROID_SYNC_INTERVAL)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error(f"Error syncing centroid index: {e}")
+
+    def sync(self):
+        """Publish queued documents, fold in every worker's updates and save when enough have accumulated."""
+        if not self.loaded:
+            return
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not Config.USE_REDIS:
+            # A single process owns the index
+            with self._lock:
+                for label, vector in pending:
+                    self._apply(label, vector)
+        else:
+            if pending:
+                pipeline = redis_client.pipeline(transaction=False)
+                for label, vector in pending:
+                    pipeline.xadd(self.stream_key, {"label": json.dumps(label, ensure_ascii=False),
+                                                    "vector": vector.tobytes()})
+                pipeline.execute()
+            while True:
+                entries = redis_client.xread({self.stream_key: self._stream_id}, count=1000)
+                if not entries:
+                    break
+                with self._lock:
+                    for entry_id, fields in entries[0][1]:
+                        self._apply(tuple(json.loads(fields[b"label"])), np.frombuffer(fields[b"vector"], dtype=np.float32))
+                        self._stream_id = entry_id.decode()
+        if self._unsaved >= Config.CENTROID_SAVE_EVERY:
+            # One writer per snapshot; the others pick up its result from the stream anyway
+            if not Config.USE_REDIS or redis_client.set(f"{self.redis_key}:saving", os.getpid(), nx=True, ex=60):
+                self.save()
+
+    def _score_matrix(self):
+        # Rebuilt lazily after updates: normalized centroids followed by medoids
+        if self._matrix is None:
+            centroids = self._normalize(self._sums / np.maximum(self._counts, 1)[:, None])
+            self._matrix = np.vstack([centroids, self._medoid_vectors]) if len(self._medoid_vectors) else centroids
+            self._row_labels = np.concatenate([np.arange(len(self._labels)), self._medoid_labels])
+        return self._matrix, self._row_labels, list(self._labels)
+
+    def score(self, embedding, top=2):
+        """Return the ``top`` labels as ``[((category, subcategory), similarity), ...]``."""
+        self._ensure_sync()
+        query = self._normalize(embedding)
+        with self._lock:
+            if not self.loaded or not self._labels:
+                return []
+            matrix, row_labels, labels = self._score_matrix()
+        similarities = matrix @ query
+        best = np.full(len(labels), -1.0, dtype=np.float32)
+        np.maximum.at(best, row_labels, similarities)
+        order = np.argsort(-best)[:top]
+        return [(labels[i], float(best[i])) for i in order]
+
+    def _serialize(self):
+        with self._lock:
+            buffer = io.BytesIO()
+            np.savez(
+                buffer,
+                labels=np.array(json.dumps(self._labels, ensure_ascii=False)),
+                sums=self._sums,
+                counts=self._counts,
+                medoid_vectors=self._medoid_vectors,
+                medoid_labels=self._medoid_labels,
+                stream_id=np.array(self._stream_id),
+            )
+            self._unsaved = 0
+            previous_id = self._saved_stream_id
+            self._saved_stream_id = self._stream_id
+        return buffer.getvalue(), previous_id
+
+    def _deserialize(self, data):
+        archive = np.load(io.BytesIO(data), allow_pickle=False)
+        labels = [tuple(label) for label in json.loads(str(archive["labels"]))]
+        with self._lock:
+            self._labels = labels
+            self._positions = {label: i for i, label in enumerate(labels)}
+            self._sums = archive["sums"]
+            self._counts = archive["counts"]
+            self._medoid_vectors = archive["medoid_vectors"]
+            self._medoid_labels = archive["medoid_labels"]
+            self._stream_id = str(archive["stream_id"]) if "stream_id" in archive.files else "0-0"
+            self._matrix = None
+        self._ensure_sync()
+
+    def save(self):
+        """Persist to disk and Redis."""
+        data, previous_id = self._serialize()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Workers share the path, so each writes its own temporary file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        if Config.USE_REDIS:
+            try:
+                redis_client.set(self.redis_key, data)
+                if previous_id:
+                    # Entries before the previous snapshot are in every copy still read
+                    redis_client.xtrim(self.stream_key, minid=previous_id)
+            except Exception as e:
+                logger.error(f"Error saving centroid index to Redis: {e}")
+        logger.info(f"Saved centroid index with {len(self._labels)} labels")
+
+    def load(self):
+        """Load from Redis, falling back to disk, then catch up on the update stream.
+
+        Returns ``False`` if neither has a copy.
+        """
+        if Config.USE_REDIS:
+            try:
+                data = redis_client.get(self.redis_key)
+            except Exception as e:
+                logger.error(f"Error loading centroid index from Redis: {e}")
+                data = None
+            if data:
+                self._deserialize(data)
+                logger.info(f"Loaded centroid index with {len(self._labels)} labels from Redis")
+                return True
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                self._deserialize(f.read())
+            logger.info(f"Loaded centroid index with {len(self._labels)} labels from {self.path}")
+            return True
+        return False
+
+    def build_from_es(self, es, index=None):
+        from elasticsearch import helpers
+
+        # Updates published before the scan are already in Elasticsearch
+        latest = redis_client.xrevrange(self.stream_key, count=1) if Config.USE_REDIS else []
+        documents, embeddings = [], []
+        for hit in helpers.scan(es, index=index or Config.ES_INDEX, query={"query": {"match_all": {}}},
+                                _source=["Category", "Sub-Category", "embedding"]):
+            source = hit["_source"]
+            if not source.get("embedding"):
+                continue
+            embeddings.append(source.pop("embedding"))
+            documents.append(source)
+        self.build(documents, embeddings)
+        if latest:
+            with self._lock:
+                self._stream_id = latest[0][0].decode()
+        self.save()
+        return len(documents)
+
+
+centroid_index = CentroidIndex(
+    Config.CENTROID_INDEX_PATH,
+    f"centroids:{Config.OLLAMA_MODEL}",
+    Config.CENTROID_MEDOIDS,
+)
+_load_lock = threading.Lock()
+
+
+def get_centroid_index(es):
+    """Return the process-wide centroid index, loading or building it on first use."""
+    if not centroid_index.loaded:
+        with _load_lock:
+            if not centroid_index.loaded and not centroid_index.load():
+                logger.warning("No persisted centroid index found, building it from Elasticsearch")
+                centroid_index.build_from_es(es)
+    return centroid_index
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1].lower() != "build":
+        print("Usage: python -m app.centroid_index build")
+        sys.exit(1)
+
+    from . import es
+    count = centroid_index.build_from_es(es)
+    print(f"Centroid index rebuilt from {count} documents at {centroid_index.path}")
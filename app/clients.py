@@ -0,0 +1,175 @@
+import logging
+import os
+import threading
+import openai
+import requests
+from elasticsearch import Elasticsearch
+from redis import ConnectionPool, Redis
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .config import Config
+
+logger = logging.getLogger()
+
+
+def pooled_session(pool_size, retries):
+    """A requests session whose keep-alive pool holds up to ``pool_size`` sockets per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=retries, backoff_factor=0.2, status_forcelist=(502, 503, 504),
+                          allowed_methods=None),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class ClientRegistry:
+    """Owns one pooled, keep-alive client per dependency for the current process.
+
+    Clients are created on first use and re-created when the process id
+    changes, so gunicorn workers forked from a preloaded master never share
+    the master's sockets.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+
+    def _factories(self):
+        return {
+            "es": self._create_es,
+            "redis": self._create_redis,
+            "ollama": self._create_ollama,
+            "openai": self._create_openai,
+        }
+
+    @staticmethod
+    def _create_es():
+        return Elasticsearch(
+            Config.ELASTICSEARCH_URL,
+            connections_per_node=Config.ES_POOL_SIZE,
+            request_timeout=Config.ES_TIMEOUT,
+            max_retries=Config.ES_MAX_RETRIES,
+            retry_on_timeout=True,
+        )
+
+    @staticmethod
+    def _create_redis():
+        pool = ConnectionPool.from_url(
+            Config.REDIS_URL,
+            max_connections=Config.REDIS_POOL_SIZE,
+            socket_timeout=Config.REDIS_TIMEOUT,
+            socket_connect_timeout=Config.REDIS_TIMEOUT,
+            health_check_interval=30,
+        )
+        return Redis(connection_pool=pool)
+
+    @staticmethod
+    def _create_ollama():
+        return pooled_session(Config.OLLAMA_POOL_SIZE, Config.OLLAMA_MAX_RETRIES)
+
+    @staticmethod
+    def _create_openai():
+        session = pooled_session(Config.OPENAI_POOL_SIZE, 0)
+        openai.requestssession = session
+        # openai caches a session per thread; drop any copy inherited from the parent
+        openai.api_requestor._thread_context = threading.local()
+        return session
+
+    def get(self, name):
+        if self._pid != os.getpid():
+            self.reset()
+        client = self._clients.get(name)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(name)
+                if client is None:
+                    client = self._factories()[name]()
+                    self._clients[name] = client
+                    logger.debug(f"Created {name} client for process {self._pid}")
+        return client
+
+    def reset(self):
+        """Forget every client; the next use creates fresh ones in this process.
+
+        Runs in a freshly forked child, so it must not wait on the parent's lock.
+        """
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+
+    @property
+    def es(self):
+        return self.get("es")
+
+    @property
+    def redis(self):
+        return self.get("redis")
+
+    @property
+    def ollama(self):
+        return self.get("ollama")
+
+    @property
+    def openai(self):
+        return self.get("openai")
+
+    def stats(self):
+        """Pool sizes and saturation for the clients created in this process."""
+        stats = {"pid": self._pid}
+        clients = dict(self._clients)
+        if "redis" in clients:
+            pool = clients["redis"].connection_pool
+            in_use = len(pool._in_use_connections)
+            stats["redis"] = {
+                "max_connections": pool.max_connections,
+                "created": pool._created_connections,
+                "in_use": in_use,
+                "idle": len(pool._available_connections),
+                "saturation": round(in_use / pool.max_connections, 4),
+            }
+        for name, pool_size in (("ollama", Config.OLLAMA_POOL_SIZE), ("openai", Config.OPENAI_POOL_SIZE)):
+            if name in clients:
+                stats[name] = self._session_stats(clients[name], pool_size)
+        if "es" in clients:
+            nodes = clients["es"].transport.node_pool.all()
+            stats["es"] = {"nodes": len(nodes), "connections_per_node": Config.ES_POOL_SIZE}
+        return stats
+
+    @staticmethod
+    def _session_stats(session, pool_size):
+        hosts = {}
+        for adapter in set(session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                # The queue holds idle sockets plus ``None`` for never-opened slots
+                free_slots = pool.pool.qsize() if pool.pool else 0
+                in_use = pool_size - free_slots
+                hosts[f"{key.key_scheme}://{key.key_host}:{key.key_port}"] = {
+                    "opened": pool.num_connections,
+                    "idle": sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+                    "in_use": in_use,
+                    "saturation": round(in_use / pool_size, 4),
+                }
+        return {"pool_size": pool_size, "hosts": hosts}
+
+
+registry = ClientRegistry()
+os.register_at_fork(after_in_child=registry.reset)
+
+
+class ClientProxy:
+    """Module-level stand-in that always resolves to the current process's client."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(registry.get(self._name), attr)
+
+    def __repr__(self):
+        return f"<ClientProxy {self._name}>"
@@ -1,3 +1,4 @@
+import json
 import os
 
 
@@ -7,6 +8,8 @@ class Config:
     JWT_EXPIRATION = 360000  # 1 hour
     RATE_LIMIT_MAX_REQUESTS = 10000  # Maximum requests per time window
     RATE_LIMIT_WINDOW_SECONDS = 1  # Time window in seconds (5 minutes)
+    # Per-user overrides, e.g. {"etl": {"max_requests": 50000, "window_seconds": 1}}
+    RATE_LIMIT_OVERRIDES = json.loads(os.getenv("RATE_LIMIT_OVERRIDES", "{}"))
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OLLAMA_API_URL = os.getenv(
         "OLLAMA_API_URL", "http://localhost:11434/api/embeddings")
@@ -20,5 +23,123 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     ELASTICSEARCH_URL = os.getenv(
         "ELASTICSEARCH_URL", "http://192.168.7.10:9200")
+    # Index (an alias once tools/document_index-ollama.py --recreate has built a versioned index)
+    # searched by classify and written by /memory
+    ES_INDEX = os.getenv("ES_INDEX", "documents")
+    # tools/document_index-gpt.py: 1536-dim OpenAI vectors, which the API's Ollama queries cannot search
+    ES_GPT_INDEX = os.getenv("ES_GPT_INDEX", "documents_index")
     USE_REDIS = True  # Check if Redis caching is enabled
     REDIS_CACHE_EXPIRATION = 3600  # Cache expiration in seconds
+    # Batch classification
+    OLLAMA_EMBED_URL = os.getenv(
+        "OLLAMA_EMBED_URL", "http://localhost:11434/api/embed")  # Multi-input embeddings endpoint
+    BATCH_MAX_QUERIES = 500  # Maximum queries accepted by /classify/batch
+    BATCH_MAX_WORKERS = 8  # Concurrent LLM classifications per batch
+    # Embedding cache
+    EMBEDDING_CACHE_ENABLED = True
+    EMBEDDING_CACHE_MAX_BYTES = 64 * 1024 * 1024  # In-process LRU budget (768 float32 = 3 KB per vector)
+    EMBEDDING_CACHE_EXPIRATION = 7 * 24 * 3600  # Redis tier expiration in seconds
+    # Semantic result cache
+    SEMANTIC_CACHE_ENABLED = True
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Minimum cosine similarity
+    SEMANTIC_CACHE_MAX_ENTRIES = 10000
+    SEMANTIC_CACHE_EXPIRATION = 3600  # Seconds before a semantic entry is ignored
+    # LLM prompt and output size
+    LLM_PROMPT_TOKEN_BUDGET = 800  # Estimated prompt tokens; examples beyond it are dropped
+    LLM_CONTEXT_MAX_CHARS = 300  # Characters kept per example description
+    LLM_QUERY_MAX_CHARS = 1500  # Characters kept of the query itself
+    LLM_MAX_TOKENS = 16  # Completion limit for the {"label": n} answer
+    LLM_JSON_MODE = True  # Request response_format json_object
+    # Micro-batching of concurrent LLM classifications into one completion
+    LLM_BATCH_ENABLED = os.getenv("LLM_BATCH_ENABLED", "false").lower() == "true"
+    LLM_BATCH_WINDOW_MS = 20  # How long the first queued query waits for company
+    LLM_BATCH_MAX_SIZE = 8  # Queries per completion
+    LLM_BATCH_WORKERS = 4  # Batched completions in flight per process
+    LLM_BATCH_TOKENS_PER_ITEM = 12  # Completion tokens allowed per query in a batch
+    # Nearest-neighbour retrieval (pick with python tools/evaluate.py)
+    KNN_K = int(os.getenv("KNN_K", "5"))  # Neighbours retrieved and shown to the LLM
+    KNN_NUM_CANDIDATES = int(os.getenv("KNN_NUM_CANDIDATES", "10"))  # HNSW candidates per shard
+    # For quantized indexes (int8_hnsw, int4_hnsw, bbq_hnsw): fetch KNN_K * KNN_OVERSAMPLE candidates
+    # on the quantized vectors and rescore them on the float vectors; 1 disables rescoring
+    KNN_OVERSAMPLE = float(os.getenv("KNN_OVERSAMPLE", "1"))
+    # Retrieval backend: "elasticsearch" (kNN query) or "local" (in-process NumPy index)
+    RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "elasticsearch")
+    LOCAL_INDEX_PATH = os.path.join(BASE_DIR, 'database/documents_index')  # Snapshot prefix (.npy + .json)
+    LOCAL_INDEX_MMAP = True  # Memory-map the snapshot instead of reading it into RAM
+    LOCAL_INDEX_RELOAD_INTERVAL = 30  # Seconds between checks for a rebuilt snapshot
+    # kNN vote fast path: skip the LLM when retrieved neighbours agree
+    FAST_PATH_ENABLED = True
+    FAST_PATH_MIN_NEIGHBORS = 3  # Minimum neighbours required to vote
+    FAST_PATH_MIN_AGREEMENT = 0.8  # Winning label's share of the total neighbour score
+    FAST_PATH_MIN_SCORE = 0.9  # Best neighbour _score for the winning label ((1 + cosine) / 2)
+    # Nearest-centroid taxonomy index: "off", "first_stage" (answer only well-separated queries) or "only"
+    CENTROID_MODE = os.getenv("CENTROID_MODE", "off")
+    CENTROID_INDEX_PATH = os.path.join(BASE_DIR, 'database/centroids.npz')
+    CENTROID_MEDOIDS = 3  # Extra representative vectors kept per label
+    CENTROID_MIN_SIMILARITY = 0.85  # Cosine similarity required to answer from the first stage
+    CENTROID_MIN_MARGIN = 0.05  # Required lead of the best label over the runner-up
+    CENTROID_SAVE_EVERY = 50  # Persist after this many incremental updates
+    CENTROID_SYNC_INTERVAL = 5  # Seconds between publishing this worker's updates and applying the others'
+    CENTROID_CONSTRAIN_LABELS = True  # Reject LLM labels outside the known taxonomy
+    # ASGI server (asgi:app)
+    ASYNC_HTTP_POOL_SIZE = 100  # Concurrent connections to Ollama/OpenAI per process
+    # Outbound connection pools (app/clients.py)
+    ES_POOL_SIZE = 10  # Connections per Elasticsearch node
+    ES_TIMEOUT = 10  # Seconds
+    ES_MAX_RETRIES = 3
+    REDIS_POOL_SIZE = 50
+    REDIS_TIMEOUT = 5  # Seconds
+    OLLAMA_POOL_SIZE = 20
+    OLLAMA_TIMEOUT = 30  # Seconds
+    OLLAMA_MAX_RETRIES = 2
+    OPENAI_POOL_SIZE = 20
+    # Stampede protection for identical concurrent cache misses
+    SINGLE_FLIGHT_ENABLED = True
+    SINGLE_FLIGHT_LOCK_MS = 30000  # Cross-worker lock lifetime; bounds how long an owner may take
+    SINGLE_FLIGHT_WAIT_SECONDS = 30  # How long waiters poll for the owner's result
+    SINGLE_FLIGHT_POLL_SECONDS = 0.05
+    SINGLE_FLIGHT_RESULT_SECONDS = 10  # Lifetime of the shared result handed to waiters
+    CACHE_STALE_SECONDS = 0  # Serve expired results this long while one worker refreshes (0 = off)
+    CACHE_REFRESH_WORKERS = 4  # Background threads refreshing stale results
+    # Bulk and write-behind /memory ingestion
+    MEMORY_SYNC_MAX_DOCUMENTS = 500  # Documents accepted by a synchronous bulk /memory request
+    MEMORY_MAX_DOCUMENTS = 50000  # Documents accepted by an asynchronous /memory job
+    MEMORY_EMBED_BATCH_SIZE = 64  # Descriptions per Ollama embedding call
+    MEMORY_BULK_CHUNK_SIZE = 500  # Documents per Elasticsearch bulk request
+    MEMORY_REFRESH_INTERVAL = 5  # Seconds between index refreshes while the job queue is busy
+    MEMORY_JOB_EXPIRATION = 24 * 3600  # Seconds job status is kept
+    MEMORY_JOB_MAX_ERRORS = 100  # Per-document errors kept in a job's status
+    # Per-request latency budget and graceful degradation
+    REQUEST_BUDGET_MS = float(os.getenv("REQUEST_BUDGET_MS", "5000"))  # Default classify budget (0 = none)
+    REQUEST_BUDGET_MAX_MS = 30000  # Upper bound for budgets requested by clients
+    REQUEST_BUDGET_HEADER = "X-Request-Budget-Ms"
+    LLM_MIN_BUDGET_MS = 300  # Below this, answer with the kNN majority label instead of calling the LLM
+    OPENAI_TIMEOUT = 20  # Seconds per completion when no budget applies
+    CACHE_STALE_MODE = "revalidate"  # "revalidate": serve stale at once; "fallback": only when the pipeline degrades
+    CIRCUIT_BREAKER_ENABLED = True
+    CIRCUIT_BREAKER_FAILURES = 5  # Consecutive failures before a dependency is skipped
+    CIRCUIT_BREAKER_RESET_SECONDS = 30  # Time before one trial call is let through
+    # Readiness probes (/api/readyz): dependencies checked and the timeout of each probe
+    READY_CHECKS = os.getenv("READY_CHECKS", "database,redis,elasticsearch,ollama").split(",")
+    READY_TIMEOUT = 1.0
+    # API keys for service clients (created with mgt.py add-key), sent in API_KEY_HEADER
+    API_KEY_HEADER = "X-API-Key"
+    API_KEY_CACHE_SIZE = 10000  # Verified keys held per process
+    API_KEY_CACHE_TTL = 300  # Seconds a verified key is trusted without the database
+    API_KEY_NEGATIVE_TTL = 30  # Seconds an unknown or revoked key is rejected without the database
+    API_KEY_REVOCATION_CHANNEL = "api_key_revocations"  # Redis pub/sub channel of revoked key prefixes
+    # Logging: "queue" writes records from a background thread, "sync" on the request thread
+    LOG_MODE = os.getenv("LOG_MODE", "queue")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json" (adds request id and stage timings)
+    LOG_FILE = os.getenv("LOG_FILE", "logs/app.log")
+    LOG_QUEUE_SIZE = 10000  # Records waiting for the listener; further records are dropped and counted
+    # Rotation of LOG_FILE: "none", "size" (LOG_MAX_BYTES) or "time" (LOG_ROTATE_WHEN). Every
+    # process rotates on its own, so give gunicorn workers separate files ("{pid}" in LOG_FILE).
+    LOG_ROTATE = os.getenv("LOG_ROTATE", "none")
+    LOG_MAX_BYTES = 50 * 1024 * 1024
+    LOG_ROTATE_WHEN = "midnight"
+    LOG_BACKUP_COUNT = 7
+    # INFO lines logged while serving a request: share of requests that keep them, and a
+    # per-process cap per second (0 = no cap). Warnings and errors are always kept.
+    LOG_REQUEST_SAMPLE_RATE = float(os.getenv("LOG_REQUEST_SAMPLE_RATE", "1.0"))
+    LOG_REQUEST_INFO_PER_SECOND = int(os.getenv("LOG_REQUEST_INFO_PER_SECOND", "0"))
@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from .config import Config
+from . import redis_client
+
+logger = logging.getLogger()
+
+
+def normalize_text(text):
+    """Normalize text before hashing so trivial whitespace changes share a key."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(text, model=None):
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"emb:{model or Config.OLLAMA_MODEL}:{digest}"
+
+
+def pack_vector(vector):
+    """Pack a vector as little-endian float32 bytes."""
+    packed = array("f", vector)
+    if packed.itemsize != 4:
+        raise ValueError("float32 array type is not available on this platform")
+    return packed.tobytes()
+
+
+def unpack_vector(data):
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+class EmbeddingCache:
+    """Two-tier embedding cache: in-process LRU over a Redis tier.
+
+    Keys include the embedding model, so changing ``Config.OLLAMA_MODEL``
+    never serves vectors produced by the previous model.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._model = Config.OLLAMA_MODEL
+        self._lock = threading.Lock()
+        self.hits = {"local": 0, "redis": 0}
+        self.misses = 0
+
+    def _check_model(self):
+        # Drop the local tier as soon as the configured model changes
+        if self._model != Config.OLLAMA_MODEL:
+            logger.info(f"Embedding model changed from {self._model} to {Config.OLLAMA_MODEL}, clearing cache")
+            self._entries.clear()
+            self._bytes = 0
+            self._model = Config.OLLAMA_MODEL
+
+    def _store_local(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def _get_local(self, texts):
+        keys = [cache_key(text) for text in texts]
+        found = [None] * len(texts)
+        remote = []
+        with self._lock:
+            self._check_model()
+            for i, key in enumerate(keys):
+                data = self._entries.get(key)
+                if data is not None:
+                    self._entries.move_to_end(key)
+                    found[i] = unpack_vector(data)
+                    self.hits["local"] += 1
+                else:
+                    remote.append(i)
+        return keys, found, remote
+
+    def _merge_remote(self, keys, found, remote, values):
+        with self._lock:
+            for i, data in zip(remote, values):
+                if data:
+                    self._store_local(keys[i], data)
+                    found[i] = unpack_vector(data)
+                    self.hits["redis"] += 1
+            self.misses += sum(1 for vector in found if vector is None)
+        return found
+
+    def get_many(self, texts):
+        """Return cached vectors for ``texts``, with ``None`` for misses."""
+        keys, found, remote = self._get_local(texts)
+        values = [None] * len(remote)
+        if remote and Config.USE_REDIS:
+            try:
+                values = redis_client.mget([keys[i] for i in remote])
+            except Exception as e:
+                logger.error(f"Error reading embedding cache from Redis: {e}")
+        return self._merge_remote(keys, found, remote, values)
+
+    async def aget_many(self, texts, redis):
+        """Like ``get_many`` but reads the Redis tier through an asyncio client."""
+        keys, found, remote = self._get_local(texts)
+        values = [None] * len(remote)
+        if remote and Config.USE_REDIS:
+            try:
+                values = await redis.mget([keys[i] for i in remote])
+            except Exception as e:
+                logger.error(f"Error reading embedding cache from Redis: {e}")
+        return self._merge_remote(keys, found, remote, values)
+
+    def get(self, text):
+        return self.get_many([text])[0]
+
+    def _set_local(self, texts, vectors):
+        items = [(cache_key(text), pack_vector(vector)) for text, vector in zip(texts, vectors) if vector]
+        with self._lock:
+            self._check_model()
+            for key, data in items:
+                self._store_local(key, data)
+        return items
+
+    def set_many(self, texts, vectors):
+        items = self._set_local(texts, vectors)
+        if items and Config.USE_REDIS:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for key, data in items:
+                    pipe.setex(key, self.ttl, data)
+                pipe.execute()
+            except Exception as e:
+                logger.error(f"Error writing embedding cache to Redis: {e}")
+
+    async def aset_many(self, texts, vectors, redis):
+        items = self._set_local(texts, vectors)
+        if items and Config.USE_REDIS:
+            try:
+                pipe = redis.pipeline(transaction=False)
+                for key, data in items:
+                    pipe.setex(key, self.ttl, data)
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"Error writing embedding cache to Redis: {e}")
+
+    def set(self, text, vector):
+        self.set_many([text], [vector])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits["local"] + self.hits["redis"] + self.misses
+            return {
+                "model": self._model,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "local_hits": self.hits["local"],
+                "redis_hits": self.hits["redis"],
+                "misses": self.misses,
+                "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+            }
+
+
+embedding_cache = EmbeddingCache(Config.EMBEDDING_CACHE_MAX_BYTES, Config.EMBEDDING_CACHE_EXPIRATION)
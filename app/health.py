@@ -0,0 +1,54 @@
+import logging
+import time
+import requests
+from sqlalchemy import text
+from . import db, es, redis_client
+from .config import Config
+
+logger = logging.getLogger()
+
+
+def check_database():
+    with db.engine.connect() as connection:
+        connection.execute(text("SELECT 1"))
+
+
+def check_redis():
+    redis_client.ping()
+
+
+def check_elasticsearch():
+    if not es.options(request_timeout=Config.READY_TIMEOUT, max_retries=0).ping():
+        raise ConnectionError(f"No answer from {Config.ELASTICSEARCH_URL}")
+
+
+def check_ollama():
+    url = Config.OLLAMA_API_URL.rsplit("/api/", 1)[0] + "/api/version"
+    # Not the pooled session: its transport retries would slow a failing probe down
+    requests.get(url, timeout=Config.READY_TIMEOUT).raise_for_status()
+
+
+CHECKS = {
+    "database": check_database,
+    "redis": check_redis,
+    "elasticsearch": check_elasticsearch,
+    "ollama": check_ollama,
+}
+
+
+def readiness():
+    """Probe every dependency in ``READY_CHECKS``; returns ``(ready, {name: result})``."""
+    checks = {}
+    for name in Config.READY_CHECKS:
+        name = name.strip()
+        if not name or (name == "redis" and not Config.USE_REDIS):
+            continue
+        start = time.perf_counter()
+        try:
+            CHECKS[name]()
+            checks[name] = {"status": "ok"}
+        except Exception as e:
+            logger.warning(f"Readiness check '{name}' failed: {e}")
+            checks[name] = {"status": "error", "error": str(e)}
+        checks[name]["ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return all(check["status"] == "ok" for check in checks.values()), checks
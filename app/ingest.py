@@ -0,0 +1,253 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from elasticsearch import helpers
+from .config import Config
+from .centroid_index import centroid_index
+from .utils import get_embeddings
+from .vector_store import local_store
+from . import es, redis_client
+
+logger = logging.getLogger()
+
+EMBEDDING_DIMS = 768
+
+
+def memory_document(item):
+    """Validate one /memory item and return the document to index, or ``None``."""
+    if not isinstance(item, dict):
+        return None
+    category = item.get("Category")
+    sub_category = item.get("Subcategory")
+    description = item.get("Description")
+    if not category or not sub_category or not description:
+        return None
+    return {"Description": description, "Category": category, "Sub-Category": sub_category}
+
+
+def index_source(document, embedding):
+    """The Elasticsearch source of a /memory document.
+
+    ``indexed_at`` (epoch milliseconds) lets a reindex replay the documents
+    written while it was building the new index.
+    """
+    return {**document, "embedding": embedding, "indexed_at": int(time.time() * 1000)}
+
+
+def track_memory(document, embedding):
+    """Keep the in-process indexes in step with a document stored in Elasticsearch."""
+    if Config.RETRIEVAL_BACKEND == "local" and local_store.loaded:
+        try:
+            local_store.append(document, embedding)
+        except Exception as e:
+            logging.error(f"Error appending document to local vector index: {str(e)}")
+    if centroid_index.loaded:
+        try:
+            centroid_index.add(document["Category"], document["Sub-Category"], embedding)
+        except Exception as e:
+            logging.error(f"Error updating centroid index: {str(e)}")
+
+
+def index_memories(documents, refresh=False):
+    """Embed ``documents`` with batched Ollama calls and write them with the bulk API.
+
+    Returns ``(indexed, errors)`` where ``errors`` lists ``{"index", "error"}``
+    for every document that could not be embedded or stored.
+    """
+    indexed, errors = 0, []
+    for start in range(0, len(documents), Config.MEMORY_EMBED_BATCH_SIZE):
+        batch = documents[start:start + Config.MEMORY_EMBED_BATCH_SIZE]
+        embeddings = get_embeddings([document["Description"] for document in batch])
+
+        actions, stored = [], []
+        for offset, (document, embedding) in enumerate(zip(batch, embeddings)):
+            if not embedding or len(embedding) != EMBEDDING_DIMS:
+                errors.append({"index": start + offset, "error": "Error generating embedding for the description"})
+                continue
+            actions.append({"_index": Config.ES_INDEX, "_source": index_source(document, embedding)})
+            stored.append((start + offset, document, embedding))
+        if not actions:
+            continue
+
+        try:
+            results = helpers.streaming_bulk(es, actions, chunk_size=Config.MEMORY_BULK_CHUNK_SIZE,
+                                             raise_on_error=False, raise_on_exception=False)
+            for (position, document, embedding), (ok, item) in zip(stored, results):
+                if ok:
+                    indexed += 1
+                    track_memory(document, embedding)
+                else:
+                    errors.append({"index": position, "error": str(item["index"].get("error"))})
+        except Exception as e:
+            logging.error(f"Error bulk indexing documents: {str(e)}")
+            errors.extend({"index": position, "error": str(e)} for position, _, _ in stored)
+
+    if refresh and indexed:
+        es.indices.refresh(index=Config.ES_INDEX)
+    logging.info(f"Bulk indexed {indexed}/{len(documents)} documents")
+    return indexed, errors
+
+
+def store_memories(user_identity, data):
+    """Bulk /memory: index the documents now, or queue a job when "async" is set.
+
+    Returns ``(status, body, headers)`` so the Flask and ASGI routes share it.
+    """
+    items = data.get("documents", [data])
+    run_async = bool(data.get("async"))
+    max_documents = Config.MEMORY_MAX_DOCUMENTS if run_async else Config.MEMORY_SYNC_MAX_DOCUMENTS
+    if not isinstance(items, list) or not items:
+        logging.warning("Memory request with an empty or invalid 'documents' list")
+        return 400, {"msg": "Documents must be a non-empty list"}, {}
+    if len(items) > max_documents:
+        logging.warning(f"Memory request with {len(items)} documents exceeds the limit")
+        return 400, {"msg": f"At most {max_documents} documents are allowed per request"}, {}
+
+    documents = [memory_document(item) for item in items]
+    invalid = [i for i, document in enumerate(documents) if document is None]
+    if invalid:
+        logging.warning(f"Memory request with {len(invalid)} invalid documents")
+        return 400, {
+            "msg": "Category, Subcategory, and Description are required",
+            "invalid": invalid[:Config.MEMORY_JOB_MAX_ERRORS]
+        }, {}
+
+    if run_async:
+        job = ingest_queue.submit(user_identity, documents)
+        body = {"msg": "Documents queued", "job_id": job["job_id"], "total": job["total"]}
+        return 202, body, {"Location": f"/api/memory/jobs/{job['job_id']}"}
+
+    indexed, errors = index_memories(documents)
+    status = 201 if not errors else 207 if indexed else 500
+    return status, {"msg": f"Stored {indexed} of {len(documents)} documents", "indexed": indexed, "errors": errors}, {}
+
+
+class IngestQueue:
+    """Write-behind ingestion for /memory jobs.
+
+    Jobs are queued in process and drained by one background thread that
+    embeds and bulk indexes them batch by batch. The index is refreshed once
+    the queue runs dry (or every ``MEMORY_REFRESH_INTERVAL`` seconds while it
+    is busy) instead of once per document. Job progress is kept in Redis so
+    any worker can answer a status request.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = os.getpid()
+        self._last_refresh = time.time()
+
+    def submit(self, user_identity, documents):
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "user": user_identity,
+            "status": "queued",
+            "total": len(documents),
+            "indexed": 0,
+            "failed": 0,
+            "errors": [],
+            "created": time.time(),
+            "updated": time.time(),
+        }
+        self._prune()
+        self._save(job)
+        self._ensure_worker()
+        self._queue.put((job, documents))
+        logging.info(f"Queued memory job {job['job_id']} with {len(documents)} documents")
+        return job
+
+    def status(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+        if Config.USE_REDIS:
+            value = redis_client.get(self._key(job_id))
+            if value:
+                return json.loads(value)
+        return None
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _prune(self):
+        """Forget finished jobs older than the job expiration."""
+        cutoff = time.time() - Config.MEMORY_JOB_EXPIRATION
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job["status"] in ("done", "failed") and job["updated"] < cutoff]:
+                del self._jobs[job_id]
+
+    @staticmethod
+    def _key(job_id):
+        return f"memory_job:{job_id}"
+
+    def _save(self, job):
+        job["updated"] = time.time()
+        with self._lock:
+            self._jobs[job["job_id"]] = job
+        if Config.USE_REDIS:
+            try:
+                redis_client.setex(self._key(job["job_id"]), Config.MEMORY_JOB_EXPIRATION, json.dumps(job))
+            except Exception as e:
+                logging.error(f"Error saving memory job {job['job_id']}: {str(e)}")
+
+    def _ensure_worker(self):
+        with self._lock:
+            # A forked child inherits the queue object but not the worker thread
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._jobs = {}
+                self._thread = None
+                self._pid = os.getpid()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="memory-ingest", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            job, documents = self._queue.get()
+            try:
+                self._process(job, documents)
+            except Exception as e:
+                logging.error(f"Memory job {job['job_id']} failed: {str(e)}")
+                job["status"] = "failed"
+                self._save(job)
+            finally:
+                self._queue.task_done()
+
+            if self._queue.empty() or time.time() - self._last_refresh >= Config.MEMORY_REFRESH_INTERVAL:
+                self._refresh()
+
+    def _process(self, job, documents):
+        job["status"] = "running"
+        self._save(job)
+        for start in range(0, len(documents), Config.MEMORY_EMBED_BATCH_SIZE):
+            batch = documents[start:start + Config.MEMORY_EMBED_BATCH_SIZE]
+            indexed, errors = index_memories(batch)
+            job["indexed"] += indexed
+            job["failed"] += len(errors)
+            # Keep the stored job small; the count still covers every failure
+            room = Config.MEMORY_JOB_MAX_ERRORS - len(job["errors"])
+            job["errors"] += [{"index": start + error["index"], "error": error["error"]} for error in errors[:max(room, 0)]]
+            self._save(job)
+        job["status"] = "done"
+        self._save(job)
+        logging.info(f"Memory job {job['job_id']} done: {job['indexed']} indexed, {job['failed']} failed")
+
+    def _refresh(self):
+        try:
+            es.indices.refresh(index=Config.ES_INDEX)
+        except Exception as e:
+            logging.error(f"Error refreshing documents index: {str(e)}")
+        self._last_refresh = time.time()
+
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+import openai
+from .clients import registry
+from .config import Config
+from .metrics import record_usage, stage
+from .resilience import breakers
+from .utils import build_classify_prompt, classification_request, read_classification
+
+logger = logging.getLogger()
+
+BATCH_SYSTEM_PROMPT = (
+    "You are a strict classifier. For each numbered query pick the number of one of that query's own labels. "
+    'Reply with JSON only: {"results": [{"id": <query number>, "label": <label number>}, ...]}.'
+)
+
+
+class LLMBatcher:
+    """Micro-batches concurrent LLM classifications into one chat completion.
+
+    Callers queue ``(query, documents)`` and wait on a future. A flusher
+    thread collects pending items for up to ``LLM_BATCH_WINDOW_MS`` (or until
+    ``LLM_BATCH_MAX_SIZE`` are waiting) and sends them as one numbered prompt,
+    each query with its own labels and examples. Items the batched answer
+    does not cover, or a batch whose answer cannot be parsed, fall back to
+    one call per query.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = []
+        self._thread = None
+        self._pool = None
+        self._pid = os.getpid()
+        self.batches = 0
+        self.fallbacks = 0
+
+    def submit(self, query, documents):
+        """Queue a classification; the future resolves to ``(category, subcategory)``."""
+        future = Future()
+        with self._condition:
+            self._ensure_worker()
+            self._pending.append((query, documents, future))
+            self._condition.notify()
+        return future
+
+    def _ensure_worker(self):
+        # A forked child inherits the pending list but not the flusher thread
+        if self._pid != os.getpid():
+            self._pending = []
+            self._thread = None
+            self._pool = None
+            self._pid = os.getpid()
+        if self._thread is None or not self._thread.is_alive():
+            self._pool = ThreadPoolExecutor(max_workers=Config.LLM_BATCH_WORKERS, thread_name_prefix="llm-batch")
+            self._thread = threading.Thread(target=self._run, name="llm-batcher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                deadline = time.monotonic() + Config.LLM_BATCH_WINDOW_MS / 1000
+                while len(self._pending) < Config.LLM_BATCH_MAX_SIZE:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                # Don't let items cancelled while waiting take up places in the batch
+                self._pending = [item for item in self._pending if not item[2].cancelled()]
+                batch = self._pending[:Config.LLM_BATCH_MAX_SIZE]
+                self._pending = self._pending[Config.LLM_BATCH_MAX_SIZE:]
+            if batch:
+                self._pool.submit(self._send, batch)
+
+    def _send(self, batch):
+        # Callers whose budget ran out cancelled their future; a running future can no longer be cancelled
+        batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            results = self._complete_batch(batch) if len(batch) > 1 else {}
+        except Exception as e:
+            logger.error(f"Batched OpenAI classification of {len(batch)} queries failed: {e}")
+            results = {}
+
+        for i, (query, documents, future) in enumerate(batch):
+            try:
+                if i not in results:
+                    if len(batch) > 1:
+                        self.fallbacks += 1
+                    results[i] = self._complete_one(query, documents)
+                if not future.done():
+                    future.set_result(results[i])
+            except Exception as e:
+                # The caller decides how to degrade; the rest of the batch is still answered
+                logger.error(f"Error in OpenAI classification: {e}")
+                if not future.done():
+                    future.set_exception(e)
+
+    @staticmethod
+    def _complete_one(query, documents):
+        prompt = build_classify_prompt(query, documents)
+        if not prompt.labels:
+            logger.warning("No candidate labels to classify against")
+            return "Unknown", "Unknown"
+        registry.openai  # Installs the pooled session for this process
+        with stage("llm_batch"):
+            response = breakers["openai"].call(openai.ChatCompletion.create, **classification_request(prompt),
+                                               request_timeout=Config.OPENAI_TIMEOUT)
+        return read_classification(response, query, prompt)
+
+    def _complete_batch(self, batch):
+        """Classify every item with one completion; returns ``{position: (category, subcategory)}``."""
+        prompts = [build_classify_prompt(query, documents) for query, documents, _ in batch]
+        sections = [f"### Query {i}\n{prompt.messages[-1]['content']}" for i, prompt in enumerate(prompts, 1) if prompt.labels]
+        if not sections:
+            return {i: ("Unknown", "Unknown") for i in range(len(batch))}
+
+        params = classification_request(prompts[0])
+        params["messages"] = [
+            {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+            {"role": "user", "content": "\n\n".join(sections)},
+        ]
+        params["max_tokens"] = Config.LLM_MAX_TOKENS + Config.LLM_BATCH_TOKENS_PER_ITEM * len(sections)
+        registry.openai
+        with stage("llm_batch"):
+            response = breakers["openai"].call(openai.ChatCompletion.create, **params, request_timeout=Config.OPENAI_TIMEOUT)
+        self.batches += 1
+
+        usage = response.get('usage', {})
+        record_usage(usage)
+        logger.info(f"Batched classification of {len(batch)} queries used {usage.get('prompt_tokens', 'N/A')} prompt "
+                    f"and {usage.get('completion_tokens', 'N/A')} completion tokens")
+
+        content = response['choices'][0]['message']['content']
+        try:
+            answers = json.loads(content.strip().removeprefix("```json").strip("` \n"))["results"]
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Could not parse batched classification, falling back to single calls: {content}")
+            return {}
+
+        results = {i: ("Unknown", "Unknown") for i, prompt in enumerate(prompts) if not prompt.labels}
+        for answer in answers if isinstance(answers, list) else []:
+            try:
+                position, number = int(answer["id"]) - 1, int(answer["label"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 0 <= position < len(prompts) and 1 <= number <= len(prompts[position].labels):
+                results[position] = prompts[position].labels[number - 1]
+        for position, (query, _, _) in enumerate(batch):
+            if position in results:
+                logger.info(f"Classification result for query '{query}': "
+                            f"Category - {results[position][0]}, Sub-Category - {results[position][1]}")
+        return results
+
+    def stats(self):
+        with self._condition:
+            pending = len(self._pending)
+        return {"pending": pending, "batches": self.batches, "fallbacks": self.fallbacks}
+
+
+llm_batcher = LLMBatcher()
@@ -1,29 +1,182 @@
+import atexit
+import json
 import logging
-from flask import request
-from app.config import Config 
+import os
+import queue
+import threading
+import time
+import uuid
+import zlib
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from app.config import Config
+from app.metrics import LOG_RECORDS_DROPPED, current_timings
+
+# (request_id, client_ip) of the request being served, set by bind_request()
+_request = ContextVar("log_request", default=None)
+
+_installed = []
+_listener = None
+
+
+def bind_request(request_id=None, client_ip=None):
+    """Tag records logged by the current request (and tasks copied from its context); returns the id."""
+    request_id = request_id or uuid.uuid4().hex
+    _request.set((request_id, client_ip))
+    return request_id
+
+
+def unbind_request():
+    # Flask reuses threads (and their context) for the next request
+    _request.set(None)
+
+
+class RequestContextFilter(logging.Filter):
+    """Copies the request id, client IP and stage timings onto the record when it is logged.
+
+    In queue mode records are formatted on the listener thread, where neither
+    the Flask request nor the request's context variables are available.
+    """
+
+    def filter(self, record):
+        bound = _request.get()
+        record.request_id, record.client_ip = bound if bound else (None, None)
+        record.client_ip = record.client_ip or "SEMANTIC-API"
+        record.stages = current_timings() if bound else {}
+        return True
+
+
+class RequestSampler(logging.Filter):
+    """Drops INFO and lower lines of requests outside ``LOG_REQUEST_SAMPLE_RATE`` or over the per-second cap.
+
+    Sampling is decided per request id, so a kept request keeps all its lines.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._second = 0
+        self._count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, "request_id", None):
+            return True
+        rate = Config.LOG_REQUEST_SAMPLE_RATE
+        if rate < 1 and zlib.crc32(record.request_id.encode("utf-8")) % 10000 >= rate * 10000:
+            LOG_RECORDS_DROPPED.labels("sampled").inc()
+            return False
+        cap = Config.LOG_REQUEST_INFO_PER_SECOND
+        if cap:
+            second = int(time.monotonic())
+            with self._lock:
+                if second != self._second:
+                    self._second, self._count = second, 0
+                self._count += 1
+                over = self._count > cap
+            if over:
+                LOG_RECORDS_DROPPED.labels("rate_limited").inc()
+                return False
+        return True
+
 
 class RequestFormatter(logging.Formatter):
     def format(self, record):
-        # Try to get the client's IP address
-        client_ip = request.headers.get('X-Forwarded-For', request.remote_addr) if request else "SEMANTIC-API"
-        # Prepend the IP address to the log message
-        record.client_ip = client_ip
+        # Records that skipped RequestContextFilter (e.g. from a handler added elsewhere)
+        if not hasattr(record, "client_ip"):
+            record.client_ip = "SEMANTIC-API"
         return super().format(record)
 
-def setup_logging():
-    # Log setup
-    logging.basicConfig(
-        level=Config.LOG_LEVEL,
-        handlers=[
-            logging.FileHandler('logs/app.log', encoding='utf-8'),  # File handler
-            logging.StreamHandler()  # Stream handler
-        ]
-    )
-
-    # Create and apply the custom formatter
-    formatter = RequestFormatter('%(client_ip)s - %(asctime)s - %(levelname)s - %(message)s')
-
-    # Apply the formatter to all handlers
-    for handler in logging.getLogger().handlers:
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the request id and the stage timings so far."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "client_ip": getattr(record, "client_ip", None),
+            "request_id": getattr(record, "request_id", None),
+        }
+        if getattr(record, "stages", None):
+            entry["stages_ms"] = record.stages
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Never blocks the request thread: records beyond ``LOG_QUEUE_SIZE`` are dropped and counted."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+
+
+def build_handlers():
+    path = Config.LOG_FILE.format(pid=os.getpid())
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    if Config.LOG_ROTATE == "size":
+        file_handler = RotatingFileHandler(path, maxBytes=Config.LOG_MAX_BYTES,
+                                           backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8')
+    elif Config.LOG_ROTATE == "time":
+        file_handler = TimedRotatingFileHandler(path, when=Config.LOG_ROTATE_WHEN,
+                                                backupCount=Config.LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        file_handler = logging.FileHandler(path, encoding='utf-8')
+    handlers = [file_handler, logging.StreamHandler()]
+
+    if Config.LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = RequestFormatter('%(client_ip)s - %(asctime)s - %(levelname)s - %(message)s')
+    for handler in handlers:
         handler.setFormatter(formatter)
+    return handlers
 
+
+def install_handlers():
+    """(Re)create the root logger's handlers, and in queue mode the listener thread that runs them."""
+    global _listener
+    root = logging.getLogger()
+    for handler in _installed:
+        root.removeHandler(handler)
+        handler.close()
+    _installed.clear()
+
+    handlers = build_handlers()
+    if Config.LOG_MODE == "queue":
+        log_queue = queue.Queue(Config.LOG_QUEUE_SIZE)
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        handlers = [DroppingQueueHandler(log_queue)]
+    else:
+        _listener = None
+
+    for handler in handlers:
+        # Request fields are captured on the request thread, before the record is queued
+        handler.addFilter(RequestContextFilter())
+        handler.addFilter(RequestSampler())
+        root.addHandler(handler)
+        _installed.append(handler)
+
+
+def stop_listener():
+    """Write out queued records; runs at exit."""
+    if _listener is not None:
+        _listener.stop()
+
+
+def setup_logging():
+    root = logging.getLogger()
+    root.setLevel(Config.LOG_LEVEL)
+    first = not _installed
+    install_handlers()
+    if first:
+        atexit.register(stop_listener)
+        # A forked gunicorn worker inherits the handlers but not the listener thread
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=install_handlers)
@@ -0,0 +1,106 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess,
+)
+
+# Prometheus metrics for the request hot path.
+#
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+# (set by gunicorn.conf.py before the workers start) and /api/metrics merges
+# them, so a scrape sees the whole server rather than whichever worker
+# answered it.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_LATENCY = Histogram(
+    "classify_stage_seconds", "Time spent in each stage of a request",
+    ["stage"], buckets=LATENCY_BUCKETS)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "End-to-end request latency",
+    ["endpoint", "method", "status"], buckets=LATENCY_BUCKETS)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Requests currently being served",
+    ["endpoint"], multiprocess_mode="livesum")
+CACHE_RESULTS = Counter(
+    "classify_cache_total", "Classify cache outcomes (hit, stale, miss, semantic, coalesced)",
+    ["result"])
+CLASSIFY_PATHS = Counter(
+    "classify_path_total", "How classifications were resolved",
+    ["path"])
+RATE_LIMITED = Counter(
+    "rate_limit_rejections_total", "Requests rejected by the rate limiter")
+DEGRADED = Counter(
+    "classify_degraded_total", "Classifications answered without the LLM because of the budget or a failure",
+    ["reason"])
+BREAKER_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total", "Circuit breaker state changes",
+    ["dependency", "state"])
+LOG_RECORDS_DROPPED = Counter(
+    "log_records_dropped_total", "Log records not written (sampled, rate_limited, queue_full)",
+    ["reason"])
+OPENAI_TOKENS = Counter(
+    "openai_tokens_total", "OpenAI tokens used by classifications",
+    ["kind"])
+
+# Stage durations of the current request, reported in the Server-Timing header
+_timings = ContextVar("timings", default=None)
+
+
+def begin_timing():
+    """Start collecting stage durations for the current request or task."""
+    _timings.set({})
+
+
+@contextmanager
+def stage(name):
+    """Time a block as stage ``name`` in the histogram and the Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def record_stage(name, seconds):
+    STAGE_LATENCY.labels(name).observe(seconds)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def server_timing(total=None):
+    """Render the collected stage durations as a ``Server-Timing`` header value."""
+    timings = dict(_timings.get() or {})
+    if total is not None:
+        timings["total"] = total
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+def current_timings():
+    """Stage durations of the current request so far, in milliseconds."""
+    return {name: round(seconds * 1000, 1) for name, seconds in (_timings.get() or {}).items()}
+
+
+def count_cache(cached):
+    """Count a classify outcome from its ``cached`` response field."""
+    CACHE_RESULTS.labels({"true": "hit", "false": "miss"}.get(cached, cached)).inc()
+
+
+def record_usage(usage):
+    """Count the prompt and completion tokens of an OpenAI response."""
+    for kind in ("prompt", "completion"):
+        tokens = usage.get(f"{kind}_tokens")
+        if tokens:
+            OPENAI_TOKENS.labels(kind).inc(tokens)
+
+
+def render_metrics():
+    """Return ``(body, content_type)`` for a Prometheus scrape."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -13,3 +13,14 @@ class User(db.Model):
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
+
+
+class ApiKey(db.Model):
+    """A revocable key for service clients. Only the SHA-256 of the key is stored."""
+    id = db.Column(db.Integer, primary_key=True)
+    prefix = db.Column(db.String(16), unique=True, nullable=False, index=True)
+    key_hash = db.Column(db.String(64), nullable=False)
+    username = db.Column(db.String(80), nullable=False)
+    name = db.Column(db.String(80))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    revoked_at = db.Column(db.DateTime)
@@ -0,0 +1,102 @@
+import logging
+import math
+from collections import namedtuple
+from redis.commands.core import AsyncScript, Script
+from .config import Config
+from .metrics import RATE_LIMITED, stage
+
+logger = logging.getLogger()
+
+# Token bucket plus cache probe, evaluated atomically in one round trip.
+# KEYS[1] is the bucket, KEYS[2..n] are cache keys returned only when allowed.
+# ARGV: capacity, window in milliseconds, cost of this request.
+RATE_LIMIT_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local rate = capacity / window
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed = 0
+local retry = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry = math.ceil((cost - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(window * 2))
+
+local result = {allowed, math.floor(tokens), math.ceil((capacity - tokens) / rate), retry}
+if allowed == 1 then
+    for i = 2, #KEYS do
+        result[#result + 1] = redis.call('GET', KEYS[i])
+    end
+end
+return result
+"""
+
+RateLimit = namedtuple("RateLimit", "allowed limit remaining reset_ms retry_ms cached")
+
+
+def limit_for(identity):
+    """Return ``(max_requests, window_seconds)`` for a user, honouring per-user overrides."""
+    override = Config.RATE_LIMIT_OVERRIDES.get(identity, {})
+    return (
+        override.get("max_requests", Config.RATE_LIMIT_MAX_REQUESTS),
+        override.get("window_seconds", Config.RATE_LIMIT_WINDOW_SECONDS),
+    )
+
+
+def _script_args(identity, cache_keys, cost):
+    max_requests, window = limit_for(identity)
+    keys = [f"rate_limit:{identity}"] + list(cache_keys)
+    return max_requests, keys, [max_requests, int(window * 1000), cost]
+
+
+# Created once and run with the caller's client: EVALSHA, reloading the script if Redis lost it
+_script = Script(None, RATE_LIMIT_SCRIPT.encode("utf-8"))
+_ascript = AsyncScript(None, RATE_LIMIT_SCRIPT.encode("utf-8"))
+
+
+def _result(max_requests, cache_keys, reply):
+    allowed, remaining, reset_ms, retry_ms = (int(value) for value in reply[:4])
+    cached = list(reply[4:]) if allowed else []
+    cached += [None] * (len(cache_keys) - len(cached))
+    if not allowed:
+        RATE_LIMITED.inc()
+    return RateLimit(bool(allowed), max_requests, remaining, reset_ms, retry_ms, cached)
+
+
+def check_rate_limit(redis, identity, cache_keys=(), cost=1):
+    """Consume ``cost`` tokens for ``identity`` and read ``cache_keys`` in one round trip."""
+    max_requests, keys, args = _script_args(identity, cache_keys, cost)
+    with stage("redis"):
+        reply = _script(keys=keys, args=args, client=redis)
+    return _result(max_requests, cache_keys, reply)
+
+
+async def acheck_rate_limit(redis, identity, cache_keys=(), cost=1):
+    """``check_rate_limit`` for an asyncio Redis client."""
+    max_requests, keys, args = _script_args(identity, cache_keys, cost)
+    with stage("redis"):
+        reply = await _ascript(keys=keys, args=args, client=redis)
+    return _result(max_requests, cache_keys, reply)
+
+
+def rate_limit_headers(limit):
+    headers = {
+        "X-RateLimit-Limit": str(limit.limit),
+        "X-RateLimit-Remaining": str(limit.remaining),
+        "X-RateLimit-Reset": str(math.ceil(limit.reset_ms / 1000)),
+    }
+    if not limit.allowed:
+        headers["Retry-After"] = str(max(1, math.ceil(limit.retry_ms / 1000)))
+    return headers
@@ -0,0 +1,144 @@
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from .config import Config
+from .metrics import BREAKER_TRANSITIONS
+
+logger = logging.getLogger()
+
+
+class DeadlineExceeded(Exception):
+    """The request's latency budget ran out before a stage could start."""
+
+
+class CircuitOpenError(Exception):
+    """A dependency's circuit breaker is open, so it was not called."""
+
+
+# Absolute deadline (time.monotonic()) of the current request or task, if any
+_deadline = ContextVar("deadline", default=None)
+
+
+def start_deadline(budget_ms=None):
+    """Give the current request ``budget_ms`` (or ``REQUEST_BUDGET_MS``), capped at ``REQUEST_BUDGET_MAX_MS``."""
+    try:
+        budget_ms = float(budget_ms) if budget_ms else Config.REQUEST_BUDGET_MS
+    except ValueError:
+        budget_ms = Config.REQUEST_BUDGET_MS
+    budget_ms = min(max(budget_ms, 0.0), Config.REQUEST_BUDGET_MAX_MS)
+    _deadline.set(time.monotonic() + budget_ms / 1000 if budget_ms else None)
+
+
+def clear_deadline():
+    _deadline.set(None)
+
+
+def remaining():
+    """Seconds left in the current budget, or ``None`` when the request has no deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def stage_timeout(cap, attempts=1, minimum=0.0):
+    """Timeout for one attempt of a stage: ``cap``, shortened to fit the remaining budget.
+
+    The budget is split across ``attempts`` so transport-level retries cannot
+    overrun it. Raises ``DeadlineExceeded`` when less than ``minimum`` seconds
+    are left.
+    """
+    left = remaining()
+    if left is None:
+        return cap
+    if left <= minimum or left <= 0:
+        raise DeadlineExceeded(f"{max(left, 0) * 1000:.0f} ms left in the request budget")
+    return min(cap, left / attempts)
+
+
+class CircuitBreaker:
+    """Stops calling a dependency after ``failures`` consecutive errors.
+
+    While open, calls fail fast with ``CircuitOpenError``. After
+    ``reset_seconds`` one trial call is let through (half-open); its outcome
+    closes the breaker again or re-opens it.
+    """
+
+    def __init__(self, name, failures=None, reset_seconds=None):
+        self.name = name
+        self._failures = failures
+        self._reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def failures(self):
+        return self._failures or Config.CIRCUIT_BREAKER_FAILURES
+
+    @property
+    def reset_seconds(self):
+        return self._reset_seconds or Config.CIRCUIT_BREAKER_RESET_SECONDS
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self._opened_at >= self.reset_seconds else "open"
+
+    def before_call(self):
+        """Raise ``CircuitOpenError`` unless a call may go ahead now."""
+        if not Config.CIRCUIT_BREAKER_ENABLED:
+            return
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f"{self.name} circuit closed")
+                BREAKER_TRANSITIONS.labels(self.name, "closed").inc()
+            self._consecutive = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        left = remaining()
+        with self._lock:
+            if left is not None and left <= 0:
+                # Cut short by the caller's budget, which says nothing about the dependency
+                self._trial = False
+                return
+            self._consecutive += 1
+            if self._trial or (self._opened_at is None and self._consecutive >= self.failures):
+                logger.warning(f"{self.name} circuit opened after {self._consecutive} consecutive failures")
+                BREAKER_TRANSITIONS.labels(self.name, "open").inc()
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+        self.success()
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self._consecutive}
+
+
+breakers = {name: CircuitBreaker(name) for name in ("ollama", "elasticsearch", "openai")}
+
+
+def breaker_stats():
+    return {name: breaker.stats() for name, breaker in breakers.items()}
@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+import numpy as np
+from .config import Config
+
+logger = logging.getLogger()
+
+# Upper bounds of the best-similarity histogram used to tune the threshold
+SIMILARITY_BUCKETS = (0.80, 0.85, 0.90, 0.92, 0.94, 0.96, 0.98, 1.0)
+
+
+class SemanticCache:
+    """Bounded cache of classified query vectors for near-duplicate lookups.
+
+    Vectors are kept L2-normalized in one float32 matrix so a lookup is a
+    single matrix-vector product. Entries expire after ``ttl`` seconds and
+    the least recently used entry is replaced once ``capacity`` is reached.
+    """
+
+    def __init__(self, capacity, ttl, threshold):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._results = [None] * capacity
+        self._created = np.zeros(capacity)
+        self._used = np.zeros(capacity)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self._histogram = [0] * (len(SIMILARITY_BUCKETS) + 1)
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _record(self, similarity):
+        for i, bound in enumerate(SIMILARITY_BUCKETS):
+            if similarity < bound:
+                self._histogram[i] += 1
+                return
+        self._histogram[-1] += 1
+
+    def lookup(self, embedding):
+        """Return ``(result, similarity)`` for the closest live entry, or ``(None, similarity)``."""
+        query = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            if self._size == 0 or self._matrix is None or query.shape[0] != self._matrix.shape[1]:
+                self.misses += 1
+                return None, 0.0
+            similarities = self._matrix[:self._size] @ query
+            similarities[now - self._created[:self._size] > self.ttl] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            self._record(similarity)
+            if similarity < self.threshold:
+                self.misses += 1
+                return None, similarity
+            self._used[best] = now
+            self.hits += 1
+            return self._results[best], similarity
+
+    def add(self, embedding, result):
+        vector = self._normalize(embedding)
+        now = time.time()
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+                self._matrix = np.zeros((self.capacity, vector.shape[0]), dtype=np.float32)
+                self._size = 0
+            if self._size < self.capacity:
+                slot = self._size
+                self._size += 1
+            else:
+                # Reuse an expired slot first, otherwise the least recently used one
+                expired = np.flatnonzero(now - self._created > self.ttl)
+                slot = int(expired[0]) if expired.size else int(np.argmin(self._used))
+            self._matrix[slot] = vector
+            self._results[slot] = result
+            self._created[slot] = now
+            self._used[slot] = now
+
+    def clear(self):
+        with self._lock:
+            self._size = 0
+            self._results = [None] * self.capacity
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            labels = [f"<{bound}" for bound in SIMILARITY_BUCKETS] + [">=1.0"]
+            return {
+                "entries": self._size,
+                "capacity": self.capacity,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "best_similarity": dict(zip(labels, self._histogram)),
+            }
+
+
+semantic_cache = SemanticCache(
+    Config.SEMANTIC_CACHE_MAX_ENTRIES,
+    Config.SEMANTIC_CACHE_EXPIRATION,
+    Config.SEMANTIC_CACHE_THRESHOLD,
+)
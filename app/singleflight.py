@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from .config import Config
+from .embedding_cache import normalize_text
+from .resilience import remaining
+
+logger = logging.getLogger()
+
+# Deletes the lock only if this worker still owns it
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class FlightAbandoned(Exception):
+    """The owner of a coalesced call was cancelled before it had a result."""
+
+
+def wait_seconds():
+    """How long a waiter may wait for the owner: ``SINGLE_FLIGHT_WAIT_SECONDS``, within its own budget.
+
+    Enough of the budget is left over for the waiter to answer without the LLM.
+    """
+    left = remaining()
+    if left is None:
+        return Config.SINGLE_FLIGHT_WAIT_SECONDS
+    return max(min(Config.SINGLE_FLIGHT_WAIT_SECONDS, left - Config.LLM_MIN_BUDGET_MS / 1000), 0)
+
+
+def flight_key(query):
+    return hashlib.sha256(normalize_text(query).encode("utf-8")).hexdigest()
+
+
+def fresh_key(query):
+    """Marker whose expiry ends the fresh period of a cached result."""
+    return f"fresh:{query}"
+
+
+def queue_cache_writes(pipe, query, ai_response):
+    """Queue the cache writes for a result on a (sync or asyncio) Redis pipeline.
+
+    With stale-while-revalidate enabled the value outlives its fresh marker
+    by ``CACHE_STALE_SECONDS`` so it can still be served while refreshing.
+    """
+    value = json.dumps(ai_response, ensure_ascii=False)
+    if Config.CACHE_STALE_SECONDS:
+        pipe.setex(query, Config.REDIS_CACHE_EXPIRATION + Config.CACHE_STALE_SECONDS, value)
+        pipe.setex(fresh_key(query), Config.REDIS_CACHE_EXPIRATION, 1)
+    else:
+        pipe.setex(query, Config.REDIS_CACHE_EXPIRATION, value)
+    return pipe
+
+
+def cache_probe_keys(queries):
+    """Keys to read for ``queries``: the cached values, then their fresh markers if enabled."""
+    if Config.CACHE_STALE_SECONDS:
+        return list(queries) + [fresh_key(query) for query in queries]
+    return list(queries)
+
+
+def split_probe(values, count):
+    """Return ``(cached_values, fresh_flags)`` from the values read for ``cache_probe_keys``."""
+    if Config.CACHE_STALE_SECONDS:
+        return values[:count], [bool(flag) for flag in values[count:]]
+    return values[:count], [True] * count
+
+
+class SingleFlight:
+    """Coalesces concurrent calls for the same key across threads and workers.
+
+    Within a process, callers for a key already in flight wait on its result.
+    Across workers, the first caller takes a short Redis lock and publishes its
+    result under ``sf:result:<key>``; the others poll for it and compute it
+    themselves only if the owner disappears or the wait times out.
+
+    Waiters wait no longer than their own request budget allows, and results
+    ``shareable`` rejects (e.g. answers degraded by the owner's budget) are
+    neither handed to waiters nor published; each waiter computes its own.
+    """
+
+    def __init__(self, redis, shareable=None):
+        self.redis = redis
+        self.shareable = shareable or (lambda result: True)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+        self.computed = 0
+
+    def do(self, query, compute):
+        """Return ``(result, shared)`` where ``result`` is what ``compute()`` returned."""
+        key = flight_key(query)
+        with self._lock:
+            call = self._calls.get(key)
+            owner = call is None
+            if owner:
+                call = {"event": threading.Event(), "result": None, "error": None, "shareable": False}
+                self._calls[key] = call
+
+        if not owner:
+            if not call["event"].wait(wait_seconds()):
+                logger.warning("Single-flight owner did not finish within the request budget, computing locally")
+                return self._compute(compute), False
+            if call["error"]:
+                raise call["error"]
+            if not call["shareable"]:
+                return self._compute(compute), False
+            with self._lock:
+                self.shared += 1
+            return call["result"], True
+
+        try:
+            call["result"], shared = self._distributed(key, compute)
+            call["shareable"] = self.shareable(call["result"])
+            return call["result"], shared
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+    def _distributed(self, key, compute):
+        if not Config.USE_REDIS:
+            return self._compute(compute), False
+        lock_key, result_key = f"sf:lock:{key}", f"sf:result:{key}"
+        token = uuid.uuid4().hex
+        if self.redis.set(lock_key, token, nx=True, px=Config.SINGLE_FLIGHT_LOCK_MS):
+            try:
+                result = self._compute(compute)
+                if self.shareable(result):
+                    self.redis.setex(result_key, Config.SINGLE_FLIGHT_RESULT_SECONDS, json.dumps(result, ensure_ascii=False))
+                return result, False
+            finally:
+                self.redis.eval(RELEASE_SCRIPT, 1, lock_key, token)
+
+        deadline = time.time() + wait_seconds()
+        while time.time() < deadline:
+            time.sleep(Config.SINGLE_FLIGHT_POLL_SECONDS)
+            value, locked = self.redis.pipeline(transaction=False).get(result_key).exists(lock_key).execute()
+            if value:
+                with self._lock:
+                    self.shared += 1
+                return json.loads(value), True
+            if not locked:
+                break
+        logger.warning("Single-flight owner did not publish a result in time, computing locally")
+        return self._compute(compute), False
+
+    def _compute(self, compute):
+        with self._lock:
+            self.computed += 1
+        return compute()
+
+    def stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls), "computed": self.computed, "shared": self.shared}
+
+
+class AsyncSingleFlight(SingleFlight):
+    """``SingleFlight`` for one event loop and an asyncio Redis client."""
+
+    def __init__(self, redis, shareable=None):
+        super().__init__(redis, shareable)
+        self._futures = {}
+
+    async def ado(self, query, compute):
+        key = flight_key(query)
+        future = self._futures.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future), wait_seconds())
+            except (asyncio.TimeoutError, FlightAbandoned):
+                logger.warning("Single-flight owner did not finish in time, computing locally")
+                self.computed += 1
+                return await compute(), False
+            if not self.shareable(result):
+                self.computed += 1
+                return await compute(), False
+            self.shared += 1
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._futures[key] = future
+        try:
+            result, shared = await self._adistributed(key, compute)
+            future.set_result(result)
+            return result, shared
+        except BaseException as e:
+            if not future.done():
+                # A cancelled owner (e.g. a refresh task at shutdown) must still release its waiters
+                future.set_exception(e if isinstance(e, Exception) else FlightAbandoned())
+                # Mark the exception as retrieved when nobody else was waiting
+                future.exception()
+            raise
+        finally:
+            self._futures.pop(key, None)
+
+    async def _adistributed(self, key, compute):
+        if not Config.USE_REDIS:
+            self.computed += 1
+            return await compute(), False
+        lock_key, result_key = f"sf:lock:{key}", f"sf:result:{key}"
+        token = uuid.uuid4().hex
+        if await self.redis.set(lock_key, token, nx=True, px=Config.SINGLE_FLIGHT_LOCK_MS):
+            try:
+                self.computed += 1
+                result = await compute()
+                if self.shareable(result):
+                    await self.redis.setex(result_key, Config.SINGLE_FLIGHT_RESULT_SECONDS, json.dumps(result, ensure_ascii=False))
+                return result, False
+            finally:
+                await self.redis.eval(RELEASE_SCRIPT, 1, lock_key, token)
+
+        deadline = time.time() + wait_seconds()
+        while time.time() < deadline:
+            await asyncio.sleep(Config.SINGLE_FLIGHT_POLL_SECONDS)
+            value, locked = await self.redis.pipeline(transaction=False).get(result_key).exists(lock_key).execute()
+            if value:
+                self.shared += 1
+                return json.loads(value), True
+            if not locked:
+                break
+        logger.warning("Single-flight owner did not publish a result in time, computing locally")
+        self.computed += 1
+        return await compute(), False
+
+
+# Background refreshes of stale cache entries
+refresh_pool = ThreadPoolExecutor(max_workers=Config.CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
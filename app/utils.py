@@ -1,8 +1,20 @@
 import requests
 import openai
 import json
+import math
 import time
+import threading
+import contextvars
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from .clients import registry
 from .config import Config
+from .embedding_cache import embedding_cache, normalize_text
+from .semantic_cache import semantic_cache
+from .vector_store import get_local_store
+from .centroid_index import centroid_index, get_centroid_index
+from .metrics import CLASSIFY_PATHS, DEGRADED, record_usage, stage
+from .resilience import CircuitOpenError, DeadlineExceeded, breakers, remaining, stage_timeout
 import logging
 
 openai.api_key = Config.OPENAI_API_KEY
@@ -11,19 +23,264 @@ logger = logging.getLogger()
 
 logger.info("Application started and logging configured with Redis.")
 
+# A classification prompt, its numbered candidate labels and the legacy prompt's estimated size
+ClassifyPrompt = namedtuple("ClassifyPrompt", "messages labels legacy_tokens")
+
+# How classifications were resolved: "semantic", "centroid", "knn" (fast path) or "llm"
+path_counts = Counter()
+_path_lock = threading.Lock()
+
 def get_embedding(text):
+    with stage("embed"):
+        if Config.EMBEDDING_CACHE_ENABLED:
+            cached = embedding_cache.get(text)
+            if cached:
+                logger.debug("Embedding cache hit")
+                return cached
+        embedding = fetch_embedding(text)
+        if embedding and Config.EMBEDDING_CACHE_ENABLED:
+            embedding_cache.set(text, embedding)
+        return embedding
+
+def fetch_embedding(text):
     headers = {"Content-Type": "application/json; charset=utf-8"}
     payload = {"model": Config.OLLAMA_MODEL, "prompt": text}
     try:
-        response = requests.post(Config.OLLAMA_API_URL, headers=headers, json=payload, timeout=30)
+        # Each retry gets its share of the remaining budget
+        timeout = stage_timeout(Config.OLLAMA_TIMEOUT, attempts=Config.OLLAMA_MAX_RETRIES + 1)
+        breakers["ollama"].before_call()
+        response = registry.ollama.post(Config.OLLAMA_API_URL, headers=headers, json=payload, timeout=timeout)
         response.raise_for_status()
-        logger.info(f"Successfully fetched embedding for text: {text}")
-        return response.json().get("embedding", None)
+        embedding = response.json().get("embedding", None)
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        logger.warning(f"Skipping embedding request: {e}")
+        return None
     except requests.RequestException as e:
+        breakers["ollama"].failure()
         logger.error(f"Request failed: {e}")
         return None
+    breakers["ollama"].success()
+    logger.info(f"Successfully fetched embedding for text: {text}")
+    return embedding
+
+def get_embeddings(texts):
+    """Return embeddings for several texts, fetching only cache misses."""
+    with stage("embed"):
+        if not Config.EMBEDDING_CACHE_ENABLED:
+            return fetch_embeddings(texts)
+        embeddings = embedding_cache.get_many(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            fetched = fetch_embeddings([texts[i] for i in missing])
+            for i, embedding in zip(missing, fetched):
+                embeddings[i] = embedding
+            embedding_cache.set_many([texts[i] for i in missing], fetched)
+        return embeddings
+
+def fetch_embeddings(texts):
+    """Fetch embeddings for several texts with a single Ollama call."""
+    if not texts:
+        return []
+    headers = {"Content-Type": "application/json; charset=utf-8"}
+    payload = {"model": Config.OLLAMA_MODEL, "input": texts}
+    try:
+        timeout = stage_timeout(Config.OLLAMA_TIMEOUT, attempts=Config.OLLAMA_MAX_RETRIES + 1)
+        breakers["ollama"].before_call()
+        response = registry.ollama.post(Config.OLLAMA_EMBED_URL, headers=headers, json=payload, timeout=timeout)
+        response.raise_for_status()
+        embeddings = response.json().get("embeddings") or []
+        breakers["ollama"].success()
+        if len(embeddings) == len(texts):
+            logger.info(f"Successfully fetched {len(texts)} embeddings in one request")
+            return embeddings
+        logger.warning(f"Batch embedding returned {len(embeddings)} vectors for {len(texts)} texts")
+    except (DeadlineExceeded, CircuitOpenError) as e:
+        logger.warning(f"Skipping batch embedding request: {e}")
+        return [None] * len(texts)
+    except requests.RequestException as e:
+        breakers["ollama"].failure()
+        logger.error(f"Batch embedding request failed: {e}")
+
+    # Fall back to one request per text
+    return [fetch_embedding(text) for text in texts]
+
+def build_knn_query(embedding, k=None, num_candidates=None):
+    return {
+        "knn": {
+            "field": "embedding",
+            "query_vector": embedding,
+            "k": k or Config.KNN_K,
+            "num_candidates": num_candidates or Config.KNN_NUM_CANDIDATES
+        }
+    }
+
+def build_knn_search(embedding, k=None, num_candidates=None):
+    """Search body for the ``k`` nearest documents.
+
+    With ``KNN_OVERSAMPLE`` above 1 the kNN query over-fetches on the
+    quantized vectors and a rescore pass reorders the candidates by exact
+    cosine similarity on the float vectors, scaled like the kNN score.
+    """
+    k = k or Config.KNN_K
+    num_candidates = num_candidates or Config.KNN_NUM_CANDIDATES
+    if Config.KNN_OVERSAMPLE <= 1:
+        return {"query": build_knn_query(embedding, k, num_candidates), "size": k}
+    window = math.ceil(k * Config.KNN_OVERSAMPLE)
+    return {
+        "query": build_knn_query(embedding, window, max(num_candidates, window)),
+        "size": k,
+        "rescore": {
+            "window_size": window,
+            "query": {
+                "rescore_query": {
+                    "script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            "source": "(cosineSimilarity(params.query_vector, 'embedding') + 1.0) / 2",
+                            "params": {"query_vector": embedding}
+                        }
+                    }
+                },
+                "query_weight": 0,
+                "rescore_query_weight": 1
+            }
+        }
+    }
+
+def search_documents(embeddings, es):
+    """Run one kNN lookup per embedding on the configured retrieval backend.
+
+    Returns Elasticsearch-shaped responses in input order; a failed lookup is
+    returned as ``{"error": ...}``.
+    """
+    with stage("search"):
+        if Config.RETRIEVAL_BACKEND == "local":
+            return get_local_store(es).search_many(embeddings, Config.KNN_K)
+        timeout = stage_timeout(Config.ES_TIMEOUT)
+        client = es.options(request_timeout=timeout, retry_on_timeout=False) if remaining() is not None else es
+        if len(embeddings) == 1:
+            return [breakers["elasticsearch"].call(client.search, index=Config.ES_INDEX, body=build_knn_search(embeddings[0]))]
+        searches = []
+        for embedding in embeddings:
+            searches.append({"index": Config.ES_INDEX})
+            searches.append(build_knn_search(embedding))
+        return breakers["elasticsearch"].call(client.msearch, body=searches)["responses"]
+
+def hits_to_documents(response):
+    return [
+        {
+            "Category": hit["_source"].get("Category", ""),
+            "Sub-Category": hit["_source"].get("Sub-Category", ""),
+            "Description": hit["_source"].get("Description", ""),
+            "score": hit.get("_score") or 0.0
+        }
+        for hit in response["hits"]["hits"]
+    ]
+
+def knn_vote(documents):
+    """Score-weighted vote over the retrieved neighbours.
+
+    Returns ``(category, subcategory, agreement, score)`` for the winning
+    pair, where ``agreement`` is its share of the total score and ``score``
+    its best neighbour score, or ``None`` when there are no neighbours.
+    """
+    weights = Counter()
+    best = {}
+    for doc in documents:
+        label = (doc["Category"], doc["Sub-Category"])
+        weights[label] += doc["score"]
+        best[label] = max(best.get(label, 0.0), doc["score"])
+    total = sum(weights.values())
+    if not total:
+        return None
+    (category, subcategory), weight = weights.most_common(1)[0]
+    return category, subcategory, weight / total, best[(category, subcategory)]
+
+def fast_path_label(documents):
+    """Return the kNN vote when neighbours agree strongly enough to skip the LLM."""
+    if not Config.FAST_PATH_ENABLED or len(documents) < Config.FAST_PATH_MIN_NEIGHBORS:
+        return None
+    vote = knn_vote(documents)
+    if not vote:
+        return None
+    category, subcategory, agreement, score = vote
+    if agreement < Config.FAST_PATH_MIN_AGREEMENT or score < Config.FAST_PATH_MIN_SCORE:
+        return None
+    return (
+        {"category": category, "subcategory": subcategory},
+        {"path": "knn", "agreement": round(agreement, 4), "score": round(score, 4)}
+    )
+
+def centroid_label(embedding, es):
+    """Answer from the nearest-centroid index when ``CENTROID_MODE`` allows it."""
+    if Config.CENTROID_MODE not in ("first_stage", "only"):
+        return None
+    try:
+        with stage("centroid"):
+            ranked = get_centroid_index(es).score(embedding, top=2)
+    except Exception as e:
+        logger.error(f"Error scoring centroid index: {e}")
+        return None
+    if not ranked:
+        return None
+    (category, subcategory), similarity = ranked[0]
+    margin = similarity - ranked[1][1] if len(ranked) > 1 else similarity
+    if Config.CENTROID_MODE == "first_stage" and (
+            similarity < Config.CENTROID_MIN_SIMILARITY or margin < Config.CENTROID_MIN_MARGIN):
+        return None
+    return (
+        {"category": category, "subcategory": subcategory},
+        {"path": "centroid", "similarity": round(similarity, 4), "margin": round(margin, 4)}
+    )
+
+def valid_labels():
+    """Known (Category, Sub-Category) pairs used to constrain LLM output, if available."""
+    if Config.CENTROID_CONSTRAIN_LABELS and centroid_index.loaded:
+        return centroid_index.labels()
+    return None
+
+def count_path(path):
+    with _path_lock:
+        path_counts[path] += 1
+    CLASSIFY_PATHS.labels(path).inc()
+
+def path_stats():
+    with _path_lock:
+        total = sum(path_counts.values())
+        stats = dict(path_counts)
+    stats["fast_path_rate"] = round(stats.get("knn", 0) / total, 4) if total else 0.0
+    return stats
+
+def lookup_semantic(embedding):
+    """Return ``(result, similarity)`` from the semantic cache, or ``(None, similarity)``."""
+    if not Config.SEMANTIC_CACHE_ENABLED:
+        return None, 0.0
+    with stage("semantic"):
+        return semantic_cache.lookup(embedding)
+
+def remember_classification(embedding, result):
+    """Store an LLM classification in the semantic cache unless it failed."""
+    if Config.SEMANTIC_CACHE_ENABLED and result["category"] != "Unknown" and result["subcategory"] != "Unknown":
+        semantic_cache.add(embedding, result)
 
 def classify_text(query, es):
+    """Classify a query.
+
+    Returns ``(result, elapsed_time, info)`` where ``info["path"]`` tells
+    whether the result came from the semantic cache, the centroid index, the
+    kNN vote fast path or the LLM.
+    """
+    for event, data in classify_stages(query, es):
+        if event == "result":
+            return data
+
+def classify_stages(query, es):
+    """Run the classification pipeline, yielding ``(event, data)`` as each stage finishes.
+
+    Events are ``neighbors`` (the retrieved documents), ``provisional`` (the
+    kNN vote while the LLM is still working) and finally ``result`` with the
+    ``(result, elapsed_time, info)`` tuple of ``classify_text``.
+    """
     start_time = time.time()
     logger.debug(f"Classifying text: {query}")
     embedding = get_embedding(query)
@@ -31,42 +288,156 @@ def classify_text(query, es):
         logger.warning("Failed to generate query embedding")
         raise ValueError("Failed to generate query embedding")
 
-    search_query = {
-        "knn": {
-            "field": "embedding",
-            "query_vector": embedding,
-            "k": 5,
-            "num_candidates": 10
-        }
-    }
+    result, similarity = lookup_semantic(embedding)
+    if result:
+        elapsed_time = round(time.time() - start_time, 2)
+        logger.info(f"Semantic cache hit with similarity {similarity:.4f} in {elapsed_time} seconds")
+        count_path("semantic")
+        yield "result", (result, elapsed_time, {"path": "semantic", "similarity": round(similarity, 4)})
+        return
+
+    centroid = centroid_label(embedding, es)
+    if centroid:
+        result, info = centroid
+        count_path("centroid")
+        elapsed_time = round(time.time() - start_time, 2)
+        logger.info(f"Centroid match with similarity {info['similarity']} in {elapsed_time} seconds")
+        yield "result", (result, elapsed_time, info)
+        return
 
     try:
-        response = es.search(index="documents", body={"query": search_query})
-        documents = [
-            {
-                "Category": hit["_source"].get("Category", ""),
-                "Sub-Category": hit["_source"].get("Sub-Category", ""),
-                "Description": hit["_source"].get("Description", "")
-            }
-            for hit in response["hits"]["hits"]
-        ]
+        response = search_documents([embedding], es)[0]
+        documents = hits_to_documents(response)
         logger.debug(f"Found {len(documents)} documents for query")
     except Exception as e:
         logger.error(f"Error while searching Elasticsearch: {e}")
-        documents = []
+        yield "neighbors", []
+        result, info = search_failed_label(e)
+        count_path(info["path"])
+        yield "result", (result, round(time.time() - start_time, 2), info)
+        return
+    yield "neighbors", documents
+
+    fast_path = fast_path_label(documents)
+    if fast_path:
+        result, info = fast_path
+        remember_classification(embedding, result)
+        count_path("knn")
+        elapsed_time = round(time.time() - start_time, 2)
+        logger.info(f"Neighbours agree ({info['agreement']}, score {info['score']}), skipped LLM in {elapsed_time} seconds")
+        yield "result", (result, elapsed_time, info)
+        return
+
+    vote = knn_vote(documents)
+    if vote:
+        yield "provisional", vote
 
+    result, info = classify_or_degrade(query, documents)
+    if info["path"] == "llm":
+        remember_classification(embedding, result)
+    count_path(info["path"])
     elapsed_time = round(time.time() - start_time, 2)
-    category, subcategory = classify(query, documents)
     logger.info(f"Classification completed in {elapsed_time} seconds")
-    return {"category": category, "subcategory": subcategory}, elapsed_time
+    yield "result", (result, elapsed_time, info)
 
-def classify(query, documents):
+def classify_texts(queries, es, max_workers=None):
+    """Classify several queries as a pipeline.
+
+    All queries are embedded in one Ollama call and searched with one
+    Elasticsearch ``_msearch``; the LLM calls then run on a bounded pool.
+    Returns a list of ``(result, elapsed_time, info)`` tuples in input order;
+    ``info`` carries the path taken and an ``error`` message on failure.
+    """
+    start_time = time.time()
+    results = [None] * len(queries)
+
+    embeddings = get_embeddings(queries)
+    searchable = []
+    for i, embedding in enumerate(embeddings):
+        if not embedding:
+            logger.warning(f"Failed to generate query embedding for batch item {i}")
+            results[i] = (None, round(time.time() - start_time, 2), {"error": "Failed to generate query embedding"})
+            continue
+        result, similarity = lookup_semantic(embedding)
+        if result:
+            count_path("semantic")
+            results[i] = (result, round(time.time() - start_time, 2), {"path": "semantic", "similarity": round(similarity, 4)})
+            continue
+        centroid = centroid_label(embedding, es)
+        if centroid:
+            count_path("centroid")
+            results[i] = (centroid[0], round(time.time() - start_time, 2), centroid[1])
+        else:
+            searchable.append(i)
+
+    # One _msearch request (or one local matrix product) for all kNN lookups
+    documents = {i: [] for i in searchable}
+    failed = {}  # item -> error of its kNN lookup
+    if searchable:
+        try:
+            responses = search_documents([embeddings[i] for i in searchable], es)
+            for i, response in zip(searchable, responses):
+                if "error" in response:
+                    logger.error(f"Error while searching Elasticsearch for batch item {i}: {response['error']}")
+                    failed[i] = None
+                    continue
+                documents[i] = hits_to_documents(response)
+        except Exception as e:
+            logger.error(f"Error while running batch kNN search: {e}")
+            failed = dict.fromkeys(searchable, e)
+
+    # Confident neighbour votes skip the LLM
+    pending = []
+    for i in searchable:
+        if i in failed:
+            result, info = search_failed_label(failed[i])
+            count_path(info["path"])
+            results[i] = (result, round(time.time() - start_time, 2), info)
+            continue
+        fast_path = fast_path_label(documents[i])
+        if fast_path:
+            result, info = fast_path
+            remember_classification(embeddings[i], result)
+            count_path("knn")
+            results[i] = (result, round(time.time() - start_time, 2), info)
+        else:
+            pending.append(i)
+
+    def run(i):
+        result, info = classify_or_degrade(queries[i], documents[i])
+        if info["path"] == "llm":
+            remember_classification(embeddings[i], result)
+        return result, round(time.time() - start_time, 2), info
+
+    with ThreadPoolExecutor(max_workers=max_workers or Config.BATCH_MAX_WORKERS) as pool:
+        # Each call runs in a copy of this context so it sees the request's deadline
+        futures = {i: pool.submit(contextvars.copy_context().run, run, i) for i in pending}
+        for i, future in futures.items():
+            try:
+                result, elapsed_time, info = future.result()
+                count_path(info["path"])
+                results[i] = (result, elapsed_time, info)
+            except Exception as e:
+                logger.error(f"Error classifying batch item {i}: {e}")
+                results[i] = (None, round(time.time() - start_time, 2), {"error": str(e)})
+
+    logger.info(f"Batch classification of {len(queries)} queries completed in {round(time.time() - start_time, 2)} seconds")
+    return results
+
+def estimate_tokens(text):
+    """Rough token count; BPE tokenizers average about three UTF-8 bytes per token on Greek/English text."""
+    return -(-len(text.encode("utf-8")) // 3)
+
+def truncate(text, max_chars):
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars - 1].rstrip() + "…"
+
+def build_legacy_prompt(query, documents):
+    """The original free-text prompt, kept only to report the tokens the compact prompt saves."""
     context = [{"Category": doc["Category"], "Sub-Category": doc["Sub-Category"], "Description": doc["Description"]} for doc in documents]
-    
     existing_categories = list({doc["Category"] for doc in documents})
     existing_subcategories = list({doc["Sub-Category"] for doc in documents})
-
-    prompt = f"""
+    return f"""You are a strict classifier. Classify the query into one of the existing categories and subcategories.
     Classify the user query into one of the existing categories and subcategories:
     Categories: {existing_categories}
     Subcategories: {existing_subcategories}
@@ -82,36 +453,214 @@ def classify(query, documents):
     **Category**: [One of the existing categories]
     **Sub-Category**: [One of the existing subcategories]
     """
-    
+
+def build_classify_prompt(query, documents):
+    """Build a compact, token-budgeted prompt over the retrieved labels.
+
+    Labels are listed once and numbered; each example only carries its
+    label number and a truncated, de-duplicated description, added in score
+    order until ``LLM_PROMPT_TOKEN_BUDGET`` is reached. The model answers
+    ``{"label": <number>}``. Returns a ``ClassifyPrompt``.
+    """
+    labels = list(dict.fromkeys((doc["Category"], doc["Sub-Category"]) for doc in documents))
+    if not labels:
+        labels = sorted(valid_labels() or [])
+    numbers = {label: i for i, label in enumerate(labels, 1)}
+
+    system = ("You are a strict classifier. Pick the numbered label that fits the query. "
+              'Reply with JSON only: {"label": <number>}.')
+    header = "Labels:\n" + "\n".join(f"{i}. {category} / {subcategory}" for (category, subcategory), i in numbers.items())
+    footer = f"Query: {truncate(query, Config.LLM_QUERY_MAX_CHARS)}"
+    budget = Config.LLM_PROMPT_TOKEN_BUDGET - estimate_tokens(system + header + footer)
+
+    examples, seen = [], set()
+    for doc in sorted(documents, key=lambda doc: doc.get("score", 0.0), reverse=True):
+        description = truncate(doc["Description"], Config.LLM_CONTEXT_MAX_CHARS)
+        key = normalize_text(description).casefold()
+        if key in seen:
+            continue
+        line = f"[{numbers[(doc['Category'], doc['Sub-Category'])]}] {description}"
+        cost = estimate_tokens(line)
+        if cost > budget:
+            break
+        seen.add(key)
+        examples.append(line)
+        budget -= cost
+
+    user = header + ("\n\nExamples:\n" + "\n".join(examples) if examples else "") + "\n\n" + footer
+    messages = [{"role": "system", "content": system}, {"role": "user", "content": user}]
+    return ClassifyPrompt(messages, labels, estimate_tokens(build_legacy_prompt(query, documents)))
+
+def classification_request(prompt):
+    """Keyword arguments for ``ChatCompletion.create`` / ``acreate``."""
+    params = {
+        "model": Config.MODEL,
+        "messages": prompt.messages,
+        "max_tokens": Config.LLM_MAX_TOKENS,
+        "temperature": 0,
+    }
+    if Config.LLM_JSON_MODE:
+        params["response_format"] = {"type": "json_object"}
+    return params
+
+def read_classification(response, query, prompt):
+    """Log token usage (and the tokens saved over the legacy prompt) and parse the label."""
+    usage_info = response.get('usage', {})
+    logger.info(f"Response from OpenAI received for query: {query}")
+    logger.info(f"Total tokens used: {usage_info.get('total_tokens', 'N/A')}")
+    logger.info(f"Prompt tokens: {usage_info.get('prompt_tokens', 'N/A')}")
+    logger.info(f"Completion tokens: {usage_info.get('completion_tokens', 'N/A')}")
+    record_usage(usage_info)
+    content = response['choices'][0]['message']['content']
+    logger.debug(f"Response content: {content}")
+
+    category, subcategory = parse_label_response(content, prompt.labels)
+    # Both sides estimated the same way, so the difference is meaningful even if the estimate is not exact
+    prompt_tokens = estimate_tokens("".join(message["content"] for message in prompt.messages))
+    completion_tokens = estimate_tokens(content)
+    legacy_completion = estimate_tokens(f"**Category**: {category}\n**Sub-Category**: {subcategory}")
+    logger.info(
+        f"Tokens saved over the legacy prompt: prompt ~{prompt.legacy_tokens - prompt_tokens} of ~{prompt.legacy_tokens}, "
+        f"completion ~{legacy_completion - completion_tokens} of ~{legacy_completion}"
+    )
+    logger.info(f"Classification result: Category - {category}, Sub-Category - {subcategory}")
+    return category, subcategory
+
+def complete_classification(query, documents):
+    """Ask the LLM for a label; returns ``(category, subcategory, usage)``."""
+    timeout = stage_timeout(Config.OPENAI_TIMEOUT, minimum=Config.LLM_MIN_BUDGET_MS / 1000)
+    registry.openai  # Installs the pooled session for this process
+    prompt = build_classify_prompt(query, documents)
+    if not prompt.labels:
+        logger.warning("No candidate labels to classify against")
+        return "Unknown", "Unknown", {}
+    with stage("llm"):
+        response = breakers["openai"].call(openai.ChatCompletion.create, **classification_request(prompt), request_timeout=timeout)
+    category, subcategory = read_classification(response, query, prompt)
+    return category, subcategory, response.get('usage', {})
+
+def request_classification(query, documents):
+    """LLM label for a query; raises when the LLM is out of budget, unavailable or failing."""
+    if Config.LLM_BATCH_ENABLED:
+        from .llm_batch import llm_batcher
+        timeout = stage_timeout(Config.OPENAI_TIMEOUT, minimum=Config.LLM_MIN_BUDGET_MS / 1000)
+        future = llm_batcher.submit(query, documents)
+        with stage("llm"):
+            try:
+                return future.result(timeout=timeout)
+            except FutureTimeout:
+                # The request degrades now; keep the item out of a batch that has not been sent yet
+                future.cancel()
+                raise
+    category, subcategory, _ = complete_classification(query, documents)
+    return category, subcategory
+
+def degradation_reason(error):
+    left = remaining()
+    # A call cut short by the budget surfaces as a plain read timeout
+    if isinstance(error, (DeadlineExceeded, TimeoutError, FutureTimeout, openai.error.Timeout)) or (left is not None and left <= 0):
+        return "deadline"
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open"
+    return "llm_error"
+
+def degraded_label(documents, reason):
+    """Answer with the kNN majority label when the LLM cannot be used."""
+    DEGRADED.labels(reason).inc()
+    vote = knn_vote(documents)
+    if not vote:
+        logger.warning(f"LLM unavailable ({reason}) and no neighbours to vote")
+        return {"category": "Unknown", "subcategory": "Unknown"}, {"path": "degraded", "degraded": reason}
+    category, subcategory, agreement, score = vote
+    logger.warning(f"LLM unavailable ({reason}), answering with the kNN majority label")
+    return (
+        {"category": category, "subcategory": subcategory},
+        {"path": "knn_fallback", "degraded": reason, "agreement": round(agreement, 4), "score": round(score, 4)}
+    )
+
+def search_failed_label(error=None):
+    """Answer ``Unknown`` when the neighbours could not be retrieved.
+
+    Marked degraded like an LLM fallback, so the answer is neither cached
+    nor shared with single-flight waiters and the next request retries.
+    """
+    reason = degradation_reason(error) if error is not None else "llm_error"
+    reason = "search_error" if reason == "llm_error" else f"search_{reason}"
+    DEGRADED.labels(reason).inc()
+    logger.warning(f"No neighbours to classify against ({reason}), answering Unknown")
+    return {"category": "Unknown", "subcategory": "Unknown"}, {"path": "degraded", "degraded": reason}
+
+def classify_or_degrade(query, documents):
+    """Return ``(result, info)`` from the LLM, or from the kNN vote when it is too slow or failing."""
     try:
-        model = Config.MODEL
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[{"role": "system", "content": "You are a strict classifier. Classify the query into one of the existing categories and subcategories."}, {"role": "user", "content": prompt}]
-        )
-        
-        # Log the response details
-        usage_info = response.get('usage', {})
-        logger.info(f"Response from OpenAI received for query: {query}")
-        logger.info(f"Total tokens used: {usage_info.get('total_tokens', 'N/A')}")
-        logger.info(f"Prompt tokens: {usage_info.get('prompt_tokens', 'N/A')}")
-        logger.info(f"Completion tokens: {usage_info.get('completion_tokens', 'N/A')}")
-        logger.debug(f"Response content: {response['choices'][0]['message']['content']}")
-        
-        category, subcategory = parse_openai_response(response['choices'][0]['message']['content'])
-        logger.info(f"Classification result: Category - {category}, Sub-Category - {subcategory}")
+        category, subcategory = request_classification(query, documents)
+    except Exception as e:
+        reason = degradation_reason(e)
+        logger.error(f"Error in OpenAI classification ({reason}): {e}")
+        return degraded_label(documents, reason)
+    return {"category": category, "subcategory": subcategory}, {"path": "llm"}
+
+def classify(query, documents):
+    try:
+        category, subcategory = request_classification(query, documents)
     except Exception as e:
         logger.error(f"Error in OpenAI classification: {e}")
         category, subcategory = "Unknown", "Unknown"
 
     return category, subcategory
 
-def parse_openai_response(response_text):
+def parse_label_response(response_text, labels):
+    """Parse ``{"label": <number>}`` (or a category/subcategory object) against ``labels``.
+
+    Falls back to the legacy ``**Category**:`` lines; anything outside the
+    candidate labels becomes ``("Unknown", "Unknown")``.
+    """
+    text = response_text.strip().removeprefix("```json").strip("` \n")
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return parse_openai_response(response_text, labels)
+    if isinstance(data, dict) and "label" in data:
+        try:
+            number = int(data["label"])
+        except (TypeError, ValueError):
+            number = 0
+        if 1 <= number <= len(labels):
+            return labels[number - 1]
+        logger.warning(f"LLM returned a label number outside the candidates: {data['label']}")
+        return "Unknown", "Unknown"
+    if isinstance(data, dict) and "category" in data:
+        return match_label(str(data["category"]), str(data.get("subcategory", "")), labels)
+    logger.warning(f"Unexpected LLM response: {response_text}")
+    return "Unknown", "Unknown"
+
+def parse_openai_response(response_text, labels=None):
+    """Parse the model's Category/Sub-Category lines.
+
+    When ``labels`` is given, the pair must belong to that closed set
+    (compared case-insensitively, ignoring surrounding brackets); otherwise
+    ``("Unknown", "Unknown")`` is returned.
+    """
     try:
         lines = response_text.split("\n")
         category = next((line.split(":")[1].strip() for line in lines if line.startswith("**Category**")), "Unknown")
         subcategory = next((line.split(":")[1].strip() for line in lines if line.startswith("**Sub-Category**")), "Unknown")
+        if labels:
+            return match_label(category, subcategory, labels)
         return category, subcategory
     except Exception as e:
         logger.error(f"Error parsing response: {e}")
         return "Unknown", "Unknown"
+
+def match_label(category, subcategory, labels):
+    def key(value):
+        return " ".join(value.strip(" []*\"'").casefold().split())
+
+    if (category, subcategory) in labels:
+        return category, subcategory
+    wanted = (key(category), key(subcategory))
+    for label in labels:
+        if (key(label[0]), key(label[1])) == wanted:
+            return label
+    logger.warning(f"LLM returned a label outside the taxonomy: {category} / {subcategory}")
+    return "Unknown", "Unknown"
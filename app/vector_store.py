@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import numpy as np
+from .config import Config
+
+logger = logging.getLogger()
+
+SOURCE_FIELDS = ("Category", "Sub-Category", "Description")
+
+
+class LocalVectorStore:
+    """In-process kNN index over the ``documents`` reference set.
+
+    Embeddings are held L2-normalized in one contiguous float32 matrix, so a
+    top-k lookup is a single matrix product. The matrix is persisted as a
+    ``.npy`` snapshot (optionally memory-mapped on load) next to a JSON file
+    with the Category/Sub-Category/Description of every row.
+    """
+
+    def __init__(self, path, mmap=True, reload_interval=30):
+        self.path = path
+        self.mmap = mmap
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._documents = []
+        self._count = 0
+        self._mtime = None
+        self._checked = 0.0
+
+    @property
+    def vectors_path(self):
+        return f"{self.path}.npy"
+
+    @property
+    def metadata_path(self):
+        return f"{self.path}.json"
+
+    @property
+    def loaded(self):
+        return self._vectors is not None
+
+    def __len__(self):
+        return self._count
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def exists(self):
+        return os.path.exists(self.vectors_path) and os.path.exists(self.metadata_path)
+
+    def load(self):
+        vectors = np.load(self.vectors_path, mmap_mode="r" if self.mmap else None)
+        with open(self.metadata_path, "r", encoding="utf-8") as f:
+            documents = json.load(f)
+        if len(documents) != vectors.shape[0]:
+            raise ValueError(f"Snapshot {self.path} has {vectors.shape[0]} vectors but {len(documents)} documents")
+        with self._lock:
+            self._vectors = vectors
+            self._documents = documents
+            self._count = len(documents)
+            self._mtime = os.path.getmtime(self.vectors_path)
+        logger.info(f"Loaded local vector index with {self._count} documents from {self.path}")
+
+    def build(self, documents, embeddings):
+        vectors = self._normalize(embeddings) if documents else np.zeros((0, 0), dtype=np.float32)
+        with self._lock:
+            self._vectors = np.ascontiguousarray(vectors)
+            self._documents = [{field: doc.get(field, "") for field in SOURCE_FIELDS} for doc in documents]
+            self._count = len(documents)
+
+    def save(self):
+        """Write the snapshot atomically so other workers never read a partial file."""
+        with self._lock:
+            vectors = np.ascontiguousarray(self._vectors[:self._count])
+            documents = list(self._documents[:self._count])
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(f"{self.metadata_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(documents, f, ensure_ascii=False)
+        with open(f"{self.vectors_path}.tmp", "wb") as f:
+            np.save(f, vectors)
+        os.replace(f"{self.metadata_path}.tmp", self.metadata_path)
+        os.replace(f"{self.vectors_path}.tmp", self.vectors_path)
+        self._mtime = os.path.getmtime(self.vectors_path)
+        logger.info(f"Saved local vector index with {len(documents)} documents to {self.path}")
+
+    def reload_if_changed(self):
+        """Pick up a snapshot rebuilt by the sync command.
+
+        Appends made by this worker are dropped on reload; they are already in
+        Elasticsearch and therefore in the rebuilt snapshot.
+        """
+        now = time.time()
+        if now - self._checked < self.reload_interval:
+            return
+        self._checked = now
+        try:
+            if self.exists() and os.path.getmtime(self.vectors_path) != self._mtime:
+                self.load()
+        except Exception as e:
+            logger.error(f"Error reloading local vector index: {e}")
+
+    def append(self, document, embedding):
+        vector = self._normalize(embedding)
+        with self._lock:
+            if self._vectors is None or self._count == 0:
+                capacity = 16
+                grown = np.zeros((capacity, vector.shape[0]), dtype=np.float32)
+            elif vector.shape[0] != self._vectors.shape[1]:
+                raise ValueError(f"Embedding has {vector.shape[0]} dimensions, index has {self._vectors.shape[1]}")
+            elif self._count >= self._vectors.shape[0] or not self._vectors.flags.writeable:
+                # Memory-mapped snapshots are read-only; copy into a growable buffer
+                capacity = max(16, self._count * 2)
+                grown = np.zeros((capacity, self._vectors.shape[1]), dtype=np.float32)
+                grown[:self._count] = self._vectors[:self._count]
+            else:
+                grown = self._vectors
+            grown[self._count] = vector
+            self._documents = self._documents[:self._count] + [{field: document.get(field, "") for field in SOURCE_FIELDS}]
+            self._vectors = grown
+            self._count += 1
+
+    def search_many(self, embeddings, k):
+        """Return one Elasticsearch-shaped response per query embedding.
+
+        ``_score`` follows Elasticsearch's cosine scoring, ``(1 + cos) / 2``.
+        """
+        with self._lock:
+            matrix = self._vectors[:self._count] if self._vectors is not None else None
+            documents = self._documents
+        if matrix is None or matrix.shape[0] == 0:
+            return [{"hits": {"hits": []}} for _ in embeddings]
+
+        queries = self._normalize(embeddings)
+        scores = queries @ matrix.T
+        k = min(k, matrix.shape[0])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        responses = []
+        for row, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-row[candidates])]
+            responses.append({"hits": {"hits": [
+                {"_score": float((1.0 + row[j]) / 2.0), "_source": documents[j]} for j in ranked
+            ]}})
+        return responses
+
+    def search(self, embedding, k):
+        return self.search_many([embedding], k)[0]
+
+    def sync_from_es(self, es, index=None):
+        """Rebuild the snapshot from every document in the Elasticsearch index."""
+        from elasticsearch import helpers
+
+        documents, embeddings = [], []
+        for hit in helpers.scan(es, index=index or Config.ES_INDEX, query={"query": {"match_all": {}}},
+                                _source=list(SOURCE_FIELDS) + ["embedding"]):
+            source = hit["_source"]
+            if not source.get("embedding"):
+                continue
+            embeddings.append(source.pop("embedding"))
+            documents.append(source)
+        self.build(documents, embeddings)
+        self.save()
+        return len(documents)
+
+
+local_store = LocalVectorStore(Config.LOCAL_INDEX_PATH, Config.LOCAL_INDEX_MMAP, Config.LOCAL_INDEX_RELOAD_INTERVAL)
+_load_lock = threading.Lock()
+
+
+def get_local_store(es):
+    """Return the process-wide local store, loading or building its snapshot on first use."""
+    if not local_store.loaded:
+        with _load_lock:
+            if local_store.loaded:
+                return local_store
+            if local_store.exists():
+                local_store.load()
+            else:
+                logger.warning(f"No local vector snapshot at {local_store.path}, building it from Elasticsearch")
+                local_store.sync_from_es(es)
+    else:
+        local_store.reload_if_changed()
+    return local_store
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1].lower() != "sync":
+        print("Usage: python -m app.vector_store sync")
+        sys.exit(1)
+
+    from . import es
+    count = local_store.sync_from_es(es)
+    print(f"Local vector index rebuilt with {count} documents at {local_store.path}")
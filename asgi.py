@@ -0,0 +1,6 @@
+from app.asgi import create_asgi_app
+from run import app as flask_app
+
+# ASGI entry point: serves /api/classify and /api/memory asynchronously and
+# forwards every other route to the Flask app.
+app = create_asgi_app(flask_app)
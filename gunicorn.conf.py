@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+# Gunicorn loads this file automatically when started from the project root.
+# Every setting can be overridden on the command line or through the
+# environment variables below.
+
+_loaded_at = time.monotonic()
+
+# Prometheus multiprocess mode: workers write samples here and /api/metrics
+# merges them. It must be set before the app (and prometheus_client) is imported.
+prometheus_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.abspath("logs/prometheus"))
+# Samples from a previous run would be merged into the new totals. Cleared
+# here, before a preloaded app creates its metric files; a reload (HUP)
+# re-reads this file while workers are still writing, so only the first time.
+if not os.environ.get("PROMETHEUS_MULTIPROC_DIR_CLEARED"):
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR_CLEARED"] = "1"
+os.makedirs(prometheus_dir, exist_ok=True)
+
+from app.config import Config  # noqa: E402  (after PROMETHEUS_MULTIPROC_DIR)
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8001")
+
+# Import the app once in the master; workers fork with it loaded. Nothing
+# connects at import time and clients are created per process, so no socket
+# is shared across workers.
+preload_app = os.environ.get("GUNICORN_PRELOAD", "true").lower() == "true"
+
+# Classification mostly waits on Ollama, Elasticsearch and OpenAI: a few
+# processes per core, each with threads up to the Elasticsearch pool so a
+# thread never queues for a connection. Threads only apply to sync workers.
+workers = int(os.environ.get("WEB_CONCURRENCY") or min(multiprocessing.cpu_count() * 2 + 1, 12))
+threads = int(os.environ.get("GUNICORN_THREADS") or min(8, Config.ES_POOL_SIZE))
+
+# Long enough for the largest request budget clients may ask for
+timeout = int(os.environ.get("GUNICORN_TIMEOUT") or Config.REQUEST_BUDGET_MAX_MS / 1000 + 30)
+graceful_timeout = 30
+keepalive = 5
+
+
+def when_ready(server):
+    # Runs in the master before any worker is forked. Without preload_app the
+    # master must not import the app (workers would inherit it), so each
+    # worker creates the tables in post_worker_init instead.
+    if server.cfg.preload_app:
+        from run import app
+        from app import init_db
+        init_db(app)
+    server.log.info(f"Master ready in {time.monotonic() - _loaded_at:.2f}s "
+                    f"(preload_app={server.cfg.preload_app}, workers={server.cfg.workers}, threads={server.cfg.threads})")
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+    from app.clients import registry
+    registry.reset()
+    # A preloaded master may hold database connections from init_db
+    if "run" in sys.modules:
+        from app import db
+        with sys.modules["run"].app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+
+def post_worker_init(worker):
+    if not worker.cfg.preload_app:
+        from run import app
+        from app import init_db
+        init_db(app)
+    worker.log.info(f"Worker {worker.pid} ready {time.monotonic() - worker.forked_at:.2f}s after fork")
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,9 +1,13 @@
+import hashlib
 import os
+import secrets
 import sys
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from redis import Redis
+from app.config import Config
 
 app = Flask(__name__)
 
@@ -28,6 +32,17 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+# API key model (keys are stored as SHA-256 hashes; see app/auth.py)
+class ApiKey(db.Model):
+    __tablename__ = "api_key"
+    id = db.Column(db.Integer, primary_key=True)
+    prefix = db.Column(db.String(16), unique=True, nullable=False, index=True)
+    key_hash = db.Column(db.String(64), nullable=False)
+    username = db.Column(db.String(80), nullable=False)
+    name = db.Column(db.String(80))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    revoked_at = db.Column(db.DateTime)
+
 # Initialize database (this creates the database file if it doesn't exist)
 with app.app_context():
     db.create_all()
@@ -68,9 +83,14 @@ def delete_user(username, password=None):
 
     confirmation = input(f"Are you sure you want to delete user '{username}'? (yes/no): ")
     if confirmation.lower() == "yes":
+        # The user's keys must stop working with the account
+        keys = ApiKey.query.filter_by(username=username, revoked_at=None).all()
+        for key in keys:
+            key.revoked_at = datetime.utcnow()
         db.session.delete(user)
         db.session.commit()
-        print(f"User '{username}' deleted successfully.")
+        print(f"User '{username}' deleted successfully, {len(keys)} API keys revoked.")
+        notify_key_changes([key.prefix for key in keys])
     else:
         print("Deletion cancelled.")
 
@@ -82,11 +102,16 @@ def edit_user(username, new_username=None, new_password=None):
         return
 
     # Validate and set the new username
+    keys = []
     if new_username:
         if User.query.filter_by(username=new_username).first():
             print(f"Username '{new_username}' already exists.")
             return
         user.username = new_username
+        # Keys follow the account, so they never act as a later user of the old name
+        keys = ApiKey.query.filter_by(username=username).all()
+        for key in keys:
+            key.username = new_username
 
     # Set new password if provided
     if new_password:
@@ -94,11 +119,58 @@ def edit_user(username, new_username=None, new_password=None):
 
     db.session.commit()
     print(f"User '{username}' updated successfully.")
+    notify_key_changes([key.prefix for key in keys if not key.revoked_at])
+
+def add_key(username, name=None):
+    """Create an API key for a user and print it once."""
+    if not User.query.filter_by(username=username).first():
+        print(f"User '{username}' not found.")
+        return
+    prefix = secrets.token_hex(6)
+    key = f"{prefix}.{secrets.token_urlsafe(32)}"
+    db.session.add(ApiKey(prefix=prefix, key_hash=hashlib.sha256(key.encode("utf-8")).hexdigest(),
+                          username=username, name=name))
+    db.session.commit()
+    print(f"API key for '{username}' (shown only once, send it as {Config.API_KEY_HEADER}):")
+    print(key)
+
+def list_keys(username=None):
+    """List API keys, optionally of one user."""
+    query = ApiKey.query.filter_by(username=username) if username else ApiKey.query
+    keys = query.order_by(ApiKey.created_at).all()
+    if not keys:
+        print("No API keys found.")
+    for key in keys:
+        status = f"revoked {key.revoked_at}" if key.revoked_at else "active"
+        print(f"Prefix: {key.prefix}, Username: {key.username}, Name: {key.name or ''}, Created At: {key.created_at}, {status}")
+
+def revoke_key(prefix):
+    """Revoke an API key and tell running API processes to drop it from their caches."""
+    key = ApiKey.query.filter_by(prefix=prefix).first()
+    if not key:
+        print(f"API key '{prefix}' not found.")
+        return
+    if not key.revoked_at:
+        key.revoked_at = datetime.utcnow()
+        db.session.commit()
+    print(f"API key '{prefix}' revoked.")
+    notify_key_changes([prefix])
+
+def notify_key_changes(prefixes):
+    """Tell running API processes to drop these keys from their caches."""
+    if not prefixes:
+        return
+    try:
+        client = Redis.from_url(Config.REDIS_URL, socket_timeout=5)
+        for prefix in prefixes:
+            client.publish(Config.API_KEY_REVOCATION_CHANNEL, prefix)
+    except Exception as e:
+        print(f"Could not notify API processes ({e}); cached copies expire within {Config.API_KEY_CACHE_TTL}s.")
 
 # Main logic for handling command-line arguments
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python app.py [list|add|delete|edit]")
+        print("Usage: python app.py [list|add|delete|edit|add-key|list-keys|revoke-key]")
         sys.exit(1)
 
     command = sys.argv[1].lower()
@@ -148,7 +220,22 @@ if __name__ == "__main__":
                 sys.exit(1)
 
             edit_user(username, new_username, new_password)
+        elif command == "add-key":
+            if len(sys.argv) < 3:
+                print("Usage: python app.py add-key <username> [--name <label>]")
+                sys.exit(1)
+            name = None
+            if "--name" in sys.argv:
+                name = sys.argv[sys.argv.index("--name") + 1]
+            add_key(sys.argv[2], name)
+        elif command == "list-keys":
+            list_keys(sys.argv[2] if len(sys.argv) > 2 else None)
+        elif command == "revoke-key":
+            if len(sys.argv) != 3:
+                print("Usage: python app.py revoke-key <prefix>")
+                sys.exit(1)
+            revoke_key(sys.argv[2])
         else:
             print(f"Unknown command: {command}")
-            print("Usage: python app.py [list|add|delete|edit]")
+            print("Usage: python app.py [list|add|delete|edit|add-key|list-keys|revoke-key]")
             sys.exit(1)
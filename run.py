@@ -1,25 +1,15 @@
 import logging
-from app import create_app, db
-from app.config import Config
+from app import create_app, init_db
 from app.logger import setup_logging
 
 setup_logging()
 
 logger = logging.getLogger()
 
+# Tables are created by gunicorn's hooks (gunicorn.conf.py), the
+# ASGI lifespan startup or the __main__ block below, not on import.
 app = create_app()
 
-
-
-with app.app_context():
-    try:
-        db.create_all()
-        logger.info("Database and tables created successfully.")
-    except Exception as e:
-        print(f"Error creating database: {e}")
-
 if __name__ == "__main__" :
+    init_db(app)
     app.run()
-    
-
-    
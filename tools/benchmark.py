@@ -0,0 +1,442 @@
+"""Offline load test for the classify and memory endpoints.
+
+Ollama, Elasticsearch and OpenAI are replaced by local HTTP servers with
+configurable latency distributions, and Redis by fakeredis, so the whole
+request path (pooled clients, caches, rate limiter, retrieval, LLM call)
+runs without any external service. Requests are driven through
+``create_app()`` at the requested concurrency and cache-hit ratio, and the
+results are written as JSON so runs can be compared.
+
+Usage:
+    python tools/benchmark.py --requests 2000 --concurrency 16 --hit-ratio 0.5 \\
+        --latency ollama=lognormal:15:0.4 --latency openai=lognormal:600:0.5 --output run.json
+
+Latency specs are in milliseconds: ``fixed:MS``, ``uniform:LOW:HIGH``,
+``normal:MEAN:SD`` or ``lognormal:MEDIAN:SIGMA``. ``--set KEY=VALUE``
+overrides a ``Config`` setting (values are parsed as JSON when possible).
+Requires ``fakeredis`` (and ``lupa`` for the rate limiter script).
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EMBEDDING_DIMS = 768
+
+
+class Latency:
+    """A latency distribution parsed from a spec such as ``lognormal:20:0.5``."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        kind, *params = spec.split(":")
+        params = [float(param) for param in params]
+        samplers = {
+            "fixed": lambda: params[0],
+            "uniform": lambda: random.uniform(params[0], params[1]),
+            "normal": lambda: random.gauss(params[0], params[1]),
+            "lognormal": lambda: params[0] * math.exp(random.gauss(0, params[1])),
+        }
+        if kind not in samplers:
+            raise ValueError(f"Unknown latency distribution: {spec}")
+        self._sample = samplers[kind]
+
+    def sleep(self):
+        time.sleep(max(0.0, self._sample()) / 1000)
+
+
+class Corpus:
+    """Synthetic labeled documents whose vectors cluster around one centre per label.
+
+    Any text maps deterministically to a vector near one of the centres, so
+    repeated queries embed identically and nearest neighbours mostly agree.
+    """
+
+    def __init__(self, size, labels, noise, seed=0):
+        rng = np.random.default_rng(seed)
+        self.noise = noise
+        self.labels = [(f"Category {i % max(1, labels // 4)}", f"Subcategory {i}") for i in range(labels)]
+        self.centres = rng.standard_normal((labels, EMBEDDING_DIMS)).astype(np.float32)
+        self.lock = threading.Lock()
+        self.documents = []
+        vectors = []
+        for i in range(size):
+            text = f"Synthetic ticket {i}"
+            label = self.labels[i % labels]
+            self.documents.append({"Description": text, "Category": label[0], "Sub-Category": label[1]})
+            vectors.append(self.embed(text, i % labels))
+        self.vectors = np.asarray(vectors, dtype=np.float32)
+
+    def embed(self, text, label=None):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        rng = np.random.default_rng(seed)
+        if label is None:
+            label = seed % len(self.centres)
+        vector = self.centres[label] + self.noise * rng.standard_normal(EMBEDDING_DIMS).astype(np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def add(self, document, embedding):
+        with self.lock:
+            self.documents.append(document)
+            self.vectors = np.vstack([self.vectors, np.asarray([embedding], dtype=np.float32)])
+
+    def knn(self, embedding, k):
+        with self.lock:
+            vectors, documents = self.vectors, list(self.documents)
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        norms = np.linalg.norm(vectors, axis=1)
+        norms[norms == 0] = 1.0
+        similarities = vectors @ query / norms
+        top = np.argsort(-similarities)[:k]
+        return [
+            {"_index": "documents", "_id": str(i), "_score": float((1 + similarities[i]) / 2), "_source": documents[i]}
+            for i in top
+        ]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    routes = {}
+    latency = None
+    headers_out = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(200, None)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.latency:
+            self.latency.sleep()
+        path = self.path.split("?")[0]
+        for pattern, handler in self.routes.items():
+            if re.fullmatch(pattern, path):
+                status, payload = handler(body)
+                return self.respond(status, payload)
+        self.respond(404, {"error": f"No fake route for {method} {path}"})
+
+    def respond(self, status, payload):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in self.headers_out.items():
+            self.send_header(key, value)
+        try:
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. its request budget ran out
+            self.close_connection = True
+
+
+def start_server(routes, latency, headers=None):
+    handler = type("Handler", (FakeHandler,), {"routes": routes, "latency": latency, "headers_out": headers or {}})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def ollama_routes(corpus):
+    def embeddings(body):
+        return 200, {"embedding": corpus.embed(json.loads(body)["prompt"])}
+
+    def embed(body):
+        return 200, {"embeddings": [corpus.embed(text) for text in json.loads(body)["input"]]}
+
+    return {r"/api/embeddings": embeddings, r"/api/embed": embed}
+
+
+def elasticsearch_routes(corpus):
+    def knn_hits(request):
+        knn = request.get("knn") or request.get("query", {}).get("knn")
+        hits = corpus.knn(knn["query_vector"], knn.get("k", 10)) if knn else []
+        return {"took": 1, "timed_out": False, "hits": {"total": {"value": len(hits), "relation": "eq"}, "hits": hits}}
+
+    def ndjson(body):
+        return [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+
+    def search(body):
+        return 200, knn_hits(json.loads(body) if body else {})
+
+    def msearch(body):
+        lines = ndjson(body)
+        return 200, {"took": 1, "responses": [{**knn_hits(request), "status": 200} for request in lines[1::2]]}
+
+    def index(body):
+        document = json.loads(body)
+        corpus.add({key: value for key, value in document.items() if key != "embedding"}, document["embedding"])
+        return 201, {"_index": "documents", "_id": str(len(corpus.documents)), "result": "created"}
+
+    def bulk(body):
+        lines, items = ndjson(body), []
+        for action, document in zip(lines[::2], lines[1::2]):
+            corpus.add({key: value for key, value in document.items() if key != "embedding"}, document["embedding"])
+            items.append({"index": {"_index": "documents", "_id": str(len(corpus.documents)), "status": 201}})
+        return 200, {"took": 1, "errors": False, "items": items}
+
+    return {
+        r"/": lambda body: (200, {"version": {"number": "8.16.0"}, "tagline": "You Know, for Search"}),
+        r"/[^/_]+/_search": search,
+        r"/(?:[^/_]+/)?_msearch": msearch,
+        r"/[^/_]+/_doc": index,
+        r"/(?:[^/_]+/)?_bulk": bulk,
+        r"/[^/_]+/_refresh": lambda body: (200, {"_shards": {"total": 1, "successful": 1, "failed": 0}}),
+    }
+
+
+def openai_routes():
+    pattern = re.compile(r'"Category": "([^"]*)", "Sub-Category": "([^"]*)"')
+
+    def chat(body):
+        request = json.loads(body)
+        prompt = request["messages"][-1]["content"]
+        if "### Query" in prompt:
+            # Micro-batched prompt: one answer per numbered query
+            count = len(re.findall(r"^### Query \d+", prompt, re.MULTILINE))
+            content = json.dumps({"results": [{"id": i, "label": 1} for i in range(1, count + 1)]})
+        elif "Labels:" in prompt:
+            # Compact prompt: answer with the first (best-scored) candidate label
+            content = json.dumps({"label": 1})
+        else:
+            match = pattern.search(prompt)
+            category, subcategory = match.groups() if match else ("Unknown", "Unknown")
+            content = f"**Category**: {category}\n**Sub-Category**: {subcategory}"
+        prompt_tokens = sum(len(message["content"].encode("utf-8")) for message in request["messages"]) // 3
+        return 200, {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 12, "total_tokens": prompt_tokens + 12},
+        }
+
+    return {r"/v1/chat/completions": chat}
+
+
+def parse_server_timing(header):
+    stages = {}
+    for part in (header or "").split(","):
+        name, _, duration = part.strip().partition(";dur=")
+        if name and duration:
+            stages[name] = float(duration)
+    return stages
+
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    values = np.asarray(values)
+    return {
+        "count": int(values.size),
+        "mean": round(float(values.mean()), 3),
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3),
+        "p99": round(float(np.percentile(values, 99)), 3),
+        "max": round(float(values.max()), 3),
+    }
+
+
+def parse_overrides(items):
+    overrides = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            overrides[key] = json.loads(value)
+        except ValueError:
+            overrides[key] = value
+    return overrides
+
+
+def setup(args):
+    """Start the fake dependencies and return ``(flask_app, corpus, servers)``."""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("The benchmark needs fakeredis: pip install fakeredis lupa")
+
+    latency = {name: None for name in ("ollama", "elasticsearch", "openai")}
+    for item in args.latency:
+        name, _, spec = item.partition("=")
+        if name not in latency:
+            sys.exit(f"Unknown dependency for --latency: {name}")
+        latency[name] = Latency(spec)
+
+    corpus = Corpus(args.corpus_size, args.labels, args.noise, args.seed)
+    ollama, ollama_url = start_server(ollama_routes(corpus), latency["ollama"])
+    elastic, elastic_url = start_server(elasticsearch_routes(corpus), latency["elasticsearch"],
+                                        {"X-Elastic-Product": "Elasticsearch"})
+    llm, llm_url = start_server(openai_routes(), latency["openai"])
+
+    # Must be in place before the app package is imported
+    os.environ["ELASTICSEARCH_URL"] = elastic_url
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+    import openai
+    from app import create_app
+    from app.centroid_index import centroid_index
+    from app.clients import registry
+    from app.config import Config
+    from app.vector_store import local_store
+
+    for key, value in {
+        "OLLAMA_API_URL": f"{ollama_url}/api/embeddings",
+        "OLLAMA_EMBED_URL": f"{ollama_url}/api/embed",
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "RATE_LIMIT_MAX_REQUESTS": 10 ** 9,
+        **parse_overrides(args.set),
+    }.items():
+        setattr(Config, key, value)
+    openai.api_base = f"{llm_url}/v1"
+    openai.api_key = "benchmark"
+    registry._clients["redis"] = fakeredis.FakeRedis()
+
+    # Build the in-process indexes from the synthetic corpus, never from the real snapshots
+    scratch = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".benchmark")
+    os.makedirs(scratch, exist_ok=True)
+    local_store.path = os.path.join(scratch, "documents_index")
+    centroid_index.path = os.path.join(scratch, "centroids.npz")
+    if Config.RETRIEVAL_BACKEND == "local":
+        local_store.build(corpus.documents, corpus.vectors)
+    if Config.CENTROID_MODE in ("first_stage", "only"):
+        centroid_index.build(corpus.documents, corpus.vectors)
+
+    return create_app(), corpus, (ollama, elastic, llm)
+
+
+def run(args):
+    flask_app, corpus, servers = setup(args)
+    from flask_jwt_extended import create_access_token
+
+    with flask_app.app_context():
+        headers = {"Authorization": f"Bearer {create_access_token(identity='benchmark')}"}
+    rng = random.Random(args.seed)
+    hot_queries = [f"Hot query {i}" for i in range(args.hot_queries)]
+    counter = iter(range(10 ** 12))
+    lock = threading.Lock()
+    local = threading.local()
+
+    def next_request():
+        with lock:
+            n = next(counter)
+            draw = rng.random()
+            if draw < args.memory_ratio:
+                return "memory", {
+                    "Category": corpus.labels[n % len(corpus.labels)][0],
+                    "Subcategory": corpus.labels[n % len(corpus.labels)][1],
+                    "Description": f"Remembered ticket {n}",
+                }
+            if hot_queries and rng.random() < args.hit_ratio:
+                return "classify", {"query": rng.choice(hot_queries)}
+            return "classify", {"query": f"Unique query {n}"}
+
+    def send(kind, body):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = flask_app.test_client()
+        start = time.perf_counter()
+        response = client.post(f"/api/{kind}", json=body, headers=headers)
+        elapsed = (time.perf_counter() - start) * 1000
+        return kind, response, elapsed
+
+    # Warm the hot set so hit-ratio requests really hit the cache
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(lambda query: send("classify", {"query": query}), hot_queries))
+
+    latencies, by_endpoint = [], defaultdict(list)
+    stages, statuses, cached = defaultdict(list), Counter(), Counter()
+
+    def worker(count):
+        results = []
+        for _ in range(count):
+            results.append(send(*next_request()))
+        return results
+
+    share = [args.requests // args.concurrency + (i < args.requests % args.concurrency) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        batches = list(pool.map(worker, share))
+    duration = time.perf_counter() - start
+
+    for kind, response, elapsed in (result for batch in batches for result in batch):
+        latencies.append(elapsed)
+        by_endpoint[kind].append(elapsed)
+        statuses[str(response.status_code)] += 1
+        if kind == "classify" and response.status_code == 200:
+            cached[response.get_json().get("cached", "false")] += 1
+        for name, duration_ms in parse_server_timing(response.headers.get("Server-Timing")).items():
+            stages[name].append(duration_ms)
+
+    for server in servers:
+        server.shutdown()
+
+    errors = sum(count for status, count in statuses.items() if not status.startswith("2"))
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 2) if duration else 0.0,
+        "latency_ms": summarize(latencies),
+        "endpoints": {kind: summarize(values) for kind, values in by_endpoint.items()},
+        "status_codes": dict(statuses),
+        "cached": dict(cached),
+        "stages_ms": {name: summarize(values) for name, values in sorted(stages.items())},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test /api/classify and /api/memory against local fakes.")
+    parser.add_argument("--requests", type=int, default=1000, help="Measured requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--hit-ratio", type=float, default=0.5, help="Share of classify requests for cached queries")
+    parser.add_argument("--hot-queries", type=int, default=50, help="Distinct cached queries")
+    parser.add_argument("--memory-ratio", type=float, default=0.0, help="Share of requests sent to /api/memory")
+    parser.add_argument("--corpus-size", type=int, default=2000, help="Documents in the fake index")
+    parser.add_argument("--labels", type=int, default=40, help="Distinct Category/Sub-Category pairs")
+    parser.add_argument("--noise", type=float, default=1.0, help="Spread of vectors around their label centre")
+    parser.add_argument("--latency", action="append", default=[], metavar="DEPENDENCY=SPEC",
+                        help="Latency of ollama, elasticsearch or openai, e.g. openai=lognormal:500:0.5")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="Override a Config setting")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = run(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"{report['requests']} requests in {report['duration_s']}s, {report['throughput_rps']} req/s, "
+              f"p50 {report['latency_ms'].get('p50')} ms, p99 {report['latency_ms'].get('p99')} ms")
+    else:
+        print(output)
@@ -0,0 +1,135 @@
+"""Measure how long the API takes to start.
+
+Each measurement runs in a fresh interpreter with every dependency pointed at
+a closed port, so a start that still waited on the network would show up as
+a slow or failed run:
+
+    import            time to ``import run`` (the app object is ready)
+    first_request     import plus the first ``/api/healthz`` through the test client
+    gunicorn          launch of ``gunicorn -c gunicorn.conf.py run:app`` until
+                      ``/api/healthz`` answers, with and without ``preload_app``
+
+``/api/readyz`` is called once the server is up and is expected to answer 503
+quickly, since nothing is reachable.
+
+Usage:
+    python tools/coldstart.py --runs 5 --workers 4 --output coldstart.json
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Nothing listens on port 9 (discard), so every dependency is down
+UNREACHABLE = {
+    "ELASTICSEARCH_URL": "http://127.0.0.1:9",
+    "REDIS_URL": "redis://127.0.0.1:9/0",
+    "OLLAMA_API_URL": "http://127.0.0.1:9/api/embeddings",
+}
+
+IMPORT_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import run
+imported = time.perf_counter()
+response = run.app.test_client().get("/api/healthz")
+print(json.dumps({"import": imported - start, "first_request": time.perf_counter() - start, "status": response.status_code}))
+"""
+
+
+def environment(**extra):
+    return {**os.environ, **UNREACHABLE, **extra}
+
+
+def summary(values):
+    return {
+        "runs": len(values),
+        "median_s": round(statistics.median(values), 3),
+        "min_s": round(min(values), 3),
+        "max_s": round(max(values), 3),
+    }
+
+
+def measure_import(runs):
+    imports, first_requests = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT], cwd=ROOT, env=environment(),
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if result["status"] != 200:
+            sys.exit(f"/api/healthz answered {result['status']} after import")
+        imports.append(result["import"])
+        first_requests.append(result["first_request"])
+    return {"import": summary(imports), "first_request": summary(first_requests)}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def get(url):
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def measure_gunicorn(runs, workers, preload, timeout):
+    ready, readyz = [], []
+    for _ in range(runs):
+        port = free_port()
+        base = f"http://127.0.0.1:{port}/api"
+        start = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "run:app",
+             "--bind", f"127.0.0.1:{port}", "--workers", str(workers)],
+            cwd=ROOT, env=environment(GUNICORN_PRELOAD=str(preload).lower()),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            while True:
+                if time.perf_counter() - start > timeout:
+                    sys.exit(f"gunicorn did not answer /api/healthz within {timeout}s")
+                try:
+                    if get(f"{base}/healthz") == 200:
+                        break
+                except OSError:
+                    time.sleep(0.01)
+            ready.append(time.perf_counter() - start)
+            probe_start = time.perf_counter()
+            status = get(f"{base}/readyz")
+            readyz.append({"status": status, "ms": round((time.perf_counter() - probe_start) * 1000, 1)})
+        finally:
+            server.terminate()
+            server.wait()
+    return {"preload_app": preload, "workers": workers, "healthz": summary(ready), "readyz": readyz}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure cold-start time of the API.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4, help="Gunicorn workers")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for gunicorn")
+    parser.add_argument("--skip-gunicorn", action="store_true")
+    parser.add_argument("--output", help="Write the JSON report here as well")
+    args = parser.parse_args()
+
+    report = measure_import(args.runs)
+    if not args.skip_gunicorn:
+        report["gunicorn"] = [measure_gunicorn(args.runs, args.workers, preload, args.timeout) for preload in (True, False)]
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
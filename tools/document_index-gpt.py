@@ -1,11 +1,30 @@
+import argparse
 import json
 import hashlib
-from elasticsearch import Elasticsearch
+import os
+import sys
+import time
+from elasticsearch import Elasticsearch, helpers
 import openai
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Config
+
 # Elasticsearch configuration
 es_host = "http://192.168.7.10:9200"  # Replace with your Elasticsearch host
-index_name = "documents_index"
+# Not Config.ES_INDEX: these 1536-dim OpenAI vectors cannot be searched with the API's Ollama embeddings
+index_name = Config.ES_GPT_INDEX
+
+# Batch sizes for existence checks, embedding requests and bulk writes
+MGET_BATCH_SIZE = 1000
+EMBED_BATCH_SIZE = 100
+BULK_CHUNK_SIZE = 500
+
+# Vector index: "hnsw" keeps float32 vectors in the graph; the quantized types
+# keep the floats on disk only, for rescoring (see KNN_OVERSAMPLE in the API)
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw")
+EMBEDDING_DIMS = 1536  # Must match the embedding model's dimensions
 
 # OpenAI API Key
 openai.api_key = "your_open_ai_api_key"
@@ -16,7 +35,7 @@ es = Elasticsearch([es_host])
 # Ensure Elasticsearch index exists
 
 
-def create_index_if_not_exists():
+def create_index_if_not_exists(index_type="hnsw", m=16, ef_construction=100):
     mapping = {
         "mappings": {
             "properties": {
@@ -26,7 +45,10 @@ def create_index_if_not_exists():
                 "hash": {"type": "keyword"},
                 "embedding": {
                     "type": "dense_vector",
-                    "dims": 1536  # Ensure this matches the embedding model's dimensions
+                    "dims": EMBEDDING_DIMS,
+                    "index": True,
+                    "similarity": "cosine",
+                    "index_options": {"type": index_type, "m": m, "ef_construction": ef_construction}
                 }
             }
         }
@@ -34,7 +56,7 @@ def create_index_if_not_exists():
 
     if not es.indices.exists(index=index_name):
         es.indices.create(index=index_name, body=mapping)
-        print(f"Created Elasticsearch index: {index_name}")
+        print(f"Created Elasticsearch index: {index_name} ({index_type}, m={m}, ef_construction={ef_construction})")
     else:
         print(f"Elasticsearch index {index_name} already exists.")
 
@@ -45,93 +67,130 @@ def generate_document_hash(doc):
     hash_source = f"{doc['Description']}{doc['Category']}{doc['Sub-Category']}"
     return hashlib.md5(hash_source.encode()).hexdigest()
 
-# Check if the document is already indexed and unchanged
+# Return the subset of document ids already present in the index
 
 
-def is_document_unchanged(doc):
-    doc_hash = generate_document_hash(doc)
-    search_query = {
-        "query": {
-            "term": {
-                "hash": doc_hash
-            }
-        }
-    }
+def existing_document_ids(ids):
+    existing = set()
+    for start in range(0, len(ids), MGET_BATCH_SIZE):
+        batch = ids[start:start + MGET_BATCH_SIZE]
+        response = es.mget(index=index_name, ids=batch, source=False)
+        existing.update(doc["_id"] for doc in response["docs"] if doc.get("found"))
+    return existing
 
-    try:
-        response = es.search(index=index_name, body=search_query)
-        return response['hits']['total']['value'] > 0
-    except Exception as e:
-        print(f"Error checking document hash in Elasticsearch: {e}")
-        return False
+# Generate embeddings for a batch of texts using the OpenAI Python 1.0.0 API
 
-# Generate embeddings using OpenAI Python 1.0.0 API
 
-
-def get_embedding(text):
+def get_embeddings(texts):
     try:
-        # Request embedding using OpenAI's embeddings API
+        # The embeddings API accepts a list of inputs and returns one item per input
         response = openai.embeddings.create(
             model="text-embedding-ada-002",  # You can change the model if needed
-            input=text
+            input=texts
         )
-        # Correct way to access the embedding data
-        # This accesses the embedding from the first item in the data list
-        return response.data[0].embedding
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
     except Exception as e:
-        print(f"Error generating embedding for text: {text[:30]}...: {e}")
-        return None
-
-# Index document into Elasticsearch
+        print(f"Error generating embeddings for {len(texts)} texts: {e}")
+        return [None] * len(texts)
+
+# Build bulk actions for new or changed documents, embedding them in batches
+
+
+def generate_actions(docs, failed):
+    for start in range(0, len(docs), EMBED_BATCH_SIZE):
+        batch = docs[start:start + EMBED_BATCH_SIZE]
+        embeddings = get_embeddings([doc["Description"] for doc in batch])
+        for doc, embedding in zip(batch, embeddings):
+            if embedding is None:
+                print(f"Failed to generate embedding for document: {doc['Description']}")
+                failed.append(doc)
+                continue
+            doc_hash = generate_document_hash(doc)
+            yield {
+                "_op_type": "index",
+                "_index": index_name,
+                # The content hash is the id, so a re-run replaces instead of duplicating
+                "_id": doc_hash,
+                "_source": {
+                    "Description": doc["Description"],
+                    "Category": doc["Category"],
+                    "Sub-Category": doc["Sub-Category"],
+                    "hash": doc_hash,
+                    "embedding": embedding
+                }
+            }
 
+# Delete indexed documents whose id is no longer produced by the source file: removed
+# documents, the previous version of changed ones, and documents indexed under
+# auto-generated ids before ids were content hashes
 
-def index_document_with_embedding(doc):
-    embedding = get_embedding(doc['Description'])
-    if embedding is None:
-        print(
-            f"Failed to generate embedding for document: {doc['Description']}")
-        return
-
-    doc_with_embedding = {
-        "Description": doc["Description"],
-        "Category": doc["Category"],
-        "Sub-Category": doc["Sub-Category"],
-        "hash": generate_document_hash(doc),
-        "embedding": embedding
-    }
 
-    try:
-        es.index(index=index_name, body=doc_with_embedding)
-        print(f"Successfully indexed document: {doc['Description']}")
-    except Exception as e:
-        print(f"Error indexing document {doc['Description']}: {e}")
+def delete_removed_documents(keep_ids):
+    stale = (
+        hit["_id"]
+        for hit in helpers.scan(es, index=index_name, query={"query": {"match_all": {}}}, source=False)
+        if hit["_id"] not in keep_ids
+    )
+    actions = ({"_op_type": "delete", "_index": index_name, "_id": doc_id} for doc_id in stale)
+    deleted, errors = helpers.bulk(es, actions, chunk_size=BULK_CHUNK_SIZE, raise_on_error=False)
+    if errors:
+        print(f"Failed to delete {len(errors)} removed documents.")
+    return deleted
 
-# Process documents from JSON file and index them
+# Process documents from JSON file and index the new or changed ones
 
 
-def process_documents_on_startup():
+def process_documents_on_startup(path="documents.json", delete_removed=True):
+    start_time = time.time()
     try:
-        with open("documents.json", "r", encoding="utf-8") as file:
+        with open(path, "r", encoding="utf-8") as file:
             documents = json.load(file)
-            # Adjusted to use "dataset" key
-            for doc in documents.get("dataset", []):
-                try:
-                    if not is_document_unchanged(doc):
-                        index_document_with_embedding(doc)
-                        print(f"Indexed document: {doc['Description']}")
-                    else:
-                        print(
-                            f"Document unchanged, skipping: {doc['Description']}")
-                except Exception as e:
-                    print(
-                        f"Error processing document {doc['Description']}: {e}")
     except FileNotFoundError:
-        print("documents.json file not found. No documents indexed.")
+        print(f"{path} file not found. No documents indexed.")
+        return
     except Exception as e:
-        print(f"Error reading documents.json: {e}")
+        print(f"Error reading {path}: {e}")
+        return
+
+    # Identical documents share a hash, so keep one of each
+    by_id = {}
+    for doc in documents.get("dataset", []):
+        by_id.setdefault(generate_document_hash(doc), doc)
+    ids = list(by_id)
+
+    existing = existing_document_ids(ids)
+    pending = [by_id[doc_id] for doc_id in ids if doc_id not in existing]
+    print(f"{len(ids)} documents, {len(existing)} unchanged, {len(pending)} to index.")
+
+    failed = []
+    indexed, errors = helpers.bulk(es, generate_actions(pending, failed), chunk_size=BULK_CHUNK_SIZE,
+                                   max_retries=3, raise_on_error=False)
+    for error in errors:
+        print(f"Error indexing document: {error}")
+
+    deleted = 0
+    if delete_removed and (failed or errors):
+        # The superseded copy is the only one left of a document that failed
+        print("Some documents failed; superseded documents are kept until a run indexes everything.")
+    elif delete_removed:
+        deleted = delete_removed_documents(set(ids))
+    es.indices.refresh(index=index_name)
+    print(f"Indexed {indexed} documents, deleted {deleted}, {len(failed) + len(errors)} failed "
+          f"in {time.time() - start_time:.1f}s.")
 
 
 # Main startup process
 if __name__ == "__main__":
-    create_index_if_not_exists()
-    process_documents_on_startup()
+    parser = argparse.ArgumentParser(description="Embed new or changed documents with OpenAI and index them.")
+    parser.add_argument("path", nargs="?", default="documents.json")
+    parser.add_argument("--keep-removed", action="store_true",
+                        help="Keep indexed documents that are no longer in the source file (by default they, "
+                             "the previous versions of changed documents and documents with pre-hash ids are deleted)")
+    parser.add_argument("--index-type", choices=VECTOR_INDEX_TYPES, default="hnsw",
+                        help="Vector storage of a new index; quantized types need KNN_OVERSAMPLE > 1 to rescore")
+    parser.add_argument("--m", type=int, default=16, help="HNSW neighbours per node")
+    parser.add_argument("--ef-construction", type=int, default=100, help="HNSW candidates while building the graph")
+    args = parser.parse_args()
+
+    create_index_if_not_exists(args.index_type, args.m, args.ef_construction)
+    process_documents_on_startup(args.path, delete_removed=not args.keep_removed)
@@ -1,20 +1,50 @@
-import requests
+import argparse
 import json
-from elasticsearch import Elasticsearch
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from elasticsearch import Elasticsearch, helpers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.config import Config
 
 # Elasticsearch setup
-es = Elasticsearch(["http://localhost:9200"])
+es = Elasticsearch(["http://localhost:9200"], connections_per_node=10, request_timeout=30)
+# The API reads and writes this alias; --recreate builds a new "<alias>_v<timestamp>" index
+# behind it and swaps the alias once the index is loaded and warm
+INDEX_NAME = Config.ES_INDEX
+KEEP_VERSIONS = 2  # Previous versions kept for --rollback
+REPLAY_MARGIN_MS = 60 * 1000  # Clock skew allowed between the API hosts and this machine
+WARMUP_QUERIES = 20  # kNN searches run on a new index before it takes traffic
 
 # Ollama API setup
 OLLAMA_API_URL = "http://localhost:11434/api/embeddings"
 OLLAMA_MODEL = "paraphrase-multilingual"
+EMBEDDING_DIMS = 768
+
+# Pipeline settings
+EMBED_WORKERS = 8  # Concurrent embedding requests
+BULK_CHUNK_SIZE = 500  # Documents per bulk request
+CHECKPOINT_EVERY = 1000  # Documents between checkpoint writes
+READ_CHUNK_SIZE = 64 * 1024  # Bytes read from the dataset file at a time
+
+# Vector index: "hnsw" keeps float32 vectors in the graph; the quantized types
+# keep the floats on disk only, for rescoring (see KNN_OVERSAMPLE in the API)
+VECTOR_INDEX_TYPES = ("hnsw", "int8_hnsw", "int4_hnsw", "bbq_hnsw")
+
+# Reuse keep-alive connections to Ollama instead of one TCP connection per document
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=EMBED_WORKERS))
 
 
 def get_embedding(text):
     headers = {"Content-Type": "application/json"}
     payload = {"model": OLLAMA_MODEL, "prompt": text}
     try:
-        response = requests.post(
+        response = session.post(
             OLLAMA_API_URL, headers=headers, json=payload, timeout=30)
         response.raise_for_status()
         response_json = response.json()
@@ -27,55 +57,361 @@ def get_embedding(text):
         return None
 
 
-def create_index():
+def vector_mapping(index_type="hnsw", m=16, ef_construction=100):
+    return {
+        "type": "dense_vector",
+        "dims": EMBEDDING_DIMS,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": {"type": index_type, "m": m, "ef_construction": ef_construction}
+    }
+
+
+def create_index(name, index_type="hnsw", m=16, ef_construction=100, bulk=False):
     index_mapping = {
         "mappings": {
             "properties": {
                 "Description": {"type": "text"},
                 "Category": {"type": "keyword"},
                 "Sub-Category": {"type": "keyword"},
-                "embedding": {
-                    "type": "dense_vector",
-                    "dims": 768  # Replace with correct dimensions
-                }
+                "indexed_at": {"type": "date", "format": "epoch_millis"},  # Set by /memory
+                "embedding": vector_mapping(index_type, m, ef_construction)
             }
         }
     }
-    # Delete index if it exists
-    es.indices.delete(index="documents", ignore=[400, 404])
-    es.indices.create(index="documents", body=index_mapping, ignore=400)
-
-
-def index_documents(data):
-    for i, doc in enumerate(data["dataset"]):
-        description = doc["Description"]
-        category = doc["Category"]
-        sub_category = doc["Sub-Category"]
-
-        # Generate embedding
-        embedding = get_embedding(description)
-        # Replace 768 with actual dimensions
-        if not embedding or len(embedding) != 768:
-            print(f"Skipping document {i} due to invalid embedding.")
-            continue
+    if bulk:
+        # No refreshes or replicas while loading; finish_build() restores them
+        index_mapping["settings"] = {"index": {"refresh_interval": "-1", "number_of_replicas": 0}}
+    es.indices.create(index=name, body=index_mapping)
+    print(f"Created index {name} ({index_type}, m={m}, ef_construction={ef_construction}).")
+
+
+def versioned_name():
+    return f"{INDEX_NAME}_v{time.strftime('%Y%m%d%H%M%S')}"
+
+
+def live_indices():
+    """Indices behind the alias, or the alias name itself while it is still a plain index."""
+    if es.indices.exists_alias(name=INDEX_NAME):
+        return sorted(es.indices.get_alias(name=INDEX_NAME))
+    if es.indices.exists(index=INDEX_NAME):
+        return [INDEX_NAME]
+    return []
+
+
+def versions():
+    return sorted(es.indices.get(index=f"{INDEX_NAME}_v*", expand_wildcards="open"))
+
+
+def ensure_index(index_type="hnsw", m=16, ef_construction=100):
+    """Create the first version and point the alias at it when there is nothing to index into."""
+    if live_indices():
+        return
+    name = versioned_name()
+    create_index(name, index_type, m, ef_construction)
+    es.indices.put_alias(index=name, name=INDEX_NAME)
+    print(f"Alias {INDEX_NAME} -> {name}.")
+
+
+def creation_millis(name):
+    return int(es.indices.get_settings(index=name)[name]["settings"]["index"]["creation_date"])
+
+
+def finish_build(name, replicas):
+    """Bring a bulk-loaded index to serving shape: refreshes, replicas, one segment."""
+    es.indices.put_settings(index=name, body={"index": {"refresh_interval": None, "number_of_replicas": replicas}})
+    es.indices.refresh(index=name)
+    # Fewer segments means fewer HNSW graphs to search per query
+    es.indices.forcemerge(index=name, max_num_segments=1, request_timeout=3600)
+    es.cluster.health(index=name, wait_for_status="yellow", timeout="5m", request_timeout=330)
+
+
+def warm_index(name):
+    """Run kNN searches with stored vectors so the graph is in the page cache before the swap."""
+    response = es.search(index=name, size=WARMUP_QUERIES, source=["embedding"],
+                         query={"function_score": {"random_score": {}}})
+    took = []
+    for hit in response["hits"]["hits"]:
+        result = es.search(index=name, size=Config.KNN_K, source=False, knn={
+            "field": "embedding", "query_vector": hit["_source"]["embedding"],
+            "k": Config.KNN_K, "num_candidates": Config.KNN_NUM_CANDIDATES})
+        took.append(result["took"])
+    if took:
+        print(f"Warmed {name} with {len(took)} searches ({sum(took) / len(took):.0f} ms average, last {took[-1]} ms).")
+
+
+def replay_writes(sources, dest, since):
+    """Copy /memory documents written to ``sources`` since ``since`` (epoch ms) into ``dest``."""
+    response = es.reindex(body={
+        "conflicts": "proceed",
+        "source": {"index": sources, "query": {"range": {"indexed_at": {"gte": since}}}},
+        # Already copied documents keep their id, so a second replay skips them
+        "dest": {"index": dest, "op_type": "create"},
+    }, refresh=True, wait_for_completion=True, request_timeout=3600)
+    return response.get("created", 0)
+
+
+def swap_alias(name, live):
+    """Point the alias at ``name`` in one atomic request."""
+    actions = [{"add": {"index": name, "alias": INDEX_NAME}}]
+    if live == [INDEX_NAME]:
+        # The alias name is taken by a plain index, which can only be removed in the same request
+        actions.insert(0, {"remove_index": {"index": INDEX_NAME}})
+        print(f"Replacing the unversioned index {INDEX_NAME}; it cannot be kept for rollback.")
+    else:
+        actions[:0] = [{"remove": {"index": index, "alias": INDEX_NAME}} for index in live]
+    es.indices.update_aliases(body={"actions": actions})
+    print(f"Alias {INDEX_NAME} -> {name}.")
+
+
+def prune_versions(keep):
+    """Delete versions beyond the ``keep`` most recent ones not behind the alias."""
+    live = live_indices()
+    previous = [name for name in versions() if name not in live]
+    for name in previous[:max(len(previous) - keep, 0)]:
+        es.indices.delete(index=name)
+        print(f"Deleted old index {name}.")
 
-        document = {
-            "Description": description,
-            "Category": category,
-            "Sub-Category": sub_category,
-            "embedding": embedding
+
+def promote(name, keep):
+    """Swap the alias to a built index, replaying /memory writes that reached the old one meanwhile."""
+    live = live_indices()
+    if live:
+        replay_start = int(time.time() * 1000)
+        replayed = replay_writes(live, name, creation_millis(name) - REPLAY_MARGIN_MS)
+        swap_alias(name, live)
+        if live != [INDEX_NAME]:
+            # Writes that resolved the alias before the swap may land in the old index just after it
+            replayed += replay_writes(live, name, replay_start - REPLAY_MARGIN_MS)
+        print(f"Replayed {replayed} documents written during the rebuild.")
+    else:
+        swap_alias(name, live)
+    prune_versions(keep)
+
+
+def rollback():
+    """Point the alias back at the previous version, with the documents written since the switch."""
+    live = live_indices()
+    older = [name for name in versions() if live and name < live[0]]
+    if not older:
+        sys.exit("No previous version to roll back to.")
+    previous = older[-1]
+    replay_start = int(time.time() * 1000)
+    replayed = replay_writes(live, previous, creation_millis(live[0]) - REPLAY_MARGIN_MS)
+    swap_alias(previous, live)
+    replayed += replay_writes(live, previous, replay_start - REPLAY_MARGIN_MS)
+    print(f"Rolled back to {previous} and replayed {replayed} documents; {', '.join(live)} kept.")
+
+
+def iter_dataset(path):
+    """Yield the objects of the top-level "dataset" array without loading the whole file."""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        position = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, position, eof
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        def skip_whitespace():
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                fill()
+
+        # Find the start of the dataset array
+        while True:
+            start = buffer.find('"dataset"', position)
+            if start != -1:
+                position = start + len('"dataset"')
+                break
+            if eof:
+                raise ValueError(f"No \"dataset\" array in {path}")
+            position = max(0, len(buffer) - len('"dataset"'))
+            fill()
+        for expected in ":[":
+            skip_whitespace()
+            if position >= len(buffer) or buffer[position] != expected:
+                raise ValueError(f"Malformed \"dataset\" array in {path}")
+            position += 1
+
+        while True:
+            skip_whitespace()
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                doc, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            position = end
+            yield doc
+            skip_whitespace()
+            if position < len(buffer) and buffer[position] == ",":
+                position += 1
+
+
+def embed_documents(docs, skip, retry=()):
+    """Yield ``(position, doc, embedding)`` in input order with bounded concurrency.
+
+    Documents before ``skip`` are passed over unless their position is in ``retry``.
+    """
+    def embed(item):
+        position, doc = item
+        return position, doc, get_embedding(doc["Description"])
+
+    pending = []
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        for position, doc in enumerate(docs):
+            if position < skip and position not in retry:
+                continue
+            pending.append(pool.submit(embed, (position, doc)))
+            # Keep at most a few batches in flight so memory stays flat
+            if len(pending) >= EMBED_WORKERS * 4:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+def generate_actions(embedded, skipped, index):
+    for position, doc, embedding in embedded:
+        if not embedding or len(embedding) != EMBEDDING_DIMS:
+            print(f"Skipping document {position} due to invalid embedding.")
+            skipped.append(position)
+            continue
+        yield {
+            "_index": index,
+            "_id": position,
+            "_source": {
+                "Description": doc["Description"],
+                "Category": doc["Category"],
+                "Sub-Category": doc["Sub-Category"],
+                "embedding": embedding
+            }
         }
 
-        try:
-            es.index(index="documents", id=i, document=document)
-            print(f"Document {i} indexed successfully.")
-        except Exception as e:
-            print(f"Failed to index document {i}: {e}")
+
+def read_checkpoint(path):
+    """Return the last checkpoint: ``position``, the earlier ``retry`` positions that failed or were
+    skipped, ``index`` and the index's original ``refresh_interval``."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_checkpoint(path, position, retry, index, refresh_interval):
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump({"position": position, "retry": sorted(retry), "index": index,
+                   "refresh_interval": refresh_interval}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def index_documents(path, checkpoint_path, index, resume=False):
+    checkpoint = read_checkpoint(checkpoint_path) if resume else {}
+    skip = checkpoint.get("position", 0)
+    # Documents before the checkpoint that failed or were skipped are sent again
+    retry = set(checkpoint.get("retry", []))
+    if skip:
+        print(f"Resuming after document {skip - 1}, retrying {len(retry)} earlier documents.")
+
+    # Disable refreshes for the duration of the load. A run killed mid-load leaves "-1"
+    # behind, so a resumed run restores the value saved by the first one.
+    if "refresh_interval" in checkpoint and checkpoint.get("index") == index:
+        refresh_interval = checkpoint["refresh_interval"]
+    else:
+        settings = next(iter(es.indices.get_settings(index=index).values()))["settings"]["index"]
+        refresh_interval = settings.get("refresh_interval")
+    if refresh_interval == "-1":
+        refresh_interval = None  # The default; finish_build() restores new versions the same way
+    write_checkpoint(checkpoint_path, skip, retry, index, refresh_interval)
+    es.indices.put_settings(index=index, body={"index": {"refresh_interval": "-1"}})
+
+    start_time = time.time()
+    indexed, failed, skipped = 0, [], []
+    position = skip
+    try:
+        actions = generate_actions(embed_documents(iter_dataset(path), skip, retry), skipped, index)
+        for ok, item in helpers.streaming_bulk(es, actions, chunk_size=BULK_CHUNK_SIZE,
+                                               raise_on_error=False, max_retries=3):
+            result = item["index"]
+            done = int(result["_id"])
+            position = max(position, done + 1)
+            if ok:
+                indexed += 1
+                retry.discard(done)
+            else:
+                failed.append(done)
+                print(f"Failed to index document {result['_id']}: {result.get('error')}")
+            if (indexed + len(failed)) % CHECKPOINT_EVERY == 0:
+                write_checkpoint(checkpoint_path, position, retry.union(failed, skipped), index, refresh_interval)
+                elapsed = time.time() - start_time
+                print(f"{indexed} documents indexed, {indexed / elapsed:.1f} docs/sec.")
+    finally:
+        es.indices.put_settings(index=index, body={"index": {"refresh_interval": refresh_interval}})
+        es.indices.refresh(index=index)
+
+    write_checkpoint(checkpoint_path, position, retry.union(failed, skipped), index, refresh_interval)
+    elapsed = time.time() - start_time
+    print(f"Indexed {indexed} documents in {elapsed:.1f}s ({indexed / max(elapsed, 1e-9):.1f} docs/sec), "
+          f"{len(failed)} failed, {len(skipped)} skipped.")
+    # A document whose embedding failed is as missing from the index as one the bulk request rejected
+    return not failed and not skipped
 
 
 if __name__ == "__main__":
-    with open("documents.json", "r", encoding="utf-8") as f:
-        data = json.load(f)
-    create_index()
-    index_documents(data)
+    parser = argparse.ArgumentParser(description="Embed documents.json with Ollama and bulk index them.")
+    parser.add_argument("path", nargs="?", default="documents.json")
+    parser.add_argument("--recreate", action="store_true",
+                        help="Build a new index version and swap the alias to it without downtime")
+    parser.add_argument("--rollback", action="store_true", help="Point the alias back at the previous version")
+    parser.add_argument("--keep", type=int, default=KEEP_VERSIONS, help="Previous versions kept for rollback")
+    parser.add_argument("--resume", action="store_true", help="Continue from the last checkpoint")
+    parser.add_argument("--checkpoint", default=".document_index.checkpoint")
+    parser.add_argument("--index-type", choices=VECTOR_INDEX_TYPES, default="hnsw",
+                        help="Vector storage of a new index; quantized types need KNN_OVERSAMPLE > 1 to rescore")
+    parser.add_argument("--m", type=int, default=16, help="HNSW neighbours per node")
+    parser.add_argument("--ef-construction", type=int, default=100, help="HNSW candidates while building the graph")
+    args = parser.parse_args()
+
+    if args.rollback:
+        rollback()
+        sys.exit(0)
+
+    if not args.recreate:
+        ensure_index(args.index_type, args.m, args.ef_construction)
+        if not index_documents(args.path, args.checkpoint, INDEX_NAME, resume=args.resume):
+            sys.exit("Some documents failed or were skipped. Rerun with --resume to retry them.")
+        print("All documents indexed successfully!")
+        sys.exit(0)
+
+    # Keep serving from the current version until the new one is complete
+    name = read_checkpoint(args.checkpoint).get("index") if args.resume else None
+    if not name or not es.indices.exists(index=name) or name in live_indices():
+        if args.resume:
+            print("No unfinished build to resume; starting a new one.")
+            args.resume = False
+        name = versioned_name()
+        create_index(name, args.index_type, args.m, args.ef_construction, bulk=True)
+    live = live_indices()
+    replicas = next(iter(es.indices.get_settings(index=live[0]).values()))["settings"]["index"]["number_of_replicas"] \
+        if live else 1
+    if not index_documents(args.path, args.checkpoint, name, resume=args.resume):
+        sys.exit(f"Some documents failed or were skipped; {INDEX_NAME} still points at {', '.join(live) or 'nothing'}. "
+                 f"Rerun with --recreate --resume to finish {name}.")
+    finish_build(name, replicas)
+    warm_index(name)
+    promote(name, args.keep)
     print("All documents indexed successfully!")
@@ -0,0 +1,207 @@
+"""Leave-one-out evaluation of retrieval and classification settings.
+
+Every document of a labeled dataset (the ``documents.json`` format) is
+classified from its neighbours with itself removed, for each combination of
+``k``, ``num_candidates``, retrieval backend and classification mode:
+
+    vote    label of the score-weighted kNN vote, no LLM call
+    hybrid  the production path: kNN vote fast path, LLM otherwise
+    llm     always ask the LLM
+
+The report gives accuracy against retrieval/LLM latency and token cost per
+configuration and recommends the fastest one within ``--tolerance`` of the
+best accuracy. Put the chosen values in ``KNN_K`` / ``KNN_NUM_CANDIDATES``.
+
+Usage:
+    python tools/evaluate.py tools/documents.json --k 3,5,10 --num-candidates 10,50,100 \\
+        --backends local,elasticsearch --modes vote,hybrid,llm --limit 500 --output eval.json
+
+Embeddings come from Ollama and are cached next to the dataset. The
+``elasticsearch`` backend queries the ``documents`` index, which must hold the
+same dataset (see document_index-ollama.py); ``local`` is an exact in-process
+search, so ``num_candidates`` does not apply to it.
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+from itertools import product
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import es
+from app.config import Config
+from app.utils import build_knn_search, complete_classification, fast_path_label, fetch_embeddings, hits_to_documents, knn_vote
+from app.vector_store import LocalVectorStore
+
+EMBED_BATCH_SIZE = 64
+
+
+def load_dataset(path, limit, seed):
+    with open(path, "r", encoding="utf-8") as f:
+        documents = [doc for doc in json.load(f).get("dataset", []) if doc.get("Description")]
+    queries = list(range(len(documents)))
+    if limit and limit < len(queries):
+        queries = sorted(random.Random(seed).sample(queries, limit))
+    return documents, queries
+
+
+def load_embeddings(path, documents):
+    """Embed the dataset once per model and dataset, reusing the cached vectors after that."""
+    digest = hashlib.sha256(json.dumps([Config.OLLAMA_MODEL] + [doc["Description"] for doc in documents],
+                                       ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+    cache_path = f"{os.path.splitext(path)[0]}.{digest}.embeddings.npy"
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    embeddings = []
+    for start in range(0, len(documents), EMBED_BATCH_SIZE):
+        batch = [doc["Description"] for doc in documents[start:start + EMBED_BATCH_SIZE]]
+        fetched = fetch_embeddings(batch)
+        if not all(fetched):
+            sys.exit(f"Failed to embed documents {start}-{start + len(batch) - 1}; is Ollama running?")
+        embeddings.extend(fetched)
+        print(f"Embedded {len(embeddings)}/{len(documents)} documents", file=sys.stderr)
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    np.save(cache_path, embeddings)
+    return embeddings
+
+
+def without_self(documents, held_out, k):
+    """Drop the held-out document from its own neighbours and keep the top ``k``."""
+    for i, doc in enumerate(documents):
+        if doc["Description"] == held_out["Description"]:
+            return documents[:i] + documents[i + 1:k + 1]
+    return documents[:k]
+
+
+def retrieve(backend, store, embedding, k, num_candidates):
+    # One extra neighbour, since the held-out document finds itself first
+    if backend == "local":
+        return hits_to_documents(store.search(embedding, k + 1))
+    response = es.search(index=Config.ES_INDEX, body=build_knn_search(embedding.tolist(), k + 1, max(num_candidates, k + 1)))
+    return hits_to_documents(response)
+
+
+def evaluate(config, documents, queries, embeddings, store):
+    backend, mode, k, num_candidates = config
+    correct = category_correct = llm_calls = prompt_tokens = completion_tokens = errors = 0
+    retrieval_ms, llm_ms = [], []
+
+    for i in queries:
+        held_out = documents[i]
+        start = time.perf_counter()
+        neighbours = without_self(retrieve(backend, store, embeddings[i], k, num_candidates), held_out, k)
+        retrieval_ms.append((time.perf_counter() - start) * 1000)
+
+        if mode == "vote":
+            vote = knn_vote(neighbours)
+            category, subcategory = vote[:2] if vote else ("Unknown", "Unknown")
+        else:
+            fast_path = fast_path_label(neighbours) if mode == "hybrid" else None
+            if fast_path:
+                category, subcategory = fast_path[0]["category"], fast_path[0]["subcategory"]
+            else:
+                start = time.perf_counter()
+                try:
+                    category, subcategory, usage = complete_classification(held_out["Description"], neighbours)
+                except Exception as e:
+                    print(f"LLM call failed for document {i}: {e}", file=sys.stderr)
+                    category, subcategory, usage = "Unknown", "Unknown", {}
+                    errors += 1
+                llm_ms.append((time.perf_counter() - start) * 1000)
+                llm_calls += 1
+                prompt_tokens += usage.get("prompt_tokens", 0)
+                completion_tokens += usage.get("completion_tokens", 0)
+
+        category_correct += category == held_out["Category"]
+        correct += (category, subcategory) == (held_out["Category"], held_out["Sub-Category"])
+
+    count = len(queries)
+    retrieval_ms = np.asarray(retrieval_ms)
+    return {
+        "backend": backend,
+        "mode": mode,
+        "k": k,
+        "num_candidates": num_candidates if backend == "elasticsearch" else None,
+        "queries": count,
+        "accuracy": round(correct / count, 4),
+        "category_accuracy": round(category_correct / count, 4),
+        "retrieval_ms_p50": round(float(np.percentile(retrieval_ms, 50)), 3),
+        "retrieval_ms_p95": round(float(np.percentile(retrieval_ms, 95)), 3),
+        "llm_ms_mean": round(float(np.mean(llm_ms)), 1) if llm_ms else 0.0,
+        "llm_call_rate": round(llm_calls / count, 4),
+        "prompt_tokens_per_query": round(prompt_tokens / count, 1),
+        "completion_tokens_per_query": round(completion_tokens / count, 1),
+        "llm_errors": errors,
+        # Expected end-to-end cost per query, used to rank configurations
+        "latency_ms_per_query": round(float(np.mean(retrieval_ms)) + sum(llm_ms) / count, 3),
+    }
+
+
+def configurations(args):
+    seen = set()
+    for backend, mode, k, num_candidates in product(args.backends, args.modes, args.k, args.num_candidates):
+        if num_candidates < k and backend == "elasticsearch":
+            continue
+        if backend == "local":
+            num_candidates = None
+        if (backend, mode, k, num_candidates) not in seen:
+            seen.add((backend, mode, k, num_candidates))
+            yield backend, mode, k, num_candidates
+
+
+def recommend(results, tolerance):
+    best = max(result["accuracy"] for result in results)
+    eligible = [result for result in results if result["accuracy"] >= best - tolerance]
+    return min(eligible, key=lambda result: (result["latency_ms_per_query"], result["prompt_tokens_per_query"]))
+
+
+def integers(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def names(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Leave-one-out sweep over kNN and classification settings.")
+    parser.add_argument("path", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "documents.json"))
+    parser.add_argument("--k", type=integers, default=[3, 5, 10])
+    parser.add_argument("--num-candidates", type=integers, default=[10, 50, 100])
+    parser.add_argument("--backends", type=names, default=["local"], help="local and/or elasticsearch")
+    parser.add_argument("--modes", type=names, default=["vote", "hybrid"], help="vote, hybrid and/or llm")
+    parser.add_argument("--limit", type=int, default=0, help="Evaluate a random sample of this many documents")
+    parser.add_argument("--tolerance", type=float, default=0.005, help="Accuracy loss accepted for a faster setting")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here as well")
+    args = parser.parse_args()
+
+    documents, queries = load_dataset(args.path, args.limit, args.seed)
+    if len(documents) < 2:
+        sys.exit(f"{args.path} needs at least two labeled documents")
+    embeddings = load_embeddings(args.path, documents)
+    store = LocalVectorStore(os.devnull, mmap=False)
+    store.build(documents, embeddings)
+
+    results = []
+    for config in configurations(args):
+        result = evaluate(config, documents, queries, embeddings, store)
+        results.append(result)
+        print(f"{result['backend']:<13} {result['mode']:<6} k={result['k']:<3} "
+              f"num_candidates={str(result['num_candidates']):<5} accuracy={result['accuracy']:.4f} "
+              f"latency={result['latency_ms_per_query']:.1f}ms tokens={result['prompt_tokens_per_query']:.0f}",
+              file=sys.stderr)
+
+    report = {"dataset": args.path, "documents": len(documents), "queries": len(queries),
+              "results": results, "recommended": recommend(results, args.tolerance)}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report["recommended"], ensure_ascii=False, indent=2))
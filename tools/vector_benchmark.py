@@ -0,0 +1,203 @@
+"""Compare vector index types on memory, latency and recall@k.
+
+The same vectors are loaded into one scratch index per type (``hnsw`` is the
+float32 baseline; ``int8_hnsw``, ``int4_hnsw`` and ``bbq_hnsw`` are
+quantized), force-merged to one segment, and queried with the API's own
+search body (``build_knn_search``) at each ``--oversample`` factor. For each
+run the report gives:
+
+    memory      estimated off-heap bytes per million vectors (vector data plus
+                HNSW graph, from the Elasticsearch sizing guide) and the
+                measured on-disk size of the vector field
+    latency     client-side p50/p95 and the mean of Elasticsearch's ``took``
+    recall@k    overlap with the exact cosine top-k computed in NumPy
+
+Usage:
+    python tools/vector_benchmark.py --synthetic 100000 --queries 200 --oversample 1,2,3 --output vectors.json
+    python tools/vector_benchmark.py --embeddings tools/documents.<digest>.embeddings.npy
+
+Put the chosen oversample factor in ``KNN_OVERSAMPLE`` and build the
+production index with ``document_index-ollama.py --index-type``.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from elasticsearch import helpers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import es
+from app.config import Config
+from app.utils import build_knn_search
+
+INDEX_PREFIX = "documents_bench_"
+BULK_CHUNK_SIZE = 500
+
+# Bytes per vector held in memory for search, besides the HNSW graph
+VECTOR_BYTES = {
+    "hnsw": lambda dims: 4 * dims,
+    "int8_hnsw": lambda dims: dims + 4,
+    "int4_hnsw": lambda dims: dims / 2 + 4,
+    "bbq_hnsw": lambda dims: dims / 8 + 14,
+}
+
+
+def synthetic_vectors(count, dims, clusters, seed):
+    """Unit vectors grouped around ``clusters`` centres, like embeddings of labelled documents."""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dims))
+    vectors = centres[rng.integers(clusters, size=count)] + rng.normal(scale=0.8, size=(count, dims))
+    return normalize(vectors.astype(np.float32))
+
+
+def normalize(vectors):
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors, count, seed):
+    """Perturbed copies of random documents, so a query never matches a document exactly."""
+    rng = np.random.default_rng(seed + 1)
+    picks = vectors[rng.choice(len(vectors), size=count, replace=len(vectors) < count)]
+    return normalize(picks + rng.normal(scale=0.02, size=picks.shape).astype(np.float32))
+
+
+def exact_neighbours(vectors, queries, k):
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, k, axis=1)[:, :k]
+    return [set(row) for row in top]
+
+
+def estimated_memory(index_type, dims, m):
+    """Off-heap bytes per million vectors: vector data plus 4 bytes per HNSW link."""
+    return int(1_000_000 * (VECTOR_BYTES[index_type](dims) + 4 * m))
+
+
+def create_index(name, index_type, dims, m, ef_construction):
+    es.indices.delete(index=name, ignore_unavailable=True)
+    es.indices.create(index=name, body={
+        "settings": {"number_of_shards": 1, "number_of_replicas": 0, "refresh_interval": "-1"},
+        "mappings": {"properties": {"embedding": {
+            "type": "dense_vector",
+            "dims": dims,
+            "index": True,
+            "similarity": "cosine",
+            "index_options": {"type": index_type, "m": m, "ef_construction": ef_construction}
+        }}}
+    })
+
+
+def load(name, vectors):
+    start = time.perf_counter()
+    actions = ({"_index": name, "_id": str(i), "_source": {"embedding": vector.tolist()}}
+               for i, vector in enumerate(vectors))
+    helpers.bulk(es, actions, chunk_size=BULK_CHUNK_SIZE, request_timeout=120)
+    es.indices.refresh(index=name)
+    es.indices.forcemerge(index=name, max_num_segments=1, request_timeout=3600)
+    return time.perf_counter() - start
+
+
+def disk_usage(name):
+    usage = es.indices.disk_usage(index=name, run_expensive_tasks=True)
+    index = usage.get(name, {})
+    field = index.get("fields", {}).get("embedding", {})
+    return {
+        "store_bytes": index.get("store_size_in_bytes"),
+        "vector_field_bytes": field.get("total_in_bytes"),
+        "knn_vectors_bytes": field.get("knn_vectors_in_bytes"),
+    }
+
+
+def search(name, queries, exact, k, num_candidates, oversample):
+    Config.KNN_OVERSAMPLE = oversample
+    for query in queries[:10]:  # Warm up the graph and page cache
+        es.search(index=name, body={**build_knn_search(query.tolist(), k, num_candidates), "_source": False})
+
+    latencies, took, recalls = [], [], []
+    for query, truth in zip(queries, exact):
+        start = time.perf_counter()
+        response = es.search(index=name, body={**build_knn_search(query.tolist(), k, num_candidates), "_source": False})
+        latencies.append((time.perf_counter() - start) * 1000)
+        took.append(response["took"])
+        found = {int(hit["_id"]) for hit in response["hits"]["hits"][:k]}
+        recalls.append(len(found & truth) / k)
+    return {
+        "oversample": oversample,
+        "latency_ms_p50": round(float(np.percentile(latencies, 50)), 2),
+        "latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+        "took_ms_mean": round(float(np.mean(took)), 2),
+        f"recall@{k}": round(float(np.mean(recalls)), 4),
+    }
+
+
+def floats(value):
+    return [float(item) for item in value.split(",") if item]
+
+
+def names(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark quantized vector index types against float32 HNSW.")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--embeddings", help="A .npy matrix of document vectors, e.g. from evaluate.py")
+    source.add_argument("--synthetic", type=int, default=50000, help="Number of random clustered vectors")
+    parser.add_argument("--dims", type=int, default=768, help="Dimensions of synthetic vectors")
+    parser.add_argument("--clusters", type=int, default=200, help="Label clusters of synthetic vectors")
+    parser.add_argument("--types", type=names, default=list(VECTOR_BYTES), help="Index types to compare")
+    parser.add_argument("--oversample", type=floats, default=[1, 2, 3], help="Factors tried on quantized types")
+    parser.add_argument("--k", type=int, default=Config.KNN_K)
+    parser.add_argument("--num-candidates", type=int, default=Config.KNN_NUM_CANDIDATES)
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=100)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch indexes")
+    parser.add_argument("--output", help="Write the JSON report here as well")
+    args = parser.parse_args()
+
+    unknown = set(args.types) - set(VECTOR_BYTES)
+    if unknown:
+        sys.exit(f"Unknown index types: {', '.join(sorted(unknown))}")
+    vectors = normalize(np.load(args.embeddings).astype(np.float32)) if args.embeddings else \
+        synthetic_vectors(args.synthetic, args.dims, args.clusters, args.seed)
+    count, dims = vectors.shape
+    queries = make_queries(vectors, args.queries, args.seed)
+    exact = exact_neighbours(vectors, queries, args.k)
+
+    results = []
+    for index_type in args.types:
+        name = INDEX_PREFIX + index_type
+        create_index(name, index_type, dims, args.m, args.ef_construction)
+        try:
+            load_seconds = load(name, vectors)
+            result = {
+                "index_type": index_type,
+                "load_s": round(load_seconds, 1),
+                "memory_bytes_per_million": estimated_memory(index_type, dims, args.m),
+                **disk_usage(name),
+                # The float32 baseline is measured as it is served today, without oversampling
+                "runs": [search(name, queries, exact, args.k, args.num_candidates, oversample)
+                         for oversample in (args.oversample if index_type != "hnsw" else [1])],
+            }
+        finally:
+            if not args.keep:
+                es.indices.delete(index=name, ignore_unavailable=True)
+        results.append(result)
+        best = max(result["runs"], key=lambda run: run[f"recall@{args.k}"])
+        print(f"{index_type:<10} {result['memory_bytes_per_million'] / 2 ** 20:8.0f} MiB/M vectors "
+              f"recall@{args.k}={best[f'recall@{args.k}']:.4f} p50={best['latency_ms_p50']:.1f}ms "
+              f"(oversample {best['oversample']:g})", file=sys.stderr)
+
+    report = {"vectors": count, "dims": dims, "queries": len(queries), "k": args.k,
+              "num_candidates": args.num_candidates, "m": args.m, "ef_construction": args.ef_construction,
+              "results": results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)